@@ -0,0 +1,123 @@
+"""
+Gemini 接続プールのベンチマーク
+- ローカルのスタブサーバー（Gemini と同じ形の JSON を返す）に対して
+  「毎回新規接続（requests.post）」と「共有接続プール（_GeminiHTTPClient）」を比較する
+- 新規接続ごとに --handshake-ms だけ待たせて TCP+TLS ハンドシェイクの往復を模擬する
+
+使い方:
+    python bench_gemini_pool.py --requests 200 --threads 4 --handshake-ms 60
+"""
+
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from main import _GeminiHTTPClient
+
+STUB_RESPONSE = json.dumps(
+    {"candidates": [{"content": {"parts": [{"text": "スタブの解説です。"}]}}]},
+    ensure_ascii=False,
+).encode("utf-8")
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive を有効にする
+    disable_nagle_algorithm = True  # ヘッダーと本文の分割送信で遅延 ACK 待ちにならないように
+
+    def setup(self):
+        super().setup()
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        time.sleep(server.handshake_seconds)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.lock:
+            self.server.requests += 1
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(STUB_RESPONSE)))
+        self.end_headers()
+        self.wfile.write(STUB_RESPONSE)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(handshake_ms: float) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.handshake_seconds = handshake_ms / 1000.0
+    server.connections = 0
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run(server: ThreadingHTTPServer, post, total: int, threads: int) -> dict:
+    server.connections = 0
+    server.requests = 0
+    url = f"http://127.0.0.1:{server.server_address[1]}/v1beta/models/stub:generateContent"
+    payload = {"contents": [{"parts": [{"text": "ベンチマーク"}]}]}
+    latencies = []
+
+    def one(_):
+        started = time.perf_counter()
+        post(url, payload)
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(one, range(total)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "seconds": elapsed,
+        "rps": total / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        "server_connections": server.connections,
+        "server_requests": server.requests,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gemini 接続プールのベンチマーク（ローカルスタブ）")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--handshake-ms", type=float, default=60.0, help="新規接続ごとの模擬ハンドシェイク時間")
+    parser.add_argument("--pool-size", type=int, default=10)
+    args = parser.parse_args()
+
+    server = start_stub_server(args.handshake_ms)
+
+    def per_request(url, payload):
+        resp = requests.post(url, json=payload, timeout=30)
+        resp.raise_for_status()
+        return resp.json()
+
+    client = _GeminiHTTPClient(pool_size=args.pool_size)
+    results = {
+        "毎回新規接続": run(server, per_request, args.requests, args.threads),
+        "共有接続プール": run(server, client.post_json, args.requests, args.threads),
+    }
+    server.shutdown()
+
+    for name, r in results.items():
+        print(
+            f"{name}: {r['seconds']:.2f}秒 ({r['rps']:.1f} req/s) "
+            f"p50 {r['p50_ms']:.1f}ms / p95 {r['p95_ms']:.1f}ms / "
+            f"接続 {r['server_connections']}本 / リクエスト {r['server_requests']}件"
+        )
+    print(f"クライアント計測: {client.metrics()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,387 @@
+"""
+画面なしで動かす管理コマンド
+- main.py の処理をそのまま使う（secrets も `streamlit run` と同じ .streamlit/secrets.toml から読む）
+- アプリと同じディレクトリで実行すること
+- デッキ・履歴は1行ずつ読み書きするので、大きなシートでもメモリ使用量は一定
+
+使い方:
+    # デッキ・履歴の書き出し（--output 省略時は標準出力）
+    python cli.py export-deck --deck "https://docs.google.com/spreadsheets/d/..." --format csv --output deck.csv
+    python cli.py export-history --deck "https://..." --user alice --output history.jsonl
+    python cli.py export-history --summary
+    # デッキの検査（--deck 省略時は secrets に登録された全デッキ。問題があれば終了コード 1）
+    python cli.py validate
+    # 近似重複のまとまりを一覧する（MinHash + LSH。まとまりがあれば終了コード 1）
+    python cli.py dedup --threshold 0.8 --format jsonl --output duplicates.jsonl
+    # 履歴の取り込み（Sheets -> SQLite）と難易度の推定を済ませておく
+    python cli.py warm --users alice,bob
+    # 履歴の書き出し（SQLite -> Sheets）・保存期間より古い履歴の集約
+    python cli.py replicate-history
+    python cli.py compact-history --retention-days 180
+    # 解説（6列目）が空のカードに AI 解説を生成して書き込む（中断しても続きから再開できる）
+    python cli.py backfill --deck "https://docs.google.com/spreadsheets/d/..." --workers 2
+    # 書き込まずに生成だけ試す（ローカルの CSV デッキでも可）
+    python cli.py backfill --deck deck.csv --dry-run --limit 5
+"""
+
+import argparse
+import csv
+import json
+import logging
+import sys
+import time
+
+import streamlit as st
+
+# 画面なしで main.py の st.cache_resource などを通るたびに出る「missing ScriptRunContext」の警告だけを抑える
+# （streamlit はログレベルを設定から上書きするので、レベルではなくフィルターで落とす）
+logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").addFilter(
+    lambda record: "missing ScriptRunContext" not in record.getMessage()
+)
+
+import main as app  # noqa: E402
+
+
+def _secret(name: str, default=None):
+    try:
+        return st.secrets.get(name, default)
+    except FileNotFoundError:
+        return default
+
+
+def _deck_urls(args) -> list[str]:
+    if args.deck:
+        return [args.deck]
+    try:
+        return app.configured_deck_urls()
+    except FileNotFoundError:
+        return []
+
+
+def _open_output(path: str | None):
+    return open(path, "w", encoding="utf-8", newline="") if path and path != "-" else sys.stdout
+
+
+def _write_records(records, fields: list[str], fmt: str, out) -> int:
+    """dict を1件ずつ CSV か JSONL で書き出す。書き出した件数を返す。"""
+    count = 0
+    if fmt == "csv":
+        writer = csv.DictWriter(out, fieldnames=fields, extrasaction="ignore")
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record)
+            count += 1
+    else:
+        for record in records:
+            out.write(json.dumps({f: record.get(f) for f in fields}, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+# ===================================================================
+# 書き出し
+# ===================================================================
+DECK_EXPORT_FIELDS = ["front", "back", "wrong_choices", "explanation", "notes", "hidden"]
+
+
+def _deck_export_record(item: dict, fmt: str) -> dict:
+    if fmt == "csv":
+        # CSV はシートと同じ列構成（3～5列目に誤答の選択肢）
+        wrongs = (item.get("wrong_choices", []) + ["", "", ""])[:3]
+        return {"表": item["front"], "裏": item["back"], "誤答1": wrongs[0], "誤答2": wrongs[1], "誤答3": wrongs[2],
+                "解説": item.get("explanation", ""), "メモ": item.get("notes", ""),
+                "非表示": "TRUE" if item.get("hidden") else ""}
+    return {f: item.get(f, [] if f == "wrong_choices" else "") for f in DECK_EXPORT_FIELDS}
+
+
+def cmd_export_deck(args) -> int:
+    urls = _deck_urls(args)
+    if len(urls) != 1:
+        print(f"書き出すデッキを --deck で1つ指定してください（secrets に登録されたデッキ: {len(urls)}件）",
+              file=sys.stderr)
+        return 2
+    fields = ["表", "裏", "誤答1", "誤答2", "誤答3", "解説", "メモ", "非表示"] if args.format == "csv" else DECK_EXPORT_FIELDS
+    out = _open_output(args.output)
+    try:
+        count = _write_records((_deck_export_record(item, args.format) for item in app.iter_deck_items(urls[0])),
+                               fields, args.format, out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(f"{count}件を書き出しました", file=sys.stderr)
+    return 0
+
+
+def cmd_export_history(args) -> int:
+    store = app._history_store()
+    if args.summary:
+        records = store.iter_summaries(args.deck, args.user)
+        fields = ["deck_url", "user_id", "word", "attempts", "corrects", "last_correct", "last_timestamp"]
+    else:
+        records = store.iter_records(args.deck, args.user)
+        fields = ["deck_url", "user_id", "timestamp", "word", "correct"]
+    out = _open_output(args.output)
+    try:
+        count = _write_records(records, fields, args.format, out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(f"{count}件を書き出しました", file=sys.stderr)
+    return 0
+
+
+# ===================================================================
+# 検査
+# ===================================================================
+def validate_deck(url: str, counts: dict):
+    """デッキの問題点を (場所, 内容) で1件ずつ返す。カード数・出題対象数は counts に入れる。
+
+    行は1行ずつ読む。重複の検出のため、表面と最初に出た場所だけは保持する。
+    """
+    first_seen = {}
+    total = visible = 0
+    source_first = None
+    for source, number, row in app.iter_deck_rows(url):
+        where = f"{source}:{number}"
+        if not any(c.strip() for c in row):
+            continue
+        front = row[0].strip() if row else ""
+        back = row[1].strip() if len(row) > 1 else ""
+        if source != source_first:
+            source_first = source
+            if front.lower() in app.HEADER_FRONTS:
+                continue  # 見出し行
+        if not front or not back:
+            yield where, "表または裏が空のため読み込まれません"
+            continue
+        total += 1
+        if front in first_seen:
+            yield where, f"表「{front}」が {first_seen[front]} と重複しています（解説・メモ・非表示は最初の行に書き込まれます）"
+        else:
+            first_seen[front] = where
+        wrongs = [c.strip() for c in row[2:5] if c.strip()]
+        if back in wrongs:
+            yield where, "誤答の選択肢に正解と同じものがあります"
+        if len(set(wrongs)) != len(wrongs):
+            yield where, "誤答の選択肢が重複しています"
+        flag = row[7].strip() if len(row) > 7 else ""
+        if flag and flag.lower() not in ("true", "1", "hidden", "非表示", "false", "0"):
+            yield where, f"8列目（非表示）の値「{flag}」は非表示として扱われません"
+        if flag.lower() not in ("true", "1", "hidden", "非表示"):
+            visible += 1
+    counts["total"], counts["visible"] = total, visible
+    if visible < 4:
+        yield url, f"出題できるカードが{visible}件です（4択クイズには4件以上必要）"
+
+
+def cmd_validate(args) -> int:
+    urls = _deck_urls(args)
+    if not urls:
+        print("検査するデッキがありません（--deck または secrets の spreadsheet_url / [decks]）", file=sys.stderr)
+        return 2
+    problems = 0
+    for url in urls:
+        print(f"== {url}")
+        counts = {}
+        try:
+            for where, message in validate_deck(url, counts):
+                print(f"{where}: {message}")
+                problems += 1
+        except Exception as e:
+            print(f"読み込めませんでした: {e}")
+            problems += 1
+            continue
+        print(f"カード {counts['total']}件 / 出題対象 {counts['visible']}件")
+    return 1 if problems else 0
+
+
+def cmd_dedup(args) -> int:
+    urls = _deck_urls(args)
+    if not urls:
+        print("検査するデッキがありません（--deck または secrets の spreadsheet_url / [decks]）", file=sys.stderr)
+        return 2
+    threshold = args.threshold or float(_secret("near_duplicate_threshold", app.NEAR_DUPLICATE_THRESHOLD))
+    found = 0
+    out = _open_output(args.output)
+    try:
+        for url in urls:
+            started = time.perf_counter()
+            try:
+                items = [item for item in app.iter_deck_items(url) if args.include_hidden or not item["hidden"]]
+                clusters = app.find_near_duplicates(items, threshold)
+            except Exception as e:
+                print(f"{url}: 読み込めませんでした: {e}", file=sys.stderr)
+                found += 1
+                continue
+            for n, cluster in enumerate(clusters, 1):
+                if args.format == "jsonl":
+                    cards = [{"front": c["front"], "back": c["back"]} for c in cluster]
+                    record = {"deck": url, "cluster": n, "cards": cards}
+                    out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                else:
+                    out.write(f"[{n}] {len(cluster)}件\n")
+                    out.writelines(f"    {c['front']} → {c['back']}\n" for c in cluster)
+            found += len(clusters)
+            print(
+                f"{url}: カード {len(items)}件 / 近似重複 {len(clusters)}組・{sum(len(c) for c in clusters)}件 "
+                f"({time.perf_counter() - started:.1f}秒)",
+                file=sys.stderr,
+            )
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 1 if found else 0
+
+
+# ===================================================================
+# 事前準備・定期ジョブ
+# ===================================================================
+def cmd_warm(args) -> int:
+    urls = _deck_urls(args)
+    if not urls:
+        print("対象のデッキがありません（--deck または secrets の spreadsheet_url / [decks]）", file=sys.stderr)
+        return 2
+    store = app._history_store()
+    users = [u.strip() for u in args.users.split(",")] if args.users else None
+    failed = 0
+    for url in urls:
+        started = time.perf_counter()
+        try:
+            count = sum(1 for _item in app.iter_deck_items(url))
+            targets = users if users is not None else sorted(
+                u for d, u in store.partitions() if d == url and not app.is_anonymous_user(u))
+            for user_id in targets:
+                app.import_history_from_sheets_once(url, user_id)
+            model = app._difficulty_models().get(url)
+        except Exception as e:
+            print(f"{url}: 失敗しました: {e}")
+            failed += 1
+            continue
+        responses = model.responses if model is not None else 0
+        print(f"{url}: カード {count}件 / 履歴の取り込み {len(targets)}人 / 難易度の推定 回答 {responses}件 "
+              f"({time.perf_counter() - started:.2f}秒)")
+    return 1 if failed else 0
+
+
+def _replicator(retention_days: float = 0):
+    return app._HistoryReplicator(app._history_store(), interval=0, retention_days=retention_days, start=False)
+
+
+def cmd_replicate_history(args) -> int:
+    replicator = _replicator()
+    before = app._history_store().counts()[1]
+    replicator.replicate_pending()
+    after = app._history_store().counts()[1]
+    print(f"書き出し {before - after}件 / 未書き出し {after}件")
+    if replicator.last_error:
+        print(f"エラー: {replicator.last_error}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def cmd_compact_history(args) -> int:
+    replicator = _replicator(args.retention_days)
+    replicator.compact()
+    print(f"集約 {replicator.compacted_rows}件")
+    if replicator.compact_error:
+        print(f"エラー: {replicator.compact_error}", file=sys.stderr)
+        return 1
+    return 0
+
+
+# ===================================================================
+# AI解説の一括補完
+# ===================================================================
+def cmd_backfill(args) -> int:
+    deck = args.deck or _secret("spreadsheet_url", "")
+    api_key = args.api_key or _secret("gemini_api_key", "")
+    if not deck:
+        print("デッキを --deck で指定してください（secrets の spreadsheet_url も未設定です）", file=sys.stderr)
+        return 2
+    if not api_key:
+        print("Gemini の APIキーがありません（--api-key または secrets の gemini_api_key）", file=sys.stderr)
+        return 2
+    try:
+        stats = app.backfill_explanations(
+            deck, api_key, args.checkpoint,
+            target_chars=args.chars,
+            temperature=args.temperature,
+            workers=args.workers,
+            batch_size=args.batch_size,
+            limit=args.limit,
+            dry_run=args.dry_run,
+        )
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    print(
+        f"対象 {stats['targets']}件 / 生成 {stats['generated']}件 / 前回から再開 {stats['resumed']}件 / "
+        f"書き込み {stats['written']}件 / 失敗 {stats['failed']}件"
+    )
+    return 1 if stats["failed"] else 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="クイズアプリの管理コマンド（画面なし）")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_deck = commands.add_parser("export-deck", help="デッキを CSV / JSONL で書き出す")
+    export_deck.add_argument("--deck", help="デッキの URL またはローカルファイル"
+                             "（省略できるのは secrets の spreadsheet_url / [decks] に登録されたデッキが1つだけのとき）")
+    export_deck.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+    export_deck.add_argument("--output", help="書き出し先（省略時は標準出力）")
+    export_deck.set_defaults(handler=cmd_export_deck)
+
+    export_history = commands.add_parser("export-history", help="履歴DB（SQLite）の履歴を書き出す")
+    export_history.add_argument("--deck", help="デッキで絞り込む")
+    export_history.add_argument("--user", help="ユーザーIDで絞り込む（\"\" は未識別ユーザー）")
+    export_history.add_argument("--summary", action="store_true", help="集約済み履歴を書き出す")
+    export_history.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+    export_history.add_argument("--output", help="書き出し先（省略時は標準出力）")
+    export_history.set_defaults(handler=cmd_export_history)
+
+    validate = commands.add_parser("validate", help="デッキの空欄・重複・選択肢の誤りを検査する")
+    validate.add_argument("--deck", help="省略時は secrets に登録された全デッキ")
+    validate.set_defaults(handler=cmd_validate)
+
+    dedup = commands.add_parser("dedup", help="表・裏がほぼ同じカードのまとまりを一覧する")
+    dedup.add_argument("--deck", help="省略時は secrets に登録された全デッキ")
+    dedup.add_argument("--threshold", type=float, help="類似度（Jaccard 係数）のしきい値（省略時は secrets の near_duplicate_threshold か 0.7）")
+    dedup.add_argument("--include-hidden", action="store_true", help="非表示のカードも含める")
+    dedup.add_argument("--format", choices=["text", "jsonl"], default="text")
+    dedup.add_argument("--output", help="書き出し先（省略時は標準出力）")
+    dedup.set_defaults(handler=cmd_dedup)
+
+    warm = commands.add_parser("warm", help="履歴の取り込みと難易度の推定を済ませておく")
+    warm.add_argument("--deck", help="省略時は secrets に登録された全デッキ")
+    warm.add_argument("--users", help="取り込むユーザーID（カンマ区切り。省略時は履歴DBにいるユーザー）")
+    warm.set_defaults(handler=cmd_warm)
+
+    replicate = commands.add_parser("replicate-history", help="未書き出しの履歴を Sheets へ書き出す")
+    replicate.set_defaults(handler=cmd_replicate_history)
+
+    compact = commands.add_parser("compact-history", help="保存期間より古い履歴を単語ごとに集約する")
+    compact.add_argument("--retention-days", type=float, required=True)
+    compact.set_defaults(handler=cmd_compact_history)
+
+    backfill = commands.add_parser("backfill", help="解説（6列目）が空のカードに AI 解説を生成して書き込む")
+    backfill.add_argument("--deck", help="デッキの URL またはローカルファイル（省略時は secrets の spreadsheet_url）")
+    backfill.add_argument("--api-key", help="Gemini の APIキー（省略時は secrets の gemini_api_key）")
+    backfill.add_argument("--checkpoint", default="backfill_checkpoint.jsonl", help="進み具合を記録するファイル")
+    backfill.add_argument("--chars", type=int, default=500, help="解説の文字数の目安")
+    backfill.add_argument("--temperature", type=float, default=0.3)
+    backfill.add_argument("--workers", type=int, default=2, help="同時に生成する件数")
+    backfill.add_argument("--batch-size", type=int, default=20, help="まとめて書き込む件数")
+    backfill.add_argument("--limit", type=int, help="今回生成する最大件数")
+    backfill.add_argument("--dry-run", action="store_true", help="生成だけしてシートには書き込まない")
+    backfill.set_defaults(handler=cmd_backfill)
+
+    args = parser.parse_args(argv)
+    if getattr(args, "deck", None) and args.command != "export-history":
+        # コマンドラインで指定したデッキは secrets に登録が無くても読む（export-history は絞り込みなので除く）
+        app.trust_local_deck(args.deck)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
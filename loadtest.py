@@ -0,0 +1,299 @@
+"""
+複数セッションの負荷試験
+- 記録した操作トレース（secrets の trace_path で main.py が書き出す JSONL）を
+  N 個の模擬セッション（Streamlit の AppTest）で再生し、再実行（rerun）1回ごとの所要時間、
+  全員が同時に操作したときの待ち時間の分布と、セッションあたりの CPU 時間・メモリ増分を
+  N ごとに表示する
+- デッキはローカルの CSV（Sheets の代わり）、Gemini はローカルのスタブサーバーを使うので
+  外部サービスには一切アクセスしない
+
+使い方:
+    # 1. 普段どおり操作してトレースを記録（.streamlit/secrets.toml に trace_path = "trace.jsonl"）
+    # 2. 再生
+    python loadtest.py --trace trace.jsonl --sessions 1,2,4,8
+    # トレースが無い場合は合成トレース（クイズ・フラッシュカード・マッチング）で試せる
+    python loadtest.py --sessions 1,2,4 --deck-size 2000
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from streamlit.testing.v1 import AppTest
+
+from bench_gemini_pool import start_stub_server
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+SLOW_RERUN_SECONDS = 1.0
+
+
+# ===================================================================
+# トレースの読み込み・合成
+# ===================================================================
+def load_traces(path: str) -> list[list[dict]]:
+    """JSONL のトレースをセッションごとの操作列にまとめる（時刻順）。"""
+    sessions = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            event = json.loads(line)
+            sessions.setdefault(event.get("session", ""), []).append(event)
+    return [sorted(events, key=lambda e: e.get("t", 0)) for events in sessions.values()]
+
+
+def synthetic_trace(seed: int = 0) -> list[dict]:
+    """4択クイズ → フラッシュカード → マッチングを一通り操作する合成トレース。"""
+    rng = random.Random(seed)
+    events = [{"action": "mode", "value": "4択クイズ"}]
+    for _ in range(15):
+        events.append({"action": "quiz_answer", "correct": rng.random() < 0.7})
+        events.append({"action": "quiz_next"})
+    events.append({"action": "mode", "value": "フラッシュカード"})
+    for _ in range(10):
+        events.append({"action": "fc_flip"})
+        events.append({"action": "fc_next", "known": rng.random() < 0.5})
+    events.append({"action": "mode", "value": "マッチングゲーム"})
+    events.extend({"action": "match_click"} for _ in range(16))
+    events.append({"action": "mode", "value": "学習履歴"})
+    return events
+
+
+# ===================================================================
+# 模擬バックエンド
+# ===================================================================
+def write_fake_deck(directory: str, size: int) -> str:
+    """Sheets の代わりに読み込ませるローカル CSV デッキを作る。"""
+    path = os.path.join(directory, "loadtest_deck.csv")
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write("表,裏\n")
+        for i in range(size):
+            f.write(f"用語{i:05d},定義{i:05d}\n")
+    return path
+
+
+# ===================================================================
+# 1セッション分の再生
+# ===================================================================
+class _Session:
+    """1人の学習者に相当する AppTest。rerun ごとの所要時間を記録する。"""
+
+    def __init__(self, secrets: dict, rng: random.Random, timeout: float):
+        self.at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+        for key, value in secrets.items():
+            self.at.secrets[key] = value
+        self.rng = rng
+        self.latencies = []
+        self.skipped = 0
+        self.errors = 0
+
+    def run(self, element=None):
+        started = time.perf_counter()
+        if element is None:
+            self.at.run()
+        else:
+            element.run()
+        self.latencies.append(time.perf_counter() - started)
+        if self.at.exception:
+            self.errors += 1
+
+    def start(self):
+        # 初回は履歴の読み込み待ちで数回 rerun が必要
+        for _ in range(4):
+            self.run()
+
+    def _button(self, key: str):
+        try:
+            return self.at.button(key=key)
+        except KeyError:
+            return None
+
+    def _button_by_label(self, label: str):
+        for button in self.at.button:
+            if button.label == label and not button.disabled:
+                return button
+        return None
+
+    def _click(self, button) -> bool:
+        if button is None:
+            self.skipped += 1
+            return False
+        self.run(button.click())
+        return True
+
+    def replay(self, event: dict):
+        action = event.get("action")
+        state = self.at.session_state
+        if action == "mode":
+            self.run(self.at.radio(key="learning_mode").set_value(event["value"]))
+            if event["value"] == "フラッシュカード":
+                # サーバー側のめくりを計測する（ブラウザ内めくりは rerun を伴わない）
+                for toggle in self.at.toggle:
+                    if toggle.key == "fc_client_side" and toggle.value:
+                        self.run(toggle.set_value(False))
+        elif action == "quiz_answer":
+            if state.get("quiz_answered"):
+                self._click(self._button("next_q"))
+            if state.get("quiz_finished") or state.get("quiz_question") is None:
+                self._click(self._button_by_label("🔄 最初から挑戦する"))
+                return
+            options = state.get("quiz_options") or []
+            back = state.get("quiz_question")["back"]
+            wanted = [i for i, o in enumerate(options) if (o == back) == bool(event.get("correct"))]
+            self._click(self._button(f"opt_{self.rng.choice(wanted)}") if wanted else None)
+        elif action == "quiz_next":
+            self._click(self._button("next_q"))
+        elif action == "quiz_ai":
+            question = state.get("quiz_question")
+            self._click(self._button(f"ai_gen_{question['front']}") if question else None)
+        elif action == "fc_flip":
+            self._click(self._button("flip_btn"))
+        elif action == "fc_next":
+            label = "⭕ 覚えた！ (Next)" if event.get("known") else "❌ まだ (Next)"
+            if not self._click(self._button_by_label(label)):
+                self._click(self._button_by_label("🔄 最初からやり直す"))
+        elif action == "match_click":
+            hidden = [b for b in self.at.button if b.label == "❓" and not b.disabled]
+            if hidden:
+                self._click(self.rng.choice(hidden))
+            else:
+                self._click(self._button("next_match_btn") or self._button("new_match"))
+        elif action == "match_new":
+            self._click(self._button("next_match_btn") or self._button("new_match"))
+        else:
+            self.skipped += 1
+
+
+# ===================================================================
+# 計測
+# ===================================================================
+def _rss_bytes() -> int:
+    """現在の常駐メモリ（Linux は /proc、それ以外は最大常駐メモリで代用）。"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _percentile(sorted_values: list[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def _session_state_bytes(session: _Session) -> int:
+    """セッションステートの大きさの目安（JSON にできる値と、nbytes() を持つストアを数える）。"""
+    total = 0
+    for value in session.at.session_state.to_dict().values():
+        if callable(getattr(value, "nbytes", None)):
+            total += value.nbytes()
+            continue
+        try:
+            total += len(json.dumps(value, ensure_ascii=False, default=str))
+        except (TypeError, ValueError):
+            pass
+    return total
+
+
+def run_level(n: int, traces: list[list[dict]], secrets: dict, timeout: float, seed: int) -> dict:
+    """n セッションを再生して、その段階の計測結果を返す。
+
+    AppTest は1プロセスに1つの Runtime を前提にしていて同時には動かせないので、
+    セッションを1操作ずつ順番に進める（ラウンドロビン）。Streamlit の rerun は GIL の下で
+    実質的に直列に処理されるため、全員が同時に操作したときの待ち時間は
+    「そのラウンドで自分の番が終わるまでの時間」として求める。
+    """
+    rss_before = _rss_bytes()
+    cpu_before = time.process_time()
+    sessions = [_Session(secrets, random.Random(seed + i), timeout) for i in range(n)]
+    for session in sessions:
+        session.start()
+        session.latencies.clear()  # 起動時の読み込みは計測から除く
+
+    scripts = [traces[i % len(traces)] for i in range(n)]
+    waits = []
+    started = time.perf_counter()
+    for step in range(max(len(script) for script in scripts)):
+        round_started = time.perf_counter()
+        for session, script in zip(sessions, scripts):
+            if step < len(script):
+                session.replay(script[step])
+                waits.append(time.perf_counter() - round_started)
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(t for s in sessions for t in s.latencies)
+    waits.sort()
+    return {
+        "sessions": n,
+        "reruns": len(latencies),
+        "seconds": elapsed,
+        "p50": _percentile(latencies, 0.50),
+        "p95": _percentile(latencies, 0.95),
+        "p99": _percentile(latencies, 0.99),
+        "wait_p50": _percentile(waits, 0.50),
+        "wait_p95": _percentile(waits, 0.95),
+        "slow": sum(1 for t in waits if t > SLOW_RERUN_SECONDS) / max(1, len(waits)),
+        "cpu_per_session": (time.process_time() - cpu_before) / n,
+        "rss_per_session": max(0, _rss_bytes() - rss_before) / n,
+        "state_per_session": sum(_session_state_bytes(s) for s in sessions) / n,
+        "skipped": sum(s.skipped for s in sessions),
+        "errors": sum(s.errors for s in sessions),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="記録した操作トレースを複数セッションで再生する負荷試験")
+    parser.add_argument("--trace", help="main.py が trace_path に書き出した JSONL（省略時は合成トレース）")
+    parser.add_argument("--sessions", default="1,2,4,8", help="同時セッション数（カンマ区切りで段階的に）")
+    parser.add_argument("--deck-size", type=int, default=500)
+    parser.add_argument("--gemini-latency-ms", type=float, default=0.0, help="スタブ Gemini の接続ごとの遅延")
+    parser.add_argument("--timeout", type=float, default=60.0, help="rerun 1回のタイムアウト秒数")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    traces = load_traces(args.trace) if args.trace else [synthetic_trace(args.seed + i) for i in range(8)]
+    traces = [t for t in traces if t]
+    if not traces:
+        parser.error("トレースに操作がありません")
+    levels = [int(n) for n in args.sessions.split(",") if n.strip()]
+
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    server = start_stub_server(args.gemini_latency_ms)
+    try:
+        deck_path = write_fake_deck(workdir, args.deck_size)
+        print(f"トレース {len(traces)}件 / デッキ {args.deck_size}枚 / 同時セッション {levels}")
+        print("rerun: 1回の処理時間 / 同時: 全員が同時に操作したときの待ち時間 / >1s: 同時操作で1秒を超えた割合")
+        print(
+            f"{'N':>4} {'rerun':>6} {'p50ms':>8} {'p95ms':>8} {'p99ms':>8} {'同時p50':>9} {'同時p95':>9} "
+            f"{'>1s':>6} {'CPU秒/人':>9} {'RSS MB/人':>10} {'state KB/人':>11} {'skip':>5} {'err':>4}"
+        )
+        for n in levels:
+            secrets = {
+                "spreadsheet_url": deck_path,
+                "gemini_api_key": "loadtest",
+                "gemini_api_base": f"http://127.0.0.1:{server.server_address[1]}",
+                # 履歴ストアはプロセス共有（cache_resource）なので全段階で同じファイルを使う
+                "history_db_path": os.path.join(workdir, "history.db"),
+            }
+            r = run_level(n, traces, secrets, args.timeout, args.seed)
+            print(
+                f"{r['sessions']:>4} {r['reruns']:>6} {r['p50'] * 1000:>8.1f} {r['p95'] * 1000:>8.1f} "
+                f"{r['p99'] * 1000:>8.1f} {r['wait_p50'] * 1000:>9.1f} {r['wait_p95'] * 1000:>9.1f} "
+                f"{r['slow']:>6.0%} "
+                f"{r['cpu_per_session']:>9.2f} {r['rss_per_session'] / 2**20:>10.1f} "
+                f"{r['state_per_session'] / 1024:>11.1f} {r['skipped']:>5} {r['errors']:>4}"
+            )
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
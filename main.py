@@ -7,12 +7,30 @@ Streamlit 学習用Webアプリ
 - Googleカレンダー連携
 """
 
+import numpy as np
 import streamlit as st
+import streamlit.components.v1 as components
+import os
 import random
+import bisect
+import csv
+import contextlib
+import contextvars
+import hashlib
+import heapq
+import itertools
 import json
 import re
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
 import time
+import unicodedata
 import urllib.parse
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from datetime import datetime, timezone, timedelta
 
 # ---------------------------------------------------------------------------
@@ -39,25 +57,32 @@ except ImportError:
 
 # Gemini AI: SDKの代わりにrequestsで直接REST APIを呼ぶ（ライブラリ依存なし）
 import requests as _requests
+from requests.adapters import HTTPAdapter
+from http.cookiejar import DefaultCookiePolicy
 GEMINI_AVAILABLE = True  # requestsは常に使えるのでTrue固定
 GEMINI_ERROR = None
 
+# HTTP/2 はオプション（httpx[http2] があり、secrets の gemini_http2 が true のときだけ使う）
+try:
+    import httpx
+    HTTPX_AVAILABLE = True
+except ImportError:
+    HTTPX_AVAILABLE = False
+
 TARGET_SHEET_NAME = "{ここにシート名を記入}"
 
-# ---------------------------------------------------------------------------
-# ページ設定
-# ---------------------------------------------------------------------------
-st.set_page_config(
-    page_title="学習アプリ",
-    page_icon="📚",
-    layout="centered",
-    initial_sidebar_state="collapsed",
+# ブラウザ内フラッシュカード（ビルド不要の静的コンポーネント）
+_flashcard_deck = components.declare_component(
+    "flashcard_deck",
+    path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "components", "flashcard"),
 )
+FC_PREFETCH = 5     # 残りがこの枚数を切ったら次のカードを要求
+FC_BATCH_SIZE = 10  # 結果をまとめて送信する件数
 
 # ---------------------------------------------------------------------------
 # カスタムCSS（スマホ最適化）
 # ---------------------------------------------------------------------------
-st.markdown("""
+APP_CSS = """
 <style>
 /* ---------- 全体 ---------- */
 @import url('https://fonts.googleapis.com/css2?family=Noto+Sans+JP:wght@400;600;700&display=swap');
@@ -289,73 +314,565 @@ div.stButton > button:active {
     }
 }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+
+# ---------------------------------------------------------------------------
+# ページ設定
+# ---------------------------------------------------------------------------
+def setup_page():
+    """ページ設定とCSS。スクリプトの実行ごとに main() の最初に呼ぶ（import しただけでは画面に触れない）。"""
+    st.set_page_config(
+        page_title="学習アプリ",
+        page_icon="📚",
+        layout="centered",
+        initial_sidebar_state="collapsed",
+    )
+    st.markdown(APP_CSS, unsafe_allow_html=True)
 
 
 # ===================================================================
-# データ読み込み
+# Google Sheets へのアクセス（読み書きのクォータ管理）
 # ===================================================================
-
-# 新しい読み込み関数（URL指定版）
-@st.cache_data(ttl=300)
-def load_data_by_url(url: str) -> list[dict]:
-    """指定されたURLのGoogle Sheetsからデータを読み込む。"""
-    if not GSPREAD_AVAILABLE or not url:
-        return []
+# Sheets API への要求はすべて sheets_read / sheets_write を通す。読み取りと書き込みは別々の
+# 1分あたりのクォータなので、それぞれを優先度付きのトークンバケット（Gemini と同じ _PriorityRateLimiter）で待たせ、
+# 429 と 5xx・通信エラーはジッター付きの指数バックオフで再試行する。件数は呼び出し元の関数ごとに数える。
+# 優先度は呼び出し元で sheets_priority を使って切り替える（既定は画面操作）。
+SHEETS_PRIORITY_INTERACTIVE = 0  # 学習者が待っている読み書き（デッキの読み込み・問題の追加・履歴の初回取り込み）
+SHEETS_PRIORITY_EDIT = 1         # 解説・メモ・非表示のまとめ書き
+SHEETS_PRIORITY_BACKGROUND = 2   # 履歴の書き出し・集約、デッキの定期更新、解説の一括補完
+SHEETS_PRIORITY_LABELS = {0: "画面操作", 1: "セル編集", 2: "バックグラウンド"}
+SHEETS_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_sheets_priority = contextvars.ContextVar("sheets_priority", default=SHEETS_PRIORITY_INTERACTIVE)
+
+
+@contextlib.contextmanager
+def sheets_priority(priority: int):
+    """この中（同じスレッド）で行う Sheets の読み書きの優先度を変える。
+
+    ThreadPoolExecutor のワーカーには引き継がれないので、並列に読むときは map_in_context を使う。
+    """
+    token = _sheets_priority.set(priority)
     try:
+        yield
+    finally:
+        _sheets_priority.reset(token)
+
+
+def map_in_context(pool: ThreadPoolExecutor, fn, items) -> list:
+    """pool.map と同じだが、呼び出し元の contextvars（Sheets の優先度など）を各ワーカーで引き継ぐ。"""
+    context = contextvars.copy_context()
+    # 同じ Context は複数のスレッドで同時に run できないので、呼び出しごとに写す
+    return list(pool.map(lambda item: context.copy().run(fn, item), items))
+
+
+def _sheets_status(error: Exception) -> int | None:
+    """gspread の APIError / requests の HTTPError から HTTP ステータスを取り出す。"""
+    return getattr(getattr(error, "response", None), "status_code", None)
+
+
+class _SheetsQuota:
+    """Sheets API の読み取り・書き込みそれぞれのレート制限と再試行、呼び出し元ごとの件数。"""
+
+    def __init__(self, read_rpm: float, write_rpm: float, max_retries: int = 5,
+                 base_delay: float = 1.0, max_delay: float = 32.0):
+        self.limiters = {"read": _PriorityRateLimiter(read_rpm), "write": _PriorityRateLimiter(write_rpm)}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self.calls = {}  # 呼び出し元 -> {"read", "write", "retries", "errors", "wait"}
+
+    def _count(self, caller: str, field: str, amount: float = 1):
+        with self._lock:
+            counts = self.calls.get(caller)
+            if counts is None:
+                counts = self.calls[caller] = {"read": 0, "write": 0, "retries": 0, "errors": 0, "wait": 0.0}
+            counts[field] += amount
+
+    def call(self, caller: str, kind: str, fn, *args, **kwargs):
+        """kind（"read" / "write"）のバケットから1件分を取り出して fn を呼ぶ。"""
+        limiter = self.limiters[kind]
+        priority = _sheets_priority.get()
+        for attempt in range(self.max_retries + 1):
+            self._count(caller, "wait", limiter.acquire(priority))
+            self._count(caller, kind)
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                status = _sheets_status(e)
+                transient = status in SHEETS_RETRY_STATUSES or isinstance(
+                    e, (_requests.exceptions.ConnectionError, _requests.exceptions.Timeout))
+                if not transient or attempt == self.max_retries:
+                    if status is not None or transient:
+                        # WorksheetNotFound など API の応答でない例外は呼び出し側の分岐なので数えない
+                        self._count(caller, "errors")
+                    raise
+                if status == 429:
+                    # クォータ超過：全体の流量を絞り、次の acquire で空きを待つ
+                    limiter.on_throttled()
+                self._count(caller, "retries")
+                time.sleep(random.uniform(0.5, 1.0) * min(self.max_delay, self.base_delay * 2 ** attempt))
+                continue
+            limiter.on_success()
+            return result
+
+    def metrics(self) -> dict:
+        with self._lock:
+            calls = {caller: dict(counts) for caller, counts in self.calls.items()}
+        return {"read": self.limiters["read"].metrics(), "write": self.limiters["write"].metrics(), "calls": calls}
+
+
+@st.cache_resource
+def _sheets_quota() -> _SheetsQuota:
+    """サーバー全体で共有する Sheets のクォータ（secrets の sheets_read_rpm / sheets_write_rpm / sheets_max_retries）。"""
+    return _SheetsQuota(
+        read_rpm=float(st.secrets.get("sheets_read_rpm", 60)),
+        write_rpm=float(st.secrets.get("sheets_write_rpm", 60)),
+        max_retries=int(st.secrets.get("sheets_max_retries", 5)),
+    )
+
+
+def sheets_read(caller: str, fn, *args, **kwargs):
+    """Sheets の読み取り要求1件（worksheet・get_all_values・col_values など）。"""
+    return _sheets_quota().call(caller, "read", fn, *args, **kwargs)
+
+
+def sheets_write(caller: str, fn, *args, **kwargs):
+    """Sheets の書き込み要求1件（append_rows・batch_update・add_worksheet など）。"""
+    return _sheets_quota().call(caller, "write", fn, *args, **kwargs)
+
+
+@st.cache_resource
+def _sheets_client(readonly: bool = False):
+    """サービスアカウントの gspread クライアント（プロセス共有で認証トークンと接続を使い回す）。"""
+    if readonly:
         scopes = [
             "https://www.googleapis.com/auth/spreadsheets.readonly",
             "https://www.googleapis.com/auth/drive.readonly",
         ]
-        creds_dict = dict(st.secrets["gcp_service_account"])
-        creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
-        gc = gspread.authorize(creds)
+    else:
+        scopes = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
+    creds = Credentials.from_service_account_info(dict(st.secrets["gcp_service_account"]), scopes=scopes)
+    return gspread.authorize(creds)
 
-        sh = gc.open_by_url(url)
-        worksheet = sh.sheet1
-        rows = worksheet.get_all_values()
 
-        data = []
-        for row in rows:
-            if len(row) >= 2 and row[0].strip() and row[1].strip():
-                item = {"front": row[0].strip(), "back": row[1].strip()}
-                
-                # 3～5列目は「誤答の選択肢」として扱う
-                wrong_choices = [c.strip() for c in row[2:5] if len(row) > 2 and c.strip()]
-                if wrong_choices:
-                    item["wrong_choices"] = wrong_choices
-                
-                # 6列目があれば「解説」として扱う
-                if len(row) >= 6 and row[5].strip():
-                    item["explanation"] = row[5].strip()
+def _open_spreadsheet(url: str, caller: str, readonly: bool = False):
+    """スプレッドシートを開く（メタデータの読み取り1件）。"""
+    return sheets_read(caller, _sheets_client(readonly).open_by_url, url)
 
-                # 7列目があれば「メモ/参考URL」として扱う
-                if len(row) >= 7 and row[6].strip():
-                    item["notes"] = row[6].strip()
-                
-                # 8列目があれば「非表示」フラグとして扱う (TRUE, true, 1, などの場合は非表示)
-                if len(row) >= 8 and row[7].strip().lower() in ("true", "1", "hidden", "非表示"):
-                    item["hidden"] = True
+
+# ===================================================================
+# データ読み込み
+# ===================================================================
+
+DECK_CACHE_TTL = 300  # 秒。バックグラウンド更新が止まってもこの時間で読み直す
+
+
+class _DeckCache:
+    """プロセス全体で共有するデッキキャッシュ（URL -> 問題リスト）。
+
+    同じURLの同時読み込みはURL単位のロックで1回にまとめる。
+    返すリストは全セッションで共有されるため、呼び出し側で変更しないこと（変更は update_item で写しに差し替える）。
+    version を渡した場合（ローカルファイルの更新時刻など）は TTL ではなく version の一致で有効性を判断する。
+    """
+
+    def __init__(self, ttl: float = DECK_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._url_locks = {}
+        self._entries = {}      # url -> (読み込み時刻, data, version)
+        self._last_access = {}  # url -> 最終参照時刻
+
+    def _url_lock(self, url: str) -> threading.Lock:
+        with self._lock:
+            return self._url_locks.setdefault(url, threading.Lock())
+
+    def get(self, url: str, version=None) -> list[dict] | None:
+        with self._lock:
+            self._last_access[url] = time.time()
+            entry = self._entries.get(url)
+        if not entry:
+            return None
+        if version is not None:
+            return entry[1] if entry[2] == version else None
+        if time.time() - entry[0] < self.ttl:
+            return entry[1]
+        return None
+
+    def get_or_load(self, url: str, loader, version=None) -> list[dict]:
+        data = self.get(url, version)
+        if data is not None:
+            return data
+        with self._url_lock(url):
+            # ロック待ちの間に他のスレッドが読み込んでいればそれを使う
+            data = self.get(url, version)
+            if data is None:
+                data = loader(url)
+                self.put(url, data, version)
+            return data
+
+    def refresh(self, url: str, loader):
+        """古い内容を返し続けたまま読み直し、完了したら差し替える。"""
+        with self._url_lock(url):
+            self.put(url, loader(url))
+
+    def put(self, url: str, data: list[dict], version=None):
+        with self._lock:
+            self._entries[url] = (time.time(), data, version)
+
+    def update_item(self, url: str, front: str, fn) -> dict[int, dict]:
+        """表面が front の問題を写しに差し替えて fn で変更する（読み出し済みのリストや dict は変わらない）。
+
+        差し替えた {id(元の dict): 写し} を返す。キャッシュに無いデッキなら何もしない。
+        """
+        return self.update_items(url, {front}, fn)
+
+    def update_items(self, url: str, fronts: set[str], fn) -> dict[int, dict]:
+        """update_item の複数版（リストの写しは1回だけ作る）。"""
+        with self._lock:
+            entry = self._entries.get(url)
+            if not entry:
+                return {}
+            data = list(entry[1])
+            replaced = {}
+            for i, item in enumerate(data):
+                if item["front"] in fronts:
+                    copy = dict(item)
+                    fn(copy)
+                    replaced[id(item)] = data[i] = copy
+            if replaced:
+                self._entries[url] = (entry[0], data, entry[2])
+            return replaced
+
+    def invalidate(self, url: str | None = None):
+        with self._lock:
+            if url is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(url, None)
+
+    def active_urls(self, within: float) -> list[str]:
+        now = time.time()
+        with self._lock:
+            return [u for u, t in self._last_access.items() if now - t < within]
+
+
+@st.cache_resource
+def _deck_cache() -> _DeckCache:
+    return _DeckCache()
+
+
+def clear_deck_cache(url: str | None = None):
+    """デッキキャッシュを破棄する（url 省略時は全デッキ）。"""
+    _deck_cache().invalidate(url)
+
+
+def _load_deck(url: str) -> list[dict]:
+    """シートから読み込み、まだ書き込まれていないセル編集を重ねる（キャッシュへの読み込み用）。"""
+    return _sheet_edit_buffer().apply_pending(url, _fetch_deck(url))
+
+
+LOCAL_DECK_EXTENSIONS = (".csv", ".tsv", ".jsonl")
+HEADER_FRONTS = ("表", "front", "おもて", "question")
+
+
+def _row_to_item(row: list[str]) -> dict | None:
+    """シート1行分（A～H列）を問題 dict にする。表・裏のどちらかが空なら None。"""
+    if len(row) < 2 or not row[0].strip() or not row[1].strip():
+        return None
+    item = {"front": row[0].strip(), "back": row[1].strip()}
+
+    # 3～5列目は「誤答の選択肢」として扱う
+    wrong_choices = [c.strip() for c in row[2:5] if len(row) > 2 and c.strip()]
+    if wrong_choices:
+        item["wrong_choices"] = wrong_choices
+
+    # 6列目があれば「解説」として扱う
+    if len(row) >= 6 and row[5].strip():
+        item["explanation"] = row[5].strip()
+
+    # 7列目があれば「メモ/参考URL」として扱う
+    if len(row) >= 7 and row[6].strip():
+        item["notes"] = row[6].strip()
+
+    # 8列目があれば「非表示」フラグとして扱う (TRUE, true, 1, などの場合は非表示)
+    if len(row) >= 8 and row[7].strip().lower() in ("true", "1", "hidden", "非表示"):
+        item["hidden"] = True
+    else:
+        item["hidden"] = False
+    return item
+
+
+def _iter_row_items(rows):
+    """行のイテレータから問題を1件ずつ返す（先頭の見出し行は除く）。"""
+    first = True
+    for row in rows:
+        item = _row_to_item(row)
+        if item is None:
+            continue
+        if first:
+            first = False
+            if item["front"].lower() in HEADER_FRONTS:
+                continue
+        yield item
+
+
+def _rows_to_items(rows) -> list[dict]:
+    """行のイテレータを問題リストにする（先頭の見出し行は除く）。"""
+    return list(_iter_row_items(rows))
+
+
+_trusted_local_decks = set()  # コマンドラインの --deck で指定されたパス（画面からは増えない）
+
+
+def trust_local_deck(url: str):
+    """管理コマンドで指定されたローカルのデッキを、登録外でも読めるようにする。"""
+    _trusted_local_decks.add(os.path.realpath(_local_deck_path(url)))
+
+
+def _local_deck_allowed(real_path: str) -> bool:
+    """secrets に登録されたデッキ、secrets の local_deck_dir の下、コマンドラインで指定したパスだけを許す。"""
+    if real_path in _trusted_local_decks:
+        return True
+    try:
+        urls = configured_deck_urls()
+    except Exception:
+        urls = []
+    configured = {
+        os.path.realpath(_local_deck_path(u)) for u in urls if not u.startswith(("http://", "https://"))
+    }
+    if real_path in configured:
+        return True
+    base = _local_deck_dir()
+    return bool(base) and os.path.commonpath([real_path, base]) == base
+
+
+def _local_deck_dir() -> str:
+    """secrets の local_deck_dir（このフォルダの下のファイルは画面から直接指定できる）。未設定なら空文字。"""
+    try:
+        base = st.secrets.get("local_deck_dir", "")
+    except Exception:
+        return ""
+    return os.path.realpath(base) if base else ""
+
+
+def is_local_deck(url: str) -> bool:
+    """デッキの指定が、読んでよいローカルのファイル／フォルダか（file:// またはパス）。
+
+    ブラウザから入力された任意のパスは開かない（_local_deck_allowed を満たすものだけ）。
+    ファイルは通常のファイルで、拡張子が CSV/TSV/JSONL のものに限る。
+    """
+    if not url or url.startswith(("http://", "https://")):
+        return False
+    real_path = os.path.realpath(_local_deck_path(url))
+    if not (os.path.isdir(real_path) or _is_local_deck_file(real_path)):
+        return False
+    return _local_deck_allowed(real_path)
+
+
+def _is_local_deck_file(path: str) -> bool:
+    return os.path.isfile(path) and path.lower().endswith(LOCAL_DECK_EXTENSIONS)
+
+
+def _local_deck_path(url: str) -> str:
+    return urllib.parse.unquote(url[len("file://"):]) if url.startswith("file://") else url
+
+
+def _local_deck_files(path: str) -> list[str]:
+    """フォルダなら直下の CSV/TSV/JSONL を名前順に、ファイルならそれ自体を返す（拡張子の違うファイルは読まない）。"""
+    if os.path.isdir(path):
+        # フォルダの外を指すリンクはたどらない
+        folder = os.path.realpath(path)
+        files = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+        return [
+            f for f in files
+            if _is_local_deck_file(os.path.realpath(f)) and os.path.dirname(os.path.realpath(f)) == folder
+        ]
+    return [path] if _is_local_deck_file(os.path.realpath(path)) else []
+
+
+def _local_deck_version(url: str) -> tuple:
+    """ローカルデッキのキャッシュ判定用（各ファイルのパス・更新時刻・サイズ）。"""
+    path = _local_deck_path(url)
+    files = _local_deck_files(path)
+    version = [(f, os.stat(f).st_mtime_ns, os.stat(f).st_size) for f in files]
+    if os.path.isdir(path):
+        # ファイルの追加・削除も拾う
+        version.append((path, os.stat(path).st_mtime_ns, 0))
+    return tuple(version)
+
+
+def _iter_jsonl_rows(f):
+    """JSONL の各行を列のリストにする（配列はそのまま、オブジェクトは列名で並べ替える）。"""
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        obj = json.loads(line)
+        if isinstance(obj, list):
+            yield [str(c) for c in obj]
+            continue
+        wrongs = obj.get("wrong_choices") or []
+        yield [
+            str(obj.get("front", "")), str(obj.get("back", "")),
+            *[str(w) for w in (list(wrongs) + ["", "", ""])[:3]],
+            str(obj.get("explanation", "")), str(obj.get("notes", "")),
+            "TRUE" if obj.get("hidden") in (True, "TRUE", "true", "1", 1) else "",
+        ]
+
+
+def _fetch_local_deck(url: str) -> list[dict]:
+    """ローカルの CSV/TSV/JSONL（またはそれらのフォルダ）を1行ずつ読みながら問題リストにする。"""
+    return list(iter_deck_items(url))
+
+
+DECK_STREAM_CHUNK_ROWS = 1000  # シートを分けて読むときの1回あたりの行数
+
+
+def iter_deck_rows(url: str, chunk_rows: int = DECK_STREAM_CHUNK_ROWS):
+    """デッキの生の行を (ファイル名またはシート名, 行番号, 列のリスト) で1行ずつ返す。
+
+    デッキ全体をメモリに載せない（シートは chunk_rows 行ずつ範囲を指定して読む）。
+    画面なしの書き出し・検査用で、キャッシュは通さない。
+    """
+    if is_local_deck(url):
+        for file_path in _local_deck_files(_local_deck_path(url)):
+            ext = os.path.splitext(file_path)[1].lower()
+            with open(file_path, encoding="utf-8-sig", newline="") as f:
+                if ext == ".jsonl":
+                    rows = _iter_jsonl_rows(f)
                 else:
-                    item["hidden"] = False
+                    rows = csv.reader(f, delimiter="\t" if ext == ".tsv" else ",")
+                for number, row in enumerate(rows, start=1):
+                    yield file_path, number, row
+        return
+    worksheet = sheets_read("iter_deck_rows", _open_spreadsheet(url, "iter_deck_rows", readonly=True).get_worksheet, 0)
+    for start in range(1, worksheet.row_count + 1, chunk_rows):
+        end = min(worksheet.row_count, start + chunk_rows - 1)
+        for offset, row in enumerate(sheets_read("iter_deck_rows", worksheet.get, f"A{start}:H{end}")):
+            yield worksheet.title, start + offset, row
 
-                data.append(item)
 
-        if data and data[0]["front"].lower() in ("表", "front", "おもて", "question"):
-            data = data[1:]
+def iter_deck_items(url: str):
+    """デッキの問題を1件ずつ返す（見出し行の判定はファイルごと）。"""
+    for _source, rows in itertools.groupby(iter_deck_rows(url), key=lambda r: r[0]):
+        yield from _iter_row_items(row for _source, _number, row in rows)
 
-        return data
+
+def _fetch_deck(url: str) -> list[dict]:
+    """指定されたURL（Google Sheets またはローカルファイル）からデータを読み込む（キャッシュなし・例外は呼び出し側へ）。"""
+    if is_local_deck(url):
+        return _fetch_local_deck(url)
+    worksheet = sheets_read("_fetch_deck", _open_spreadsheet(url, "_fetch_deck", readonly=True).get_worksheet, 0)
+    return _rows_to_items(sheets_read("_fetch_deck", worksheet.get_all_values))
+
+
+# 新しい読み込み関数（URL指定版）
+def load_data_by_url(url: str) -> list[dict]:
+    """指定されたURLのGoogle Sheets（またはローカルファイル）からデータを読み込む（プロセス共有キャッシュ経由）。"""
+    try:
+        return _load_cached_deck(url)
     except Exception as e:
         st.error(f"データ読み込みエラー ({url}): {e}")
         return []
 
-@st.cache_data(ttl=300)
+
+def _load_cached_deck(url: str) -> list[dict]:
+    """load_data_by_url の本体（例外は呼び出し側へ。画面を持たないスレッドからも呼べる）。"""
+    if not url:
+        return []
+    if is_local_deck(url):
+        # ローカルファイルは更新時刻が変わったときだけ読み直す
+        return _deck_cache().get_or_load(url, _fetch_deck, _local_deck_version(url))
+    if not GSPREAD_AVAILABLE:
+        return []
+    return _deck_cache().get_or_load(url, _load_deck)
+
 def load_data_from_sheets() -> list[dict]:
     """(旧互換) secrets.spreadsheet_url から読み込む"""
     url = st.secrets.get("spreadsheet_url", "")
     return load_data_by_url(url)
 
 
+def configured_deck_urls() -> list[str]:
+    """secrets に登録されている全デッキのURL（spreadsheet_url と [decks]）。"""
+    urls = []
+    default_url = st.secrets.get("spreadsheet_url", "")
+    if default_url:
+        urls.append(default_url)
+    if "decks" in st.secrets:
+        for info in st.secrets["decks"].values():
+            if "url" in info:
+                urls.append(info["url"])
+    return list(dict.fromkeys(urls))
+
+
+@st.cache_resource
+def start_deck_warmup() -> dict:
+    """サーバー起動後の最初の実行で全デッキを並列に読み込み、定期更新スレッドを開始する。
+
+    プロセスにつき1回だけ実行される。戻り値の dict は所要時間などの統計で、
+    更新スレッドが随時書き換える。
+    """
+    stats = {"decks": 0, "seconds": None, "errors": {}, "refreshes": 0, "last_refresh_seconds": None}
+    try:
+        urls = configured_deck_urls()
+    except Exception:
+        urls = []
+    if not GSPREAD_AVAILABLE:
+        urls = [u for u in urls if is_local_deck(u)]
+    cache = _deck_cache()
+    indexes = _search_indexes()
+    difficulty = _difficulty_models()
+    interval = float(st.secrets.get("deck_refresh_interval", 240))
+    stats["decks"] = len(urls)
+
+    def load_all(target_urls: list[str], refresh: bool) -> float:
+        started = time.perf_counter()
+
+        def load_one(url: str):
+            try:
+                if is_local_deck(url):
+                    # ローカルファイルは更新時刻が変わっていれば読み直す
+                    data = cache.get_or_load(url, _fetch_deck, _local_deck_version(url))
+                elif refresh:
+                    # 定期更新は学習者の読み込み・書き込みの後に回す
+                    with sheets_priority(SHEETS_PRIORITY_BACKGROUND):
+                        cache.refresh(url, _load_deck)
+                    data = cache.get(url)
+                else:
+                    data = cache.get_or_load(url, _load_deck)
+                # 検索インデックス：初回は作っておき、更新時は使われているものだけ作り直す
+                if refresh:
+                    indexes.refresh(url, data)
+                else:
+                    indexes.get(url, data)
+                # 難易度：初回に推定し、更新時は古くなったものだけ推定し直す
+                difficulty.refresh(url)
+                stats["errors"].pop(url, None)
+            except Exception as e:
+                stats["errors"][url] = str(e)
+
+        if target_urls:
+            with ThreadPoolExecutor(max_workers=min(8, len(target_urls))) as pool:
+                map_in_context(pool, load_one, target_urls)
+        return time.perf_counter() - started
+
+    def warm_up_and_refresh():
+        stats["seconds"] = load_all(urls, refresh=False)
+        while interval > 0:
+            time.sleep(interval)
+            # 登録デッキに加え、直近に参照されたデッキ（URL直接入力など）も更新する
+            targets = list(dict.fromkeys(urls + cache.active_urls(within=interval * 4)))
+            stats["last_refresh_seconds"] = load_all(targets, refresh=True)
+            stats["refreshes"] += 1
+
+    threading.Thread(target=warm_up_and_refresh, name="deck-warmup", daemon=True).start()
+    return stats
+
+
 def get_sample_data() -> list[dict]:
     """ローカル開発用サンプルデータ。"""
     return [
@@ -378,6 +895,43 @@ def get_sample_data() -> list[dict]:
     ]
 
 
+def load_decks_merged(decks: dict[str, str]) -> list[dict]:
+    """複数デッキを並列に読み込み、(デッキ, 表面) で重複を除いた1つのプールに統合する。
+
+    各問題には出どころを示す "deck" / "deck_url" を付与する（履歴・メモ等の書き込み先の振り分け用）。
+    同じURLが別名で登録されていても1回だけ読み込む。
+    """
+    urls = list(dict.fromkeys(u for u in decks.values() if u))
+    if not urls:
+        return []
+    names = {}
+    for name, url in decks.items():
+        names.setdefault(url, name)
+
+    def load_one(url: str) -> tuple[list[dict], Exception | None]:
+        # st.error はスクリプトのスレッドでしか表示されないので、エラーは呼び出し側で出す
+        try:
+            return _load_cached_deck(url), None
+        except Exception as e:
+            return [], e
+
+    with ThreadPoolExecutor(max_workers=min(8, len(urls))) as pool:
+        loaded = map_in_context(pool, load_one, urls)
+
+    merged = []
+    seen = set()
+    for url, (items, error) in zip(urls, loaded):
+        if error is not None:
+            st.error(f"データ読み込みエラー ({names[url]}: {url}): {error}")
+        for item in items:
+            key = (url, item["front"])
+            if key in seen:
+                continue
+            seen.add(key)
+            merged.append({**item, "deck": names[url], "deck_url": url})
+    return merged
+
+
 def load_data(url: str = "") -> list[dict]:
     if url:
         return load_data_by_url(url)
@@ -388,17 +942,202 @@ def load_data(url: str = "") -> list[dict]:
         return data
     return get_sample_data()
 
+# ===================================================================
+# 全文検索（文字 n-gram の転置インデックス）
+# ===================================================================
+SEARCH_FIELDS = ("front", "back", "explanation", "notes")
+SEARCH_RESULT_LIMIT = 200
+
+
+def _search_normalize(text: str) -> str:
+    """全角・半角や大文字・小文字の違いを吸収する。"""
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+def _search_tokens(text: str) -> set[str]:
+    """文字の 1-gram と 2-gram（分かち書きなしで日本語にも効く）。空白はまたがない。"""
+    tokens = set()
+    for word in text.split():
+        tokens.update(word)
+        tokens.update(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+class _SearchIndex:
+    """1デッキ分の転置インデックス（トークン -> 問題の位置の集合）。
+
+    検索はクエリの 2-gram の出現集合を小さい順に積集合し、残った候補だけ本文に含まれるか確かめる。
+    """
+
+    def __init__(self, items: list[dict]):
+        self.items = items
+        self._lock = threading.Lock()
+        self._postings = {}
+        self._texts = []
+        self._fronts = []
+        self._tokens = []
+        self._positions = {}
+        for i, item in enumerate(items):
+            self._positions.setdefault(item["front"], i)
+            self._texts.append("")
+            self._fronts.append("")
+            self._tokens.append(())
+            self._index(i)
+
+    def _index(self, i: int):
+        item = self.items[i]
+        text = _search_normalize(" ".join(str(item.get(f, "")) for f in SEARCH_FIELDS))
+        tokens = _search_tokens(text)
+        self._texts[i] = text
+        self._fronts[i] = _search_normalize(item["front"])
+        self._tokens[i] = tuple(tokens)
+        for token in tokens:
+            posting = self._postings.get(token)
+            if posting is None:
+                self._postings[token] = {i}
+            else:
+                posting.add(i)
+
+    def update(self, front: str, items: list[dict] | None = None):
+        """メモ・解説の保存後に、その問題だけ索引を張り直す。
+
+        items を渡した場合は、問題を写しに差し替えたリスト（並びは同じ）に持ち替える。
+        """
+        with self._lock:
+            if items is not None and len(items) == len(self.items):
+                self.items = items
+            i = self._positions.get(front)
+            if i is None:
+                return
+            for token in self._tokens[i]:
+                self._postings[token].discard(i)
+            self._index(i)
+
+    def search(self, query: str, limit: int = SEARCH_RESULT_LIMIT) -> list[dict]:
+        terms = _search_normalize(query).split()
+        if not terms:
+            return []
+        grams = set()
+        for term in terms:
+            grams.update([term[i:i + 2] for i in range(len(term) - 1)] or [term])
+        with self._lock:
+            postings = sorted((self._postings.get(g, set()) for g in grams), key=len)
+            candidates = postings[0]
+            for posting in postings[1:]:
+                candidates = candidates & posting
+                if not candidates:
+                    return []
+            # 表面に含むものを先に、あとはデッキの並び順（どちらも limit 件あれば打ち切る）
+            front_hits, other_hits = [], []
+            for i in sorted(candidates):
+                if self.items[i].get("hidden") or not all(t in self._texts[i] for t in terms):
+                    continue
+                if all(t in self._fronts[i] for t in terms):
+                    front_hits.append(i)
+                    if len(front_hits) >= limit:
+                        break
+                elif len(other_hits) < limit:
+                    other_hits.append(i)
+        return [self.items[i] for i in (front_hits + other_hits)[:limit]]
+
+
+class _SearchIndexRegistry:
+    """デッキURLごとの検索インデックス（プロセス共有）。デッキが読み直されたら作り直す。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._indexes = {}
+
+    def get(self, url: str, items: list[dict]) -> _SearchIndex:
+        with self._lock:
+            index = self._indexes.get(url)
+        if index is None or index.items is not items:
+            index = _SearchIndex(items)
+            with self._lock:
+                self._indexes[url] = index
+        return index
+
+    def refresh(self, url: str, items: list[dict]):
+        """デッキの再読み込み時：一度でも使われたインデックスだけ作り直す。"""
+        with self._lock:
+            present = url in self._indexes
+        if present:
+            self.get(url, items)
+
+    def update(self, url: str, front: str, items: list[dict] | None = None):
+        with self._lock:
+            index = self._indexes.get(url)
+        if index is not None:
+            index.update(front, items)
+
+
+@st.cache_resource
+def _search_indexes() -> _SearchIndexRegistry:
+    return _SearchIndexRegistry()
+
+
+def search_cards(sources: dict[str, list[dict]], query: str) -> list[tuple[str, dict]]:
+    """複数デッキを横断して検索し、(デッキURL, 問題) のリストを返す。"""
+    registry = _search_indexes()
+    results = []
+    for url, items in sources.items():
+        for item in registry.get(url, items).search(query):
+            results.append((url, item))
+            if len(results) >= SEARCH_RESULT_LIMIT:
+                return results
+    return results
+
+
+def _start_search_quiz(query: str, keys: list[tuple[str, str]]):
+    """検索結果だけでクイズを始める（ボタンのコールバック）。"""
+    st.session_state.search_restrict = {"query": query, "keys": set(keys)}
+    st.session_state.learning_mode = "4択クイズ"
+
+
+def search_mode(sources: dict[str, list[dict]], deck_names: dict[str, str]):
+    st.markdown("### 🔎 検索")
+    query = st.text_input("キーワード（表・裏・解説・メモから探します）", key="search_query",
+                          placeholder="例：損益分岐点")
+    if not query.strip():
+        st.caption("スペース区切りで複数のキーワードを指定すると、すべてを含む問題を探します。")
+        return
+
+    started = time.perf_counter()
+    results = search_cards(sources, query)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    more = "以上" if len(results) >= SEARCH_RESULT_LIMIT else ""
+    st.caption(f"{len(results)}件{more} ({elapsed_ms:.1f}ms)")
+    if not results:
+        return
+
+    keys = [(url, item["front"]) for url, item in results]
+    st.button(f"🎯 この{len(results)}件でクイズ", type="primary", use_container_width=True,
+              on_click=_start_search_quiz, args=(query, keys), disabled=len(results) < 4,
+              help="4件以上必要です" if len(results) < 4 else None)
+
+    for url, item in results[:50]:
+        deck = f" — {deck_names[url]}" if deck_names.get(url) else ""
+        with st.expander(f"{item['front']}{deck}"):
+            st.markdown(f"**答え:** {item['back']}")
+            if item.get("explanation"):
+                st.info(f"💡 解説: {item['explanation']}")
+            if item.get("notes"):
+                st.caption(f"📝 {item['notes']}")
+    if len(results) > 50:
+        st.caption(f"ほか {len(results) - 50}件（キーワードを追加して絞り込んでください）")
+
+
 # --- フラッシュカードモード ---
 def flashcard_mode(data: list[dict]):
     st.markdown("### ⚡ フラッシュカード")
+
+    if st.toggle("⚡ ブラウザ内で高速めくり", value=True, key="fc_client_side",
+                 help="カードのめくり・送りをブラウザ内で処理し、結果はまとめて送信します"):
+        flashcard_client_mode(data)
+        return
     
-    if "fc_order" not in st.session_state or len(st.session_state.fc_order) != len(data):
-        st.session_state.fc_index = 0
-        st.session_state.fc_flipped = False
-        # ランダム順にするためにインデックスリストを作成
-        indices = list(range(len(data)))
-        random.shuffle(indices)
-        st.session_state.fc_order = indices
+    # ランダム順にするためにインデックスリストを作成
+    _ensure_fc_order(data)
 
     # 全問終了チェック
     if st.session_state.fc_index >= len(data):
@@ -412,14 +1151,11 @@ def flashcard_mode(data: list[dict]):
             unsafe_allow_html=True
         )
         if st.button("🔄 最初からやり直す", use_container_width=True):
-            st.session_state.fc_index = 0
-            st.session_state.fc_flipped = False
-            random.shuffle(st.session_state.fc_order)
+            st.session_state.fc_perm = None  # 次の周回のシードで並べ直す
             st.rerun()
         return
 
-    current_data_idx = st.session_state.fc_order[st.session_state.fc_index]
-    item = data[current_data_idx]
+    item = data[_fc_data_index(st.session_state.fc_index)]
     
     # カード表示
     card_content = item["back"] if st.session_state.fc_flipped else item["front"]
@@ -450,11 +1186,13 @@ def flashcard_mode(data: list[dict]):
     col1, col2 = st.columns(2)
     with col1:
         if st.button("arrows_rotate", help="カードを裏返す", key="flip_btn", use_container_width=True):
+            record_trace("fc_flip")
             st.session_state.fc_flipped = not st.session_state.fc_flipped
             st.rerun()
     
     # レイアウト調整：反転ボタンを大きく
     if st.button(label, use_container_width=True, type="primary"):
+        record_trace("fc_flip")
         st.session_state.fc_flipped = not st.session_state.fc_flipped
         st.rerun()
 
@@ -464,12 +1202,14 @@ def flashcard_mode(data: list[dict]):
     c1, c2 = st.columns(2)
     with c1:
         if st.button("❌ まだ (Next)", use_container_width=True):
+            record_trace("fc_next", known=False)
             st.session_state.fc_index += 1
             st.session_state.fc_flipped = False
             st.rerun()
     with c2:
         if st.button("⭕ 覚えた！ (Next)", use_container_width=True):
-            add_history_record(item["front"], True)
+            record_trace("fc_next", known=True)
+            add_history_record(item["front"], True, item.get("deck_url", ""))
             st.session_state.fc_index += 1
             st.session_state.fc_flipped = False
             st.session_state._ls_counter += 1
@@ -477,13 +1217,14 @@ def flashcard_mode(data: list[dict]):
             
     # 非表示ボタン
     if st.button("🗑️ この問題を非表示にする", key="fc_hide", use_container_width=True, help="この問題をスプレッドシート上で非表示に設定し、出題対象から除外します"):
-        if save_hidden_to_sheet(item["front"]):
+        if save_hidden_to_sheet(item["front"], item.get("deck_url")):
             st.success("問題を非表示にしました")
             time.sleep(1)
             st.rerun()
             
              
-    st.caption(f"進捗: {st.session_state.fc_index + 1} / {len(data)}")
+    shown, visible = _session_progress(data, st.session_state.fc_perm, st.session_state.fc_index)
+    st.caption(f"進捗: {shown + 1} / {visible}")
 
     # 中断して保存ボタン
     st.divider()
@@ -492,61 +1233,1061 @@ def flashcard_mode(data: list[dict]):
         # 状態リセットしてトップ(ようなもの)へ戻る、あるいはrerun
         st.session_state.fc_index = 0
         st.session_state.fc_flipped = False
-        st.session_state.fc_order = []
+        st.session_state.fc_perm = None
+        st.success("学習内容を保存しました。最初の画面に戻ります。")
+        time.sleep(1)
+        st.rerun()
+
+
+def _ensure_fc_order(data: list[dict]):
+    """フラッシュカードの出題順（周回ごとのシードから計算する並べ替え）を用意し、非表示のカードを読み飛ばす。"""
+    perm = st.session_state.get("fc_perm")
+    if perm is None or len(perm) > len(data):
+        st.session_state.fc_index = 0
+        st.session_state.fc_flipped = False
+        st.session_state.fc_round = st.session_state.get("fc_round", 0) + 1
+        st.session_state.fc_perm = _session_order(len(data), "fc", st.session_state.fc_round)
+    while (st.session_state.fc_index < len(data)
+           and data[_fc_data_index(st.session_state.fc_index)].get("hidden")):
+        st.session_state.fc_index += 1
+
+
+def _fc_data_index(position: int) -> int:
+    return _order_index(st.session_state.fc_perm, position)
+
+
+def flashcard_client_mode(data: list[dict]):
+    """ブラウザ内フラッシュカード。
+
+    サーバーは出題順の一部（ウィンドウ）を送るだけで、めくり・送りはブラウザ側で完結する。
+    結果は FC_BATCH_SIZE 件ごと、または残りが FC_PREFETCH 枚を切ったときにまとめて届く。
+    """
+    _ensure_fc_order(data)
+    component_key = "fc_deck_component"
+    # 非表示・表示に戻したとき (fc_rev) もブラウザ側のカードを作り直す
+    deck_id = (
+        f"{st.session_state.get('session_cache_key')}_{st.session_state.get('fc_round', 0)}"
+        f"_{st.session_state.get('fc_rev', 0)}"
+    )
+
+    # 前回の描画以降にブラウザから届いた結果を、ウィンドウを作る前に反映する
+    report = st.session_state.get(component_key)
+    last_seq = st.session_state.get("fc_last_seq", 0)
+    if report and report.get("deck_id") == deck_id and report.get("seq", 0) > last_seq:
+        st.session_state.fc_last_seq = report["seq"]
+        # 回答時刻はブラウザの時計ではなく「送信の何秒前か」から、サーバーの時刻で決める
+        now = time.time()
+        sent_at = report.get("sent_at") or 0
+        results = [
+            (r["front"], True, r.get("deck_url", ""),
+             now - max(0.0, (sent_at - r["answered_at"]) / 1000) if sent_at and r.get("answered_at") else None)
+            for r in report.get("results", []) if r.get("correct")
+        ]
+        if results:
+            add_history_records(results)
+            st.session_state._ls_counter += 1
+        st.session_state.fc_index = min(int(report.get("position", 0)), len(data))
+        _ensure_fc_order(data)
+        if report.get("hide"):
+            if save_hidden_to_sheet(report["hide"], report.get("hide_deck_url")):
+                st.toast("問題を非表示にしました", icon="🗑️")
+                st.rerun()
+
+    # 全問終了チェック
+    if st.session_state.fc_index >= len(data):
+        flush_history_to_sheets()
+        st.markdown(
+            '<div style="text-align:center; padding:40px 0;">'
+            '<h2>🎉 一通り学習しました！</h2>'
+            '</div>',
+            unsafe_allow_html=True
+        )
+        if st.button("🔄 最初からやり直す", use_container_width=True):
+            st.session_state.fc_perm = None  # 次の周回のシードで並べ直す（deck_id も変わる）
+            st.rerun()
+        return
+
+    # 現在位置から「送信間隔 + 先読み枚数」分だけ送る
+    start = st.session_state.fc_index
+    shown, visible = _session_progress(data, st.session_state.fc_perm, start)
+    cards = []
+    for position in range(start, min(len(data), start + FC_BATCH_SIZE + FC_PREFETCH * 2)):
+        item = data[_fc_data_index(position)]
+        if item.get("hidden"):
+            # 位置をずらさないよう枠だけ送り、ブラウザ側で読み飛ばす
+            cards.append({"skip": True})
+        else:
+            cards.append({"front": item["front"], "back": item["back"], "deck_url": item.get("deck_url", "")})
+    _flashcard_deck(
+        deck_id=deck_id,
+        cards=cards,
+        offset=start,
+        total=len(data),
+        shown=shown,
+        visible=visible,
+        prefetch=FC_PREFETCH,
+        batch_size=FC_BATCH_SIZE,
+        seq=st.session_state.get("fc_last_seq", 0),
+        key=component_key,
+        default=None,
+    )
+
+    # 中断して保存ボタン（ブラウザ側の未送信分は次の送信時に反映される）
+    st.divider()
+    if st.button("💾 中断して保存 (Save & Quit)", key="fc_client_save", use_container_width=True):
+        flush_history_to_sheets()
+        st.session_state.fc_index = 0
+        st.session_state.fc_flipped = False
+        st.session_state.fc_perm = None
         st.success("学習内容を保存しました。最初の画面に戻ります。")
         time.sleep(1)
         st.rerun()
 
 
+# ===================================================================
+# 近似重複カードの検出（MinHash + LSH）
+# ===================================================================
+# 表・裏を正規化した文字 3-gram の集合どうしの Jaccard 係数で「ほぼ同じ問題」を判定する。
+# 全ペアの比較（5万枚で12億組）はせず、MinHash 署名を帯に分けた LSH で候補だけを拾い、
+# 候補の組だけ署名の一致率（Jaccard 係数の推定値）で確かめる。
+# 64 個の署名を 4 行ずつ 16 帯に分けると、Jaccard 係数 s の組が候補に入る確率は 1 - (1 - s^4)^16 で、
+# s = 0.3 で約 12%、0.5 で約 64%、0.7 で約 98.8% になる。
+NEAR_DUPLICATE_SHINGLE = 3
+NEAR_DUPLICATE_PERMUTATIONS = 64
+NEAR_DUPLICATE_BANDS = 16
+NEAR_DUPLICATE_THRESHOLD = 0.7
+NEAR_DUPLICATE_BATCH = 1024  # 署名をまとめて計算するカード数（一時配列の大きさの上限）
+_MINHASH_RNG = np.random.default_rng(20240601)  # 署名はプロセスをまたいでも同じになるよう固定
+_MINHASH_A = _MINHASH_RNG.integers(0, 2**64, NEAR_DUPLICATE_PERMUTATIONS, dtype=np.uint64) | np.uint64(1)
+_MINHASH_B = _MINHASH_RNG.integers(0, 2**64, NEAR_DUPLICATE_PERMUTATIONS, dtype=np.uint64)
+
+
+def _near_duplicate_text(front: str, back: str) -> str:
+    """比較に使う文字列（空白・全角半角・大文字小文字の違いは無視）。短すぎる場合は n-gram 1つ分に埋める。"""
+    text = "".join(_search_normalize(front).split()) + "\0" + "".join(_search_normalize(back).split())
+    return text.ljust(NEAR_DUPLICATE_SHINGLE, "\0")
+
+
+def _minhash_signatures(texts: list[str]) -> np.ndarray:
+    """MinHash 署名（カード数 × NEAR_DUPLICATE_PERMUTATIONS）。
+
+    まとめたカードの文字コードを1本の配列にし、文字 n-gram のハッシュ値を位置ごとに一度に求める
+    （カードの境界をまたぐ n-gram は除く）。署名のハッシュ関数は剰余を使わない
+    multiply-shift（(a*x + b) mod 2^64 の上位 32bit）。
+    同じ n-gram が何度出ても最小値は変わらないので、集合にまとめる必要はない。
+    """
+    k = NEAR_DUPLICATE_SHINGLE
+    signatures = np.empty((len(texts), NEAR_DUPLICATE_PERMUTATIONS), dtype=np.uint32)
+    for start in range(0, len(texts), NEAR_DUPLICATE_BATCH):
+        batch = texts[start:start + NEAR_DUPLICATE_BATCH]
+        lengths = np.fromiter((len(t) for t in batch), dtype=np.int64, count=len(batch))
+        codes = np.frombuffer("".join(batch).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+        with np.errstate(over="ignore"):
+            hashes = np.zeros(len(codes) - k + 1, dtype=np.uint64)
+            for r in range(k):
+                hashes = hashes * np.uint64(0x9E3779B97F4A7C15) + codes[r:len(codes) - k + 1 + r]
+        # 各カードの中で始まり、カードの中で終わる n-gram だけを残す
+        ends = np.cumsum(lengths)
+        position = np.arange(len(hashes)) - np.repeat(ends - lengths, lengths)[:len(hashes)]
+        owner_length = np.repeat(lengths, lengths)[:len(hashes)]
+        x = hashes[position <= owner_length - k]
+        offsets = np.concatenate(([0], np.cumsum(lengths - k + 1)[:-1]))
+        with np.errstate(over="ignore"):
+            values = ((_MINHASH_A[:, None] * x[None, :] + _MINHASH_B[:, None]) >> np.uint64(32)).astype(np.uint32)
+        signatures[start:start + len(batch)] = np.minimum.reduceat(values, offsets, axis=1).T
+    return signatures
+
+
+def _lsh_band_keys(signatures: np.ndarray) -> np.ndarray:
+    """署名を帯ごとに1つの 64bit 値へまとめる（カード数 × NEAR_DUPLICATE_BANDS）。"""
+    rows = NEAR_DUPLICATE_PERMUTATIONS // NEAR_DUPLICATE_BANDS
+    bands = signatures.reshape(len(signatures), NEAR_DUPLICATE_BANDS, rows).astype(np.uint64)
+    keys = np.zeros((len(signatures), NEAR_DUPLICATE_BANDS), dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for r in range(rows):
+            keys = keys * np.uint64(1000003) + bands[:, :, r]
+    return keys
+
+
+class _UnionFind:
+    def __init__(self, n: int):
+        self.parent = list(range(n))
+
+    def find(self, i: int) -> int:
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, i: int, j: int):
+        ri, rj = self.find(i), self.find(j)
+        if ri != rj:
+            self.parent[max(ri, rj)] = min(ri, rj)
+
+
+class _NearDuplicateIndex:
+    """1デッキ分の MinHash 署名と、帯ごとに整列した LSH の表。"""
+
+    def __init__(self, items: list[dict]):
+        started = time.perf_counter()
+        self.items = items
+        self.signatures = _minhash_signatures([_near_duplicate_text(item["front"], item["back"]) for item in items])
+        keys = _lsh_band_keys(self.signatures)
+        self._order = np.argsort(keys, axis=0, kind="stable")
+        self._sorted_keys = np.take_along_axis(keys, self._order, axis=0)
+        self.build_seconds = time.perf_counter() - started
+
+    def _candidate_pairs(self) -> np.ndarray:
+        """同じ帯の値を持つカードの組（各バケットの先頭と残りを組にする）。"""
+        n = len(self.items)
+        codes = []
+        positions = np.arange(n)
+        for band in range(NEAR_DUPLICATE_BANDS):
+            keys = self._sorted_keys[:, band]
+            same = keys[1:] == keys[:-1]
+            if not same.any():
+                continue
+            heads = np.maximum.accumulate(np.where(np.concatenate(([True], ~same)), positions, 0))
+            members = np.flatnonzero(same) + 1
+            order = self._order[:, band]
+            i, j = order[heads[members]], order[members]
+            codes.append(np.minimum(i, j) * n + np.maximum(i, j))
+        if not codes:
+            return np.empty((0, 2), dtype=np.int64)
+        codes = np.unique(np.concatenate(codes))
+        return np.stack((codes // n, codes % n), axis=1)
+
+    def _similarity(self, i: np.ndarray, j: np.ndarray) -> np.ndarray:
+        """署名の一致率（Jaccard 係数の推定値）。"""
+        result = np.empty(len(i))
+        for start in range(0, len(i), NEAR_DUPLICATE_BATCH):
+            s = slice(start, start + NEAR_DUPLICATE_BATCH)
+            result[s] = (self.signatures[i[s]] == self.signatures[j[s]]).mean(axis=1)
+        return result
+
+    def clusters(self, threshold: float = NEAR_DUPLICATE_THRESHOLD) -> list[list[int]]:
+        """近似重複のまとまり（カードの位置のリスト）。大きいまとまりから順に返す。"""
+        pairs = self._candidate_pairs()
+        similar = pairs[self._similarity(pairs[:, 0], pairs[:, 1]) >= threshold]
+        groups = _UnionFind(len(self.items))
+        for i, j in similar.tolist():
+            groups.union(i, j)
+        clusters = {}
+        for i in np.unique(similar).tolist():
+            clusters.setdefault(groups.find(i), []).append(i)
+        return sorted(clusters.values(), key=lambda c: (-len(c), c[0]))
+
+    def similar(self, front: str, back: str,
+                threshold: float = NEAR_DUPLICATE_THRESHOLD) -> list[tuple[float, dict]]:
+        """新しいカードとよく似た既存カードを (類似度, 問題) の類似度順で返す。"""
+        if not self.items:
+            return []
+        signature = _minhash_signatures([_near_duplicate_text(front, back)])
+        keys = _lsh_band_keys(signature)[0]
+        candidates = set()
+        for band in range(NEAR_DUPLICATE_BANDS):
+            column = self._sorted_keys[:, band]
+            lo = np.searchsorted(column, keys[band], side="left")
+            hi = np.searchsorted(column, keys[band], side="right")
+            candidates.update(self._order[lo:hi, band].tolist())
+        if not candidates:
+            return []
+        candidates = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        scores = (self.signatures[candidates] == signature[0]).mean(axis=1)
+        hits = np.argsort(-scores, kind="stable")
+        return [(float(scores[h]), self.items[candidates[h]]) for h in hits if scores[h] >= threshold]
+
+
+class _NearDuplicateRegistry:
+    """デッキURLごとの近似重複インデックス（プロセス共有）。デッキが読み直されたら作り直す。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._indexes = {}
+
+    def get(self, url: str, items: list[dict]) -> _NearDuplicateIndex:
+        with self._lock:
+            index = self._indexes.get(url)
+        if index is None or index.items is not items:
+            index = _NearDuplicateIndex(items)
+            with self._lock:
+                self._indexes[url] = index
+        return index
+
+
+@st.cache_resource
+def _near_duplicate_indexes() -> _NearDuplicateRegistry:
+    return _NearDuplicateRegistry()
+
+
+def find_near_duplicates(items: list[dict], threshold: float = NEAR_DUPLICATE_THRESHOLD) -> list[list[dict]]:
+    """問題リストの中の近似重複のまとまり（各まとまりはデッキ内の並び順）。"""
+    index = _NearDuplicateIndex(items)
+    return [[items[i] for i in cluster] for cluster in index.clusters(threshold)]
+
+
+# ===================================================================
+# 履歴ストア (SQLite)
+# ===================================================================
+# 学習履歴の正本はサーバー上のSQLite。Google Sheets の "History" シートは
+# バックグラウンドで追記される書き出し先（バックアップ）として扱う。
+# 履歴はユーザー単位に分割され、シートもユーザーごとのタブ (History_<ユーザー>) に書き出す。
+# 保存期間 (history_retention_days) より古い行は単語ごとの集約行にまとめ、
+# 集約タブ (HistorySummary_<ユーザー>) へ移す。読み込みは「集約 + 直近の生履歴」になる。
+HISTORY_SHEET_HEADER = ["Timestamp", "Word", "Correct"]
+HISTORY_SUMMARY_HEADER = ["Word", "Attempts", "Corrects", "LastResult", "LastTimestamp", "CompactedThrough",
+                          "CompactedRows"]
+
+
+def current_user_id() -> str:
+    """現在の学習者のID。ログイン名があればそれを、なければブラウザ固有IDを使う。
+
+    どちらも分からない間（LocalStorage が使えない環境など）はセッション限りの "anon-" ID になる。
+    """
+    login = st.session_state.get("user_login", "").strip()
+    if login:
+        return login
+    browser_id = st.session_state.get("browser_id", "")
+    if browser_id:
+        return f"browser-{browser_id}"
+    if "anon_user_id" not in st.session_state:
+        st.session_state.anon_user_id = f"anon-{random.getrandbits(64):016x}"
+    return st.session_state.anon_user_id
+
+
+def is_anonymous_user(user_id: str) -> bool:
+    """セッション限りの学習者（と旧形式の ""）。履歴は SQLite だけに置き、シートには読み書きしない。"""
+    return not user_id or user_id.startswith("anon-")
+
+
+def history_sheet_name(user_id: str) -> str:
+    """ユーザーの履歴を書き出すタブ名（"" は旧形式の共有 "History" タブ。今は読み書きしない）。"""
+    if not user_id:
+        return "History"
+    safe = re.sub(r"[\[\]:*?/\\']", "_", user_id)
+    return f"History_{safe}"[:99]
+
+
+def history_summary_sheet_name(user_id: str) -> str:
+    """ユーザーの集約済み履歴のタブ名（未識別ユーザーは "HistorySummary"）。"""
+    if not user_id:
+        return "HistorySummary"
+    safe = re.sub(r"[\[\]:*?/\\']", "_", user_id)
+    return f"HistorySummary_{safe}"[:99]
+
+
+def _timestamp_to_epoch(ts: str) -> float:
+    try:
+        return datetime.fromisoformat(ts).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class _HistoryStore:
+    """学習履歴のSQLiteストア。
+
+    (デッキ, ユーザー, 時刻) と (デッキ, 単語, 時刻) のインデックスを持ち、
+    デッキ切り替え時の履歴読み込みはシート全体のダウンロードではなく索引検索になる。
+    replicated=0 の行が Sheets への書き出し待ち。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                deck_url TEXT NOT NULL,
+                user_id TEXT NOT NULL DEFAULT '',
+                word TEXT NOT NULL,
+                correct INTEGER NOT NULL,
+                timestamp TEXT NOT NULL,
+                epoch REAL NOT NULL,
+                replicated INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_history_user_time ON history(deck_url, user_id, epoch);
+            CREATE INDEX IF NOT EXISTS idx_history_word_time ON history(deck_url, word, epoch);
+            CREATE INDEX IF NOT EXISTS idx_history_unreplicated ON history(replicated) WHERE replicated = 0;
+            CREATE TABLE IF NOT EXISTS history_summary (
+                deck_url TEXT NOT NULL,
+                user_id TEXT NOT NULL DEFAULT '',
+                word TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                corrects INTEGER NOT NULL,
+                last_correct INTEGER NOT NULL,
+                last_timestamp TEXT NOT NULL,
+                last_epoch REAL NOT NULL,
+                PRIMARY KEY (deck_url, user_id, word)
+            );
+        """)
+        # 取り込み済みの印はユーザー単位（旧形式のテーブルは作り直す。取り込み時に重複は除外される）
+        columns = [r[1] for r in self._conn.execute("PRAGMA table_info(history_imports)")]
+        if columns and "user_id" not in columns:
+            self._conn.execute("DROP TABLE history_imports")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS history_imports (
+                deck_url TEXT NOT NULL,
+                user_id TEXT NOT NULL DEFAULT '',
+                imported_at REAL NOT NULL,
+                PRIMARY KEY (deck_url, user_id)
+            )
+        """)
+        self._conn.commit()
+
+    def add(self, records: list[dict], deck_url: str, user_id: str = "", replicated: bool = False):
+        rows = [
+            (deck_url, user_id, r["word"], int(bool(r["correct"])), r["timestamp"],
+             _timestamp_to_epoch(r["timestamp"]), int(replicated))
+            for r in records
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO history (deck_url, user_id, word, correct, timestamp, epoch, replicated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+
+    def query(self, deck_url: str, user_id: str = "", since: float | None = None) -> list[dict]:
+        """デッキ・ユーザーの履歴を古い順に返す（since 指定時はその時刻以降のみ）。"""
+        sql = "SELECT word, correct, timestamp FROM history WHERE deck_url = ? AND user_id = ?"
+        params = [deck_url, user_id]
+        if since is not None:
+            sql += " AND epoch >= ?"
+            params.append(since)
+        sql += " ORDER BY epoch, id"
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [{"word": w, "correct": bool(c), "timestamp": ts} for w, c, ts in rows]
+
+    def word_history(self, deck_url: str, word: str) -> list[dict]:
+        """1単語の全ユーザー分の履歴（単語インデックスを使用）。"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user_id, correct, timestamp FROM history "
+                "WHERE deck_url = ? AND word = ? ORDER BY epoch, id",
+                (deck_url, word),
+            ).fetchall()
+        return [{"user_id": u, "correct": bool(c), "timestamp": ts} for u, c, ts in rows]
+
+    def is_imported(self, deck_url: str, user_id: str = "") -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM history_imports WHERE deck_url = ? AND user_id = ?", (deck_url, user_id)
+            ).fetchone()
+        return row is not None
+
+    def mark_imported(self, deck_url: str, user_id: str = ""):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO history_imports (deck_url, user_id, imported_at) VALUES (?, ?, ?)",
+                (deck_url, user_id, time.time()),
+            )
+            self._conn.commit()
+
+    def clear(self, deck_url: str, user_id: str = "") -> int:
+        """デッキ・ユーザーの履歴と集約を消す。消した行数を返す。
+
+        取り込み済みの印は残す（シートの履歴を取り込み直して元に戻らないように）。
+        """
+        with self._lock:
+            deleted = self._conn.execute(
+                "DELETE FROM history WHERE deck_url = ? AND user_id = ?", (deck_url, user_id)
+            ).rowcount
+            self._conn.execute(
+                "DELETE FROM history_summary WHERE deck_url = ? AND user_id = ?", (deck_url, user_id)
+            )
+            self._conn.commit()
+        return deleted
+
+    def unreplicated(self, limit: int = 5000) -> list[tuple]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, deck_url, user_id, word, correct, timestamp FROM history "
+                "WHERE replicated = 0 ORDER BY id LIMIT ?",
+                (limit,),
+            ).fetchall()
+
+    def mark_replicated(self, ids: list[int]):
+        with self._lock:
+            self._conn.executemany("UPDATE history SET replicated = 1 WHERE id = ?", [(i,) for i in ids])
+            self._conn.commit()
+
+    def summaries(self, deck_url: str, user_id: str = "") -> dict[str, dict]:
+        """デッキ・ユーザーの集約済み履歴（単語 -> 回答数・正答数・最後の正誤と時刻）。"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT word, attempts, corrects, last_correct, last_timestamp FROM history_summary "
+                "WHERE deck_url = ? AND user_id = ?",
+                (deck_url, user_id),
+            ).fetchall()
+        return {
+            w: {"attempts": a, "corrects": c, "last_correct": bool(lc), "last_timestamp": ts}
+            for w, a, c, lc, ts in rows
+        }
+
+    def import_summaries(self, deck_url: str, user_id: str, summaries: dict[str, dict]):
+        """シートの集約タブを取り込む（既にある行は回答数の多い方を残す）。"""
+        rows = [
+            (deck_url, user_id, w, s["attempts"], s["corrects"], int(s["last_correct"]),
+             s["last_timestamp"], _timestamp_to_epoch(s["last_timestamp"]))
+            for w, s in summaries.items()
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO history_summary "
+                "(deck_url, user_id, word, attempts, corrects, last_correct, last_timestamp, last_epoch) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (deck_url, user_id, word) DO UPDATE SET "
+                "attempts = excluded.attempts, corrects = excluded.corrects, "
+                "last_correct = excluded.last_correct, last_timestamp = excluded.last_timestamp, "
+                "last_epoch = excluded.last_epoch "
+                "WHERE excluded.attempts > history_summary.attempts",
+                rows,
+            )
+            self._conn.commit()
+
+    def compact(self, before: float) -> int:
+        """before より古い書き出し済みの行を単語ごとの集約へまとめて削除する。まとめた件数を返す。
+
+        時刻を解釈できなかった行 (epoch=0) と Sheets 未書き出しの行は残す。
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, deck_url, user_id, word, correct, timestamp, epoch FROM history "
+                "WHERE epoch > 0 AND epoch < ? AND replicated = 1 ORDER BY epoch, id",
+                (before,),
+            ).fetchall()
+            if not rows:
+                return 0
+            merged = {}
+            for _id, url, user_id, word, correct, ts, epoch in rows:
+                acc = merged.setdefault((url, user_id, word), [0, 0, 0, "", 0.0])
+                acc[0] += 1
+                acc[1] += correct
+                acc[2], acc[3], acc[4] = correct, ts, epoch  # 古い順なので最後が最新
+            self._conn.executemany(
+                "INSERT INTO history_summary "
+                "(deck_url, user_id, word, attempts, corrects, last_correct, last_timestamp, last_epoch) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (deck_url, user_id, word) DO UPDATE SET "
+                "attempts = attempts + excluded.attempts, corrects = corrects + excluded.corrects, "
+                "last_correct = CASE WHEN excluded.last_epoch >= last_epoch THEN excluded.last_correct ELSE last_correct END, "
+                "last_timestamp = CASE WHEN excluded.last_epoch >= last_epoch THEN excluded.last_timestamp ELSE last_timestamp END, "
+                "last_epoch = MAX(last_epoch, excluded.last_epoch)",
+                [(*key, *acc) for key, acc in merged.items()],
+            )
+            self._conn.executemany("DELETE FROM history WHERE id = ?", [(r[0],) for r in rows])
+            self._conn.commit()
+        return len(rows)
+
+    def _iter_rows(self, sql: str, params: list, batch: int = 1000):
+        """読み取り専用の別接続で結果を batch 行ずつ返す（WAL なので書き込みを止めない）。"""
+        conn = sqlite3.connect(self.path)
+        try:
+            cursor = conn.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(batch)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            conn.close()
+
+    def iter_records(self, deck_url: str | None = None, user_id: str | None = None):
+        """履歴を1行ずつ古い順に返す（デッキ・ユーザーの指定がなければ全件）。"""
+        sql = "SELECT deck_url, user_id, timestamp, word, correct FROM history WHERE 1 = 1"
+        params = []
+        if deck_url is not None:
+            sql += " AND deck_url = ?"
+            params.append(deck_url)
+        if user_id is not None:
+            sql += " AND user_id = ?"
+            params.append(user_id)
+        for url, user, ts, word, correct in self._iter_rows(sql + " ORDER BY epoch, id", params):
+            yield {"deck_url": url, "user_id": user, "timestamp": ts, "word": word, "correct": bool(correct)}
+
+    def iter_summaries(self, deck_url: str | None = None, user_id: str | None = None):
+        """集約済み履歴を1行ずつ返す。"""
+        sql = ("SELECT deck_url, user_id, word, attempts, corrects, last_correct, last_timestamp "
+               "FROM history_summary WHERE 1 = 1")
+        params = []
+        if deck_url is not None:
+            sql += " AND deck_url = ?"
+            params.append(deck_url)
+        if user_id is not None:
+            sql += " AND user_id = ?"
+            params.append(user_id)
+        for url, user, word, attempts, corrects, last_correct, ts in self._iter_rows(sql, params):
+            yield {"deck_url": url, "user_id": user, "word": word, "attempts": attempts,
+                   "corrects": corrects, "last_correct": bool(last_correct), "last_timestamp": ts}
+
+    def card_counts(self, deck_url: str) -> list[tuple[str, str, int, int]]:
+        """デッキの全ユーザー分の (ユーザー, 単語, 回答数, 正解数)。集約済みの行も合算する。"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT user_id, word, SUM(attempts), SUM(corrects) FROM ("
+                "  SELECT user_id, word, COUNT(*) AS attempts, SUM(correct) AS corrects FROM history"
+                "  WHERE deck_url = ? GROUP BY user_id, word"
+                "  UNION ALL"
+                "  SELECT user_id, word, attempts, corrects FROM history_summary WHERE deck_url = ?"
+                ") GROUP BY user_id, word",
+                (deck_url, deck_url),
+            ).fetchall()
+
+    def partitions(self) -> list[tuple[str, str]]:
+        """履歴のある (デッキ, ユーザー) の一覧。"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT deck_url, user_id FROM history_imports "
+                "UNION SELECT DISTINCT deck_url, user_id FROM history"
+            ).fetchall()
+
+    def summary_counts(self) -> tuple[int, int]:
+        """(集約行数, 集約済みの回答数)"""
+        with self._lock:
+            words, attempts = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(attempts), 0) FROM history_summary"
+            ).fetchone()
+        return words, attempts
+
+    def counts(self) -> tuple[int, int]:
+        """(総件数, Sheets未書き出し件数)"""
+        with self._lock:
+            total = self._conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+            pending = self._conn.execute("SELECT COUNT(*) FROM history WHERE replicated = 0").fetchone()[0]
+        return total, pending
+
+
+@st.cache_resource
+def _history_store() -> _HistoryStore:
+    return _HistoryStore(st.secrets.get("history_db_path", "quiz_history.db"))
+
+
+class _HistoryReplicator:
+    """未書き出しの履歴を Google Sheets の History シートへ非同期に追記するスレッド。
+
+    retention_days > 0 なら compact_interval 秒に1回、保存期間より古い履歴を集約する。
+    """
+
+    def __init__(self, store: _HistoryStore, interval: float, retention_days: float = 0,
+                 compact_interval: float = 86400, start: bool = True):
+        self.store = store
+        self.interval = interval
+        self.retention_days = retention_days
+        self.compact_interval = compact_interval
+        self.last_error = None
+        self.last_synced_at = None
+        self.last_compacted_at = None
+        self.compacted_rows = 0
+        self.compact_error = None
+        self._wake = threading.Event()
+        self._clear_lock = threading.Lock()
+        self._pending_clears = set()  # 次の書き出しの前に空にする (デッキ, ユーザー)
+        if start:
+            # start=False はコマンドラインから replicate_pending / compact を直接呼ぶとき
+            threading.Thread(target=self._run, name="history-replicator", daemon=True).start()
+
+    def kick(self):
+        """すぐに書き出しを行うよう起こす。"""
+        self._wake.set()
+
+    def clear_remote(self, url: str, user_id: str):
+        """ユーザーの履歴タブと集約タブを書き出しスレッドで空にする（共有の "History" タブは消さない）。"""
+        if is_anonymous_user(user_id) or is_local_deck(url):
+            return
+        with self._clear_lock:
+            self._pending_clears.add((url, user_id))
+        self.kick()
+
+    def clear_pending(self):
+        with self._clear_lock:
+            clears, self._pending_clears = self._pending_clears, set()
+        for url, user_id in clears:
+            try:
+                with sheets_priority(SHEETS_PRIORITY_BACKGROUND):
+                    _clear_history_sheets(url, user_id)
+            except Exception as e:
+                self.last_error = f"{url}: {e}"
+                with self._clear_lock:
+                    self._pending_clears.add((url, user_id))
+
+    def _run(self):
+        while True:
+            self._wake.wait(timeout=self.interval)
+            self._wake.clear()
+            if GSPREAD_AVAILABLE:
+                self.clear_pending()
+            try:
+                self.replicate_pending()
+            except Exception as e:
+                self.last_error = str(e)
+            if self.retention_days > 0 and time.time() - (self.last_compacted_at or 0) >= self.compact_interval:
+                self.compact()
+
+    def replicate_pending(self):
+        with sheets_priority(SHEETS_PRIORITY_BACKGROUND):
+            self._replicate_pending()
+
+    def _replicate_pending(self):
+        rows = self.store.unreplicated()
+        # ローカルデッキには書き出し先のシートがなく、セッション限りの学習者はタブを作らないので、
+        # SQLite だけで完結させる
+        local_ids = [row[0] for row in rows if is_local_deck(row[1]) or is_anonymous_user(row[2])]
+        if local_ids:
+            self.store.mark_replicated(local_ids)
+            rows = [row for row in rows if not (is_local_deck(row[1]) or is_anonymous_user(row[2]))]
+        if not rows or not GSPREAD_AVAILABLE:
+            return
+        by_partition = {}
+        for row in rows:
+            by_partition.setdefault((row[1], row[2]), []).append(row)
+        errors = []
+        for (url, user_id), deck_rows in by_partition.items():
+            try:
+                sh = _open_spreadsheet(url, "replicate_pending")
+                sheet_name = history_sheet_name(user_id)
+                try:
+                    worksheet = sheets_read("replicate_pending", sh.worksheet, sheet_name)
+                except gspread.WorksheetNotFound:
+                    worksheet = sheets_write("replicate_pending", sh.add_worksheet, title=sheet_name, rows=1000, cols=3)
+                    sheets_write("replicate_pending", worksheet.append_row, HISTORY_SHEET_HEADER)
+                sheets_write("replicate_pending", worksheet.append_rows, [
+                    [ts, word, "Correct" if correct else "Wrong"]
+                    for _id, _url, _user, word, correct, ts in deck_rows
+                ])
+                self.store.mark_replicated([r[0] for r in deck_rows])
+            except Exception as e:
+                # 失敗したデッキ分は replicated=0 のまま残り、次回に再送される
+                errors.append(f"{url}: {e}")
+        self.last_error = "; ".join(errors) or None
+        self.last_synced_at = time.time()
+
+    def compact(self):
+        """SQLite と各ユーザーの History タブで、保存期間より古い行を集約する。
+
+        書き出しと同じスレッドで動くので、集約中にこのサーバーからの追記が割り込むことはない。
+        """
+        cutoff = time.time() - self.retention_days * 86400
+        errors = []
+        if GSPREAD_AVAILABLE:
+            for url, user_id in self.store.partitions():
+                if is_local_deck(url) or is_anonymous_user(user_id):
+                    continue
+                try:
+                    with sheets_priority(SHEETS_PRIORITY_BACKGROUND):
+                        _compact_history_sheet(url, user_id, cutoff)
+                except Exception as e:
+                    errors.append(f"{url}: {e}")
+        try:
+            self.compacted_rows += self.store.compact(cutoff)
+        except Exception as e:
+            errors.append(str(e))
+        self.compact_error = "; ".join(errors) or None
+        self.last_compacted_at = time.time()
+
+
+@st.cache_resource
+def _history_replicator() -> _HistoryReplicator:
+    return _HistoryReplicator(
+        _history_store(),
+        float(st.secrets.get("history_sync_interval", 60)),
+        retention_days=float(st.secrets.get("history_retention_days", 0)),
+        compact_interval=float(st.secrets.get("history_compact_interval", 86400)),
+    )
+
+
+def _clear_history_sheets(url: str, user_id: str):
+    """ユーザーの History タブを見出しだけにし、集約タブを空にする。"""
+    sh = _open_spreadsheet(url, "_clear_history_sheets")
+    for sheet_name in (history_sheet_name(user_id), history_summary_sheet_name(user_id)):
+        try:
+            worksheet = sheets_read("_clear_history_sheets", sh.worksheet, sheet_name)
+        except gspread.WorksheetNotFound:
+            continue
+        sheets_write("_clear_history_sheets", worksheet.clear)
+        if sheet_name == history_sheet_name(user_id):
+            sheets_write("_clear_history_sheets", worksheet.append_row, HISTORY_SHEET_HEADER)
+
+
+def clear_learning_history():
+    """現在の学習者の、読み込み中のデッキの履歴を消す（画面・SQLite・ユーザー別のシート）。
+
+    LocalStorage は呼び出し側で消す。
+    """
+    user_id = current_user_id()
+    urls = st.session_state.get("active_deck_urls") or [
+        st.session_state.get("current_deck_url") or st.secrets.get("spreadsheet_url", "")
+    ]
+    store = _history_store()
+    replicator = _history_replicator()
+    for url in urls:
+        if url:
+            store.clear(url, user_id)
+            replicator.clear_remote(url, user_id)
+    st.session_state.history = []
+    st.session_state.history_summary = {}
+    st.session_state.history_version = st.session_state.get("history_version", 0) + 1
+
+
+def _read_history_summary_sheet(url: str, user_id: str = "") -> tuple[dict[str, dict], str]:
+    """集約タブを読み込む。(単語 -> 集約, 直前に集約した生履歴の印) を返す（タブが無ければ空）。"""
+    try:
+        sh = _open_spreadsheet(url, "_read_history_summary_sheet")
+        worksheet = sheets_read("_read_history_summary_sheet", sh.worksheet, history_summary_sheet_name(user_id))
+        rows = sheets_read("_read_history_summary_sheet", worksheet.get_all_values)
+    except gspread.WorksheetNotFound:
+        return {}, ""
+    return _parse_history_summary_rows(rows)
+
+
+def _parse_history_summary_rows(rows: list[list[str]]) -> tuple[dict[str, dict], str]:
+    """集約タブの全行（見出し込み）を (単語 -> 集約, 直前に集約した生履歴の印) にする。"""
+    summaries = {}
+    compacted_rows = ""
+    for r in rows[1:]:
+        if len(r) < 5 or not r[0]:
+            continue
+        try:
+            attempts, corrects = int(r[1]), int(r[2])
+        except ValueError:
+            continue
+        summaries[r[0]] = {
+            "attempts": attempts,
+            "corrects": corrects,
+            "last_correct": r[3] == "Correct",
+            "last_timestamp": r[4],
+        }
+        if len(r) >= 7 and r[6]:
+            compacted_rows = r[6]
+    return summaries, compacted_rows
+
+
+def _history_rows_mark(rows: list[list[str]]) -> str:
+    """集約した生履歴の行の印（"行数:ハッシュ"）。削除前に中断した行を見分けるのに使う。"""
+    digest = hashlib.sha1(json.dumps([r[:3] for r in rows], ensure_ascii=False).encode("utf-8")).hexdigest()
+    return f"{len(rows)}:{digest[:16]}"
+
+
+def _compact_history_sheet(url: str, user_id: str, cutoff: float) -> int:
+    """History タブの先頭から続く cutoff より古い行を集約タブへまとめ、その行を削除する。
+
+    History タブは追記のみなので古い行は先頭に並ぶ。先頭の連続部分だけを消すので、
+    集約中に他のサーバーが末尾へ追記した行は失われない。
+    先頭の行が前回集約した行そのもの（集約後・削除前に中断した分）なら数えずに消す。
+    それ以外の古い行は、他のサーバーから遅れて書き出された行も含めて集約へ足し込む。
+    """
+    sh = _open_spreadsheet(url, "_compact_history_sheet")
+    try:
+        worksheet = sheets_read("_compact_history_sheet", sh.worksheet, history_sheet_name(user_id))
+    except gspread.WorksheetNotFound:
+        return 0
+    rows = sheets_read("_compact_history_sheet", worksheet.get_all_values)[1:]
+    old_count = 0
+    for r in rows:
+        epoch = _timestamp_to_epoch(r[0]) if r else 0.0
+        if not epoch or epoch >= cutoff:
+            break
+        old_count += 1
+    if not old_count:
+        return 0
+
+    sheet_name = history_summary_sheet_name(user_id)
+    try:
+        summary_ws = sheets_read("_compact_history_sheet", sh.worksheet, sheet_name)
+        summary_values = sheets_read("_compact_history_sheet", summary_ws.get_all_values)
+    except gspread.WorksheetNotFound:
+        summary_ws, summary_values = None, []
+    summaries, compacted_rows = _parse_history_summary_rows(summary_values)
+    already = 0
+    count_text = compacted_rows.split(":", 1)[0]
+    if count_text.isdigit() and int(count_text) <= old_count:
+        if _history_rows_mark(rows[:int(count_text)]) == compacted_rows:
+            already = int(count_text)
+    for r in rows[already:old_count]:
+        if len(r) < 3:
+            continue
+        correct = r[2] == "Correct"
+        s = summaries.setdefault(r[1], {"attempts": 0, "corrects": 0, "last_correct": correct, "last_timestamp": ""})
+        s["attempts"] += 1
+        s["corrects"] += int(correct)
+        if r[0] >= s["last_timestamp"]:
+            s["last_correct"], s["last_timestamp"] = correct, r[0]
+
+    through = datetime.fromtimestamp(cutoff, timezone(timedelta(hours=9))).isoformat()
+    mark = _history_rows_mark(rows[:old_count])
+    summary_rows = [HISTORY_SUMMARY_HEADER] + [
+        [w, s["attempts"], s["corrects"], "Correct" if s["last_correct"] else "Wrong", s["last_timestamp"], through,
+         mark]
+        for w, s in sorted(summaries.items())
+    ]
+    if summary_ws is None:
+        summary_ws = sheets_write("_compact_history_sheet", sh.add_worksheet, title=sheet_name,
+                                  rows=len(summary_rows) + 100, cols=len(HISTORY_SUMMARY_HEADER))
+    elif summary_ws.col_count < len(HISTORY_SUMMARY_HEADER):
+        # 列を足す前に作った集約タブは広げておく（グリッド外への書き込みはエラーになる）
+        sheets_write("_compact_history_sheet", summary_ws.add_cols, len(HISTORY_SUMMARY_HEADER) - summary_ws.col_count)
+    # 消してから書くと書き込み失敗で集約が失われるので、上書きしてから余った末尾の行を消す
+    sheets_write("_compact_history_sheet", summary_ws.update, summary_rows, "A1")
+    if len(summary_values) > len(summary_rows):
+        sheets_write("_compact_history_sheet", summary_ws.delete_rows, len(summary_rows) + 1, len(summary_values))
+    # 集約を書き終えてから生履歴を消す（途中で失敗しても二重計上にはならない）
+    sheets_write("_compact_history_sheet", worksheet.delete_rows, 2, old_count + 1)
+    return old_count
+
+
+def import_history_from_sheets_once(url: str, user_id: str = ""):
+    """ユーザーの履歴タブを初回だけSQLiteへ取り込む（以後は索引検索のみ）。
+
+    読むのはそのユーザーのタブだけなので、取り込み量はチーム全体ではなく本人の学習量に比例する。
+    """
+    store = _history_store()
+    if store.is_imported(url, user_id):
+        return
+    if is_local_deck(url) or is_anonymous_user(user_id):
+        # ローカルデッキの履歴は SQLite のみ（取り込むシートがない）。
+        # 共有の "History" タブは誰の履歴か区別できないので取り込まない
+        store.mark_imported(url, user_id)
+        return
+    try:
+        records = _read_history_sheet(url, history_sheet_name(user_id))
+    except gspread.WorksheetNotFound:
+        records = []
+    # 集約済みの古い履歴は単語ごとの行として取り込む
+    summaries, _compacted_rows = _read_history_summary_sheet(url, user_id)
+    if summaries:
+        store.import_summaries(url, user_id, summaries)
+    # 取り込み前にこのサーバーで記録済みの行（シートへ書き出し済み）は除く
+    existing = {(r["timestamp"], r["word"]) for r in store.query(url, user_id)}
+    records = [r for r in records if (r["timestamp"], r["word"]) not in existing]
+    # 取り込んだ行は既にシートにあるので書き出し済みとして登録する
+    if records:
+        store.add(records, url, user_id, replicated=True)
+    store.mark_imported(url, user_id)
+
+
+def load_history_from_store(url: str | None = None, user_id: str | None = None) -> list[dict]:
+    """SQLiteから現在のユーザーのデッキ履歴を読み込む（未取り込みなら先にシートから取り込む）。"""
+    url = url or st.session_state.get("current_deck_url") or st.secrets.get("spreadsheet_url")
+    if not url:
+        return []
+    if user_id is None:
+        user_id = current_user_id()
+    try:
+        return _query_store_history(url, user_id)
+    except Exception as e:
+        st.warning(f"学習履歴を読み込めませんでした ({url}): {e}")
+        return []
+
+
+def _query_store_history(url: str, user_id: str) -> list[dict]:
+    """load_history_from_store の本体（例外は呼び出し側へ。画面を持たないスレッドからも呼べる）。"""
+    if GSPREAD_AVAILABLE:
+        import_history_from_sheets_once(url, user_id)
+    return _history_store().query(url, user_id)
+
+
+def load_history_summary_from_store(url: str | None = None, user_id: str | None = None) -> dict[str, dict]:
+    """SQLiteから現在のユーザーの集約済み履歴（保存期間より古い分）を読み込む。"""
+    url = url or st.session_state.get("current_deck_url") or st.secrets.get("spreadsheet_url")
+    if not url:
+        return {}
+    if user_id is None:
+        user_id = current_user_id()
+    try:
+        return _history_store().summaries(url, user_id)
+    except Exception as e:
+        st.warning(f"集約済みの学習履歴を読み込めませんでした ({url}): {e}")
+        return {}
+
+
+def _merge_history_summaries(parts: list[dict[str, dict]]) -> dict[str, dict]:
+    """複数デッキの集約を単語ごとに合算する（最後の正誤は新しい方）。"""
+    merged = {}
+    for part in parts:
+        for word, s in part.items():
+            acc = merged.get(word)
+            if acc is None:
+                merged[word] = dict(s)
+                continue
+            acc["attempts"] += s["attempts"]
+            acc["corrects"] += s["corrects"]
+            if s["last_timestamp"] > acc["last_timestamp"]:
+                acc["last_correct"], acc["last_timestamp"] = s["last_correct"], s["last_timestamp"]
+    return merged
+
+
 # ===================================================================
 # LocalStorage ヘルパー
 # ===================================================================
 LS_KEY = "quiz_app_history"
+LS_BROWSER_ID_KEY = "quiz_app_browser_id"
+
+
+def _ls_history_key() -> str:
+    """ログイン中はユーザーごとのキーに保存し、共有ブラウザで履歴が混ざらないようにする。"""
+    login = st.session_state.get("user_login", "").strip()
+    return f"{LS_KEY}:{login}" if login else LS_KEY
+
+
+def _read_history_sheet(url: str, sheet_name: str = "History") -> list[dict]:
+    """履歴シートの全行を読み込む（例外は呼び出し側へ）。"""
+    sh = _open_spreadsheet(url, "_read_history_sheet")
+    worksheet = sheets_read("_read_history_sheet", sh.worksheet, sheet_name)
+    rows = sheets_read("_read_history_sheet", worksheet.get_all_values)
+
+    if not rows or len(rows) < 2:
+        return []
 
+    # ヘッダー除去
+    data_rows = rows[1:]
+    history = []
+    for r in data_rows:
+        if len(r) >= 3:
+            history.append({
+                "timestamp": r[0],
+                "word": r[1],
+                "correct": (r[2] == "Correct")
+            })
+    return history
 
-def load_history_from_sheets() -> list[dict]:
+
+def load_history_from_sheets(url: str | None = None) -> list[dict]:
     """スプレッドシートの 'History' シートから履歴を読み込む。"""
     try:
-        url = st.session_state.get("current_deck_url") or st.secrets.get("spreadsheet_url")
+        url = url or st.session_state.get("current_deck_url") or st.secrets.get("spreadsheet_url")
         if not url:
             return []
-            
-        scope = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
-        creds_dict = dict(st.secrets["gcp_service_account"])
-        creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
-        client = gspread.authorize(creds)
-        sh = client.open_by_url(url)
-        worksheet = sh.worksheet("History")
-        rows = worksheet.get_all_values()
-        
-        if not rows or len(rows) < 2:
-            return []
-            
-        # ヘッダー除去
-        data_rows = rows[1:]
-        history = []
-        for r in data_rows:
-            if len(r) >= 3:
-                history.append({
-                    "timestamp": r[0],
-                    "word": r[1],
-                    "correct": (r[2] == "Correct")
-                })
-        return history
+        return _read_history_sheet(url)
     except Exception:
         return []
 
 def load_history_from_ls() -> list[dict]:
-    """LocalStorage から学習履歴を読み込む。"""
+    """LocalStorage から学習履歴とブラウザ固有ID（無ければ発行）を読み込む。"""
     if not JS_EVAL_AVAILABLE:
         return None  # JSが使えない場合はNoneを返す（ロード未完了扱い）
     try:
         raw = streamlit_js_eval(
-            js_expressions=f"localStorage.getItem('{LS_KEY}')",
+            js_expressions=(
+                "(() => {"
+                f"let id = localStorage.getItem('{LS_BROWSER_ID_KEY}');"
+                "if (!id) {"
+                "id = (window.crypto && crypto.randomUUID) ? crypto.randomUUID()"
+                " : Date.now().toString(36) + Math.random().toString(36).slice(2);"
+                f"localStorage.setItem('{LS_BROWSER_ID_KEY}', id);"
+                "}"
+                f"return JSON.stringify({{browser_id: id, history: localStorage.getItem('{_ls_history_key()}')}});"
+                "})()"
+            ),
             key=f"ls_load_{st.session_state.get('_ls_counter', 0)}",
         )
         if raw and isinstance(raw, str):
-            return json.loads(raw)
+            payload = json.loads(raw)
+            st.session_state.browser_id = payload.get("browser_id") or ""
+            return json.loads(payload["history"]) if payload.get("history") else []
         if raw is None:
              return None # まだロードできていない
     except Exception:
@@ -563,200 +2304,857 @@ def save_history_to_ls(history: list[dict]):
         # エスケープ処理
         escaped = data_json.replace("\\", "\\\\").replace("'", "\\'")
         streamlit_js_eval(
-            js_expressions=f"localStorage.setItem('{LS_KEY}', '{escaped}')",
+            js_expressions=f"localStorage.setItem('{_ls_history_key()}', '{escaped}')",
             key=f"ls_save_{st.session_state.get('_ls_counter', 0)}",
         )
     except Exception:
         pass
 
 
-def add_history_record(word: str, correct: bool):
+def add_history_record(word: str, correct: bool, deck_url: str = ""):
     """履歴レコードを追加して保存（LocalStorage + Google Sheets）。"""
+    add_history_records([(word, correct, deck_url)])
+
+
+def add_history_records(results: list[tuple]):
+    """複数の履歴レコードをまとめて追加する（LocalStorageへの書き込みは1回）。
+
+    各要素は (単語, 正誤, デッキURL) か (単語, 正誤, デッキURL, 回答した時刻のUNIX秒)。
+    デッキURLが空なら現在のデッキに記録する。時刻を省くと今の時刻になる。
+    記録はまずSQLiteに保存し、Sheets へは _HistoryReplicator が非同期に書き出す。
+    """
     jst = timezone(timedelta(hours=9))
-    timestamp = datetime.now(jst).isoformat()
-    record = {
-        "word": word,
-        "correct": correct,
-        "timestamp": timestamp,
-    }
+    now = time.time()
     if "history" not in st.session_state:
         st.session_state.history = []
-    st.session_state.history.append(record)
-    
+    default_url = st.session_state.get("current_deck_url") or st.secrets.get("spreadsheet_url")
+
+    by_url = {}
+    for word, correct, deck_url, *answered_at in results:
+        epoch = min(answered_at[0], now) if answered_at and answered_at[0] else now
+        record = {
+            "word": word,
+            "correct": correct,
+            "timestamp": datetime.fromtimestamp(epoch, jst).isoformat(),
+        }
+        if deck_url:
+            record["deck_url"] = deck_url
+        st.session_state.history.append(record)
+        url = deck_url or default_url
+        if url:
+            by_url.setdefault(url, []).append(record)
+
     # LocalStorage保存
     save_history_to_ls(st.session_state.history)
-    
-    # Google Sheets保存 (バッチ処理に変更: 10件ごとに flush)
-    if "pending_history" not in st.session_state:
-        st.session_state.pending_history = []
-    
-    st.session_state.pending_history.append(record)
-    
-    if len(st.session_state.pending_history) >= 10:
+
+    # 直近の正誤マップも更新（get_word_status 用）
+    _word_status_map()
+    for word, correct, *_rest in results:
+        st.session_state.word_status[word] = "correct" if correct else "wrong"
+    st.session_state.word_status_source = (
+        len(st.session_state.history), id(st.session_state.setdefault("history_summary", {}))
+    )
+
+    # SQLite保存（正本・ユーザー単位）
+    try:
+        store = _history_store()
+        user_id = current_user_id()
+        for url, records in by_url.items():
+            store.add(records, url, user_id)
+    except Exception as e:
+        st.error(f"学習履歴の保存に失敗しました: {e}")
+        return
+
+    # Google Sheets への書き出し (バッチ処理: 10件ごとに flush)
+    st.session_state.unsynced_count = st.session_state.get("unsynced_count", 0) + len(results)
+    if st.session_state.unsynced_count >= 10:
         flush_history_to_sheets()
 
 def flush_history_to_sheets():
-    """保留中の履歴をスプレッドシートに一括保存する。"""
+    """SQLiteに溜まった未書き出しの履歴をスプレッドシートへ送るよう依頼する（非同期）。"""
     try:
-        pending = st.session_state.get("pending_history", [])
-        if not pending:
-            return
-
-        url = st.session_state.get("current_deck_url") or st.secrets.get("spreadsheet_url")
-        if not url:
-            return
-            
-        scope = [
-            'https://www.googleapis.com/auth/spreadsheets',
-            'https://www.googleapis.com/auth/drive'
-        ]
-        creds_dict = dict(st.secrets["gcp_service_account"])
-        creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
-        client = gspread.authorize(creds)
-        
-        sh = client.open_by_url(url)
-        
-        # Historyシートの取得または作成
-        try:
-            worksheet = sh.worksheet("History")
-        except gspread.WorksheetNotFound:
-            worksheet = sh.add_worksheet(title="History", rows=1000, cols=3)
-            worksheet.append_row(["Timestamp", "Word", "Correct"])
-            
-        # 一括追記
-        rows_to_add = []
-        for r in pending:
-            rows_to_add.append([
-                r["timestamp"],
-                r["word"],
-                "Correct" if r["correct"] else "Wrong"
-            ])
-        
-        if rows_to_add:
-            worksheet.append_rows(rows_to_add)
-            
-        # クリア
-        st.session_state.pending_history = []
-        st.toast("学習履歴を保存しました！", icon="✅")
-        
+        _history_replicator().kick()
+        st.session_state.unsynced_count = 0
     except Exception as e:
         st.error(f"スプレッドシートへの保存に失敗しました: {e}")
 
 
-def save_notes_to_sheet(front: str, notes: str):
-    """7列目（メモ/参考URL）をスプレッドシートに保存する。"""
-    try:
-        url = st.session_state.get("current_deck_url") or st.secrets.get("spreadsheet_url")
-        if not url:
-            return False
-        scope = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
-        creds_dict = dict(st.secrets["gcp_service_account"])
-        creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
-        client = gspread.authorize(creds)
-        sh = client.open_by_url(url)
-        worksheet = sh.sheet1
-        # 対象行を検索
-        cell = worksheet.find(front, in_column=1)
-        if cell:
-            worksheet.update_cell(cell.row, 7, notes)
-            # キャッシュクリア（シートデータキャッシュとセッションデータキャッシュの両方）
-            st.cache_data.clear()
-            # st.session_state.pop(key, None) # 停止：クイズ状態維持のため
-            return True
-        return False
-    except Exception as e:
-        if "403" in str(e):
-            client_email = st.secrets.get("gcp_service_account", {}).get("client_email", "不明")
-            st.error(f"⚠️ スプレッドシートの権限エラー (403)\n\nこの機能を使うには、スプレッドシートの画面右上の「共有」ボタンから、以下のメールアドレスを「編集者」として追加してください：\n\n`{client_email}`")
-        else:
-            st.error(f"メモの保存に失敗しました: {e}")
-        return False
+# ===================================================================
+# カードのセル編集（解説・メモ・非表示）のまとめ書き
+# ===================================================================
+CARD_COLUMN_FIELDS = {6: "explanation", 7: "notes", 8: "hidden"}
 
 
-def save_explanation_to_sheet(front: str, explanation: str):
-    """6列目（解説）をスプレッドシートに追記する。"""
-    try:
-        url = st.session_state.get("current_deck_url") or st.secrets.get("spreadsheet_url")
-        if not url:
-            return False
-        scope = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
-        creds_dict = dict(st.secrets["gcp_service_account"])
-        creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
-        client = gspread.authorize(creds)
-        sh = client.open_by_url(url)
-        worksheet = sh.sheet1
-        cell = worksheet.find(front, in_column=1)
-        if cell:
-            existing = worksheet.cell(cell.row, 6).value or ""
-            new_val = (existing + "\n" + explanation).strip() if existing else explanation
-            worksheet.update_cell(cell.row, 6, new_val)
-            # キャッシュクリア（シートデータキャッシュとセッションデータキャッシュの両方）
-            st.cache_data.clear()
-            # st.session_state.pop(key, None) # 停止：クイズ状態維持のため
-            return True
-        return False
-    except Exception as e:
-        if "403" in str(e):
-            client_email = st.secrets.get("gcp_service_account", {}).get("client_email", "不明")
-            st.error(f"⚠️ スプレッドシートの権限エラー (403)\n\nこの機能を使うには、スプレッドシートの画面右上の「共有」ボタンから、以下のメールアドレスを「編集者」として追加してください：\n\n`{client_email}`")
-        else:
-            st.error(f"解説の保存に失敗しました: {e}")
-        return False
+def _combine_cell_edit(old: tuple[str, str] | None, new: tuple[str, str]) -> tuple[str, str]:
+    """同じセルへの編集 (mode, value) を1つにまとめる。mode は "set"（上書き）か "append"（追記）。"""
+    mode, value = new
+    if old is None or mode == "set":
+        return new
+    old_mode, old_value = old
+    return old_mode, (old_value + "\n" + value).strip() if old_value else value
 
 
-def save_hidden_to_sheet(front: str):
-    """8列目（非表示フラグ）をスプレッドシートに保存する。"""
-    try:
-        url = st.session_state.get("current_deck_url") or st.secrets.get("spreadsheet_url")
-        if not url:
-            return False
-        scope = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
-        creds_dict = dict(st.secrets["gcp_service_account"])
-        creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
-        client = gspread.authorize(creds)
-        sh = client.open_by_url(url)
-        worksheet = sh.sheet1
-        # 対象行を検索
-        cell = worksheet.find(front, in_column=1)
-        if cell:
-            worksheet.update_cell(cell.row, 8, "TRUE")
-            # キャッシュクリア（データの再読み込みを強制）
-            st.cache_data.clear()
-            if "session_cache_key" in st.session_state:
-                del st.session_state.session_cache_key
-            return True
+def _apply_cell_edit(item: dict, column: int, mode: str, value: str):
+    """問題 dict にセル編集を反映する（シートの読み込み結果と同じ形にする）。"""
+    field = CARD_COLUMN_FIELDS[column]
+    if field == "hidden":
+        item["hidden"] = value.strip().lower() in ("true", "1", "hidden", "非表示")
+    elif mode == "append" and item.get(field):
+        item[field] = (item[field] + "\n" + value).strip()
+    else:
+        item[field] = value
+
+
+class _SheetEditBuffer:
+    """カードのセル編集をデッキ単位で溜め、window 秒ごとに1回の batch_update で書き込むスレッド。
+
+    同じセルへの編集はまとめてから送る。書き込みまでの間にデッキを読み直しても
+    apply_pending で未送信の編集を重ねるので、編集した内容が巻き戻って見えることはない。
+    """
+
+    def __init__(self, window: float, max_attempts: int = 3):
+        self.window = window
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._pending = {}   # url -> {(front, column): (mode, value)}
+        self._inflight = {}  # url -> 書き込み中の編集
+        self._attempts = {}  # url -> 連続失敗回数
+        self._wake = threading.Event()
+        self.edits = 0
+        self.coalesced = 0
+        self.batches = 0
+        self._errors = {}    # url -> 直近のエラー
+        threading.Thread(target=self._run, name="sheet-edit-writer", daemon=True).start()
+
+    def errors(self) -> dict[str, str]:
+        """デッキごとの直近の書き込みエラー（写し）。"""
+        with self._lock:
+            return dict(self._errors)
+
+    def add(self, url: str, front: str, column: int, value: str, append: bool = False):
+        self.add_many(url, [front], column, value, append)
+
+    def add_many(self, url: str, fronts: list[str], column: int, value: str, append: bool = False):
+        """複数の問題の同じ列に同じ値を書く編集を、1回でまとめて積む。"""
+        edit = ("append" if append else "set", value)
+        with self._lock:
+            edits = self._pending.setdefault(url, {})
+            for front in fronts:
+                key = (front, column)
+                self.edits += 1
+                if key in edits:
+                    self.coalesced += 1
+                edits[key] = _combine_cell_edit(edits.get(key), edit)
+        self._wake.set()
+
+    def apply_pending(self, url: str, items: list[dict]) -> list[dict]:
+        """読み込んだデッキに、まだシートへ届いていない編集を重ねて返す。"""
+        with self._lock:
+            edits = dict(self._inflight.get(url, {}))
+            for key, edit in self._pending.get(url, {}).items():
+                edits[key] = _combine_cell_edit(edits.get(key), edit)
+        if edits:
+            by_front = {}
+            for item in items:
+                by_front.setdefault(item["front"], item)
+            for (front, column), (mode, value) in edits.items():
+                if front in by_front:
+                    _apply_cell_edit(by_front[front], column, mode, value)
+        return items
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return sum(len(e) for e in self._pending.values()) + sum(len(e) for e in self._inflight.values())
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            # 窓の間に届いた編集もまとめて送る
+            time.sleep(self.window)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            self._inflight = batch
+        dropped = []
+        for url, edits in batch.items():
+            try:
+                self._write(url, edits)
+            except Exception as e:
+                with self._lock:
+                    self._errors[url] = str(e)
+                    attempts = self._attempts.get(url, 0) + 1
+                    if attempts < self.max_attempts:
+                        # 失敗分は後から来た編集の前に戻して次の窓で再送する
+                        self._attempts[url] = attempts
+                        pending = self._pending.setdefault(url, {})
+                        merged = dict(edits)
+                        for key, edit in pending.items():
+                            merged[key] = _combine_cell_edit(merged.get(key), edit)
+                        self._pending[url] = merged
+                        self._wake.set()
+                    else:
+                        self._attempts.pop(url, None)
+                        dropped.append(url)
+            else:
+                with self._lock:
+                    self._errors.pop(url, None)
+                    self._attempts.pop(url, None)
+        with self._lock:
+            self._inflight = {}
+        # 諦めた編集はキャッシュ上のデッキにだけ残っているので、シートから読み直させる
+        for url in dropped:
+            clear_deck_cache(url)
+
+    def _write(self, url: str, edits: dict):
+        with sheets_priority(SHEETS_PRIORITY_EDIT):
+            write_cell_edits(url, edits)
+        self.batches += 1
+
+
+def write_cell_edits(url: str, edits: dict[tuple[str, int], tuple[str, str]]) -> int:
+    """1デッキ分の編集を書き込む（A列の読み取り1回 + 追記用の列読み取り + batch_update 1回）。
+
+    書き込んだセル数を返す（表面がシートに見つからない編集は飛ばす）。
+    """
+    worksheet = sheets_read("write_cell_edits", _open_spreadsheet(url, "write_cell_edits").get_worksheet, 0)
+    rows = {}
+    for i, value in enumerate(sheets_read("write_cell_edits", worksheet.col_values, 1), start=1):
+        rows.setdefault(value.strip(), i)
+    append_columns = {column: sheets_read("write_cell_edits", worksheet.col_values, column)
+                      for (_front, column), (mode, _value) in edits.items() if mode == "append"}
+    updates = []
+    for (front, column), (mode, value) in edits.items():
+        row = rows.get(front)
+        if row is None:
+            continue
+        if mode == "append":
+            existing = append_columns[column][row - 1] if row <= len(append_columns[column]) else ""
+            value = (existing + "\n" + value).strip() if existing else value
+        updates.append({"range": gspread.utils.rowcol_to_a1(row, column), "values": [[value]]})
+    if updates:
+        sheets_write("write_cell_edits", worksheet.batch_update, updates)
+    return len(updates)
+
+
+@st.cache_resource
+def _sheet_edit_buffer() -> _SheetEditBuffer:
+    """secrets の sheet_edit_window（既定 2 秒）で書き込みをまとめる間隔を調整。"""
+    return _SheetEditBuffer(float(st.secrets.get("sheet_edit_window", 2.0)))
+
+
+def _queue_card_edit(front: str, column: int, value: str, url: str | None, append: bool = False) -> bool:
+    """セル編集を書き込み待ちに積み、キャッシュ中のデッキとこのセッションの問題にもすぐ反映する。"""
+    return _queue_card_edits([front], column, value, url, append)
+
+
+def _queue_card_edits(fronts: list[str], column: int, value: str, url: str | None, append: bool = False) -> bool:
+    """1デッキの複数の問題に同じセル編集をまとめて積む（書き込み待ちへの追加とキャッシュの差し替えは1回ずつ）。"""
+    url = url or st.session_state.get("current_deck_url") or st.secrets.get("spreadsheet_url")
+    if is_local_deck(url):
+        st.warning("ローカルファイルのデッキは読み取り専用です。ファイルを直接編集してください。")
         return False
-    except Exception as e:
-        st.error(f"非表示設定の保存に失敗しました: {e}")
+    if not url or not GSPREAD_AVAILABLE:
         return False
+    buffer = _sheet_edit_buffer()
+    error = buffer.errors().get(url, "")
+    if "403" in error:
+        client_email = st.secrets.get("gcp_service_account", {}).get("client_email", "不明")
+        st.error(f"⚠️ スプレッドシートの権限エラー (403)\n\nこの機能を使うには、スプレッドシートの画面右上の「共有」ボタンから、以下のメールアドレスを「編集者」として追加してください：\n\n`{client_email}`")
+        return False
+    buffer.add_many(url, fronts, column, value, append)
+
+    # 自分の編集がすぐ見えるように、共有キャッシュとセッション内の問題を編集済みの写しに差し替える。
+    # 共有中の dict は他のセッションが読んでいる最中かもしれないので変更しない
+    # （単一デッキではセッションもキャッシュと同じ dict を持つので、同じ写しに揃える）
+    mode = "append" if append else "set"
+
+    def edit(item: dict):
+        _apply_cell_edit(item, column, mode, value)
+
+    targets = set(fronts)
+    copies = _deck_cache().update_items(url, targets, edit)
+
+    def edited(item: dict) -> dict:
+        if item["front"] not in targets or item.get("deck_url", url) != url:
+            return item
+        if id(item) not in copies:
+            copy = dict(item)
+            edit(copy)
+            copies[id(item)] = copy
+        return copies[id(item)]
+
+    data = st.session_state.get("session_data_cache")
+    if data is not None:
+        for i, item in enumerate(data):
+            if item["front"] in targets:
+                data[i] = edited(item)
+    if st.session_state.get("quiz_question"):
+        st.session_state.quiz_question = edited(st.session_state.quiz_question)
+    for built in st.session_state.get("quiz_pipeline") or []:
+        built["item"] = edited(built["item"])
+    items = _deck_cache().get(url)
+    for front in targets:
+        _search_indexes().update(url, front, items)
+    return True
+
+
+def save_notes_to_sheet(front: str, notes: str, url: str | None = None):
+    """7列目（メモ/参考URL）をスプレッドシートに保存する（まとめ書き）。"""
+    return _queue_card_edit(front, 7, notes, url)
+
+
+def save_explanation_to_sheet(front: str, explanation: str, url: str | None = None):
+    """6列目（解説）をスプレッドシートに追記する（まとめ書き）。"""
+    return _queue_card_edit(front, 6, explanation, url, append=True)
+
+
+def save_hidden_to_sheet(front: str, url: str | None = None):
+    """8列目（非表示フラグ）をスプレッドシートに保存し（まとめ書き）、セッションの出題からその場で外す。"""
+    return save_hidden_many([{"front": front, "deck_url": url}]) == 1
+
+
+def save_hidden_many(items: list[dict]) -> int:
+    """まとめて非表示にする（デッキごとに1回で書き込み待ちに積む）。非表示にできた件数を返す。"""
+    by_url = {}
+    for item in items:
+        by_url.setdefault(item.get("deck_url"), []).append(item["front"])
+    done = 0
+    for url, fronts in by_url.items():
+        if not _queue_card_edits(fronts, 8, "TRUE", url):
+            continue
+        done += len(fronts)
+    if done:
+        _remove_from_session()
+    return done
+
+
+def save_unhidden_to_sheet(item: dict) -> bool:
+    """8列目（非表示フラグ）を消して、セッションの出題に戻す。"""
+    return save_unhidden_many([item]) == 1
+
+
+def save_unhidden_many(items: list[dict]) -> int:
+    """まとめて表示に戻す（デッキごとに1回で書き込み待ちに積む）。戻せた件数を返す。"""
+    by_url = {}
+    for item in items:
+        by_url.setdefault(item.get("deck_url"), []).append(item)
+    done = 0
+    for url, group in by_url.items():
+        if not _queue_card_edits([item["front"] for item in group], 8, "", url):
+            continue
+        done += len(group)
+        for item in group:
+            item = dict(item)
+            _apply_cell_edit(item, 8, "set", "")
+            _restore_to_session(item)
+    return done
+
+
+# ===================================================================
+# セッションの出題順（シードから位置ごとに計算する並べ替え）
+# ===================================================================
+# スライス・4択・フラッシュカード・マッチングの出題順は、シャッフル済みのリストを持たず
+# 「シード + 何番目か」から都度計算する。session_state に残るのは数個の整数だけで、
+# secrets の session_seed を固定すれば出題順を再現できる（デバッグ・ベンチマーク用）。
+# 非表示にしたカードはスライスに残したまま取り出すときに読み飛ばし、
+# 表示に戻したカードはスライスの末尾に足す（並べ替えの後ろに、足した順で出る）。
+class _SeededPermutation:
+    """[0, n) の並べ替えを、シードだけから位置ごとに計算する（リストを持たない）。
+
+    4段の Feistel 網で n 以上の 4 の累乗の範囲に全単射を作り、n 以上に出た値は
+    もう一度通す（cycle walking、平均 4 回以内）。index() はその逆変換。
+    """
+
+    __slots__ = ("n", "seed", "_half_bits", "_mask", "_keys")
+    ROUNDS = 4
+
+    def __init__(self, n: int, seed: int):
+        self.n = n
+        self.seed = seed
+        bits = max(2, (max(n, 1) - 1).bit_length())
+        bits += bits & 1
+        self._half_bits = bits // 2
+        self._mask = (1 << self._half_bits) - 1
+        self._keys = tuple(
+            int.from_bytes(hashlib.sha256(f"{seed}:{r}".encode()).digest()[:4], "big")
+            for r in range(self.ROUNDS)
+        )
+
+    def _f(self, r: int, x: int) -> int:
+        h = (x * 0x9E3779B1 ^ self._keys[r]) & 0xFFFFFFFF
+        h ^= h >> 15
+        h = (h * 0x2C1B3C6D) & 0xFFFFFFFF
+        h ^= h >> 12
+        return h & self._mask
+
+    def _encrypt(self, x: int) -> int:
+        left, right = x >> self._half_bits, x & self._mask
+        for r in range(self.ROUNDS):
+            left, right = right, left ^ self._f(r, right)
+        return (left << self._half_bits) | right
+
+    def _decrypt(self, y: int) -> int:
+        left, right = y >> self._half_bits, y & self._mask
+        for r in reversed(range(self.ROUNDS)):
+            left, right = right ^ self._f(r, left), left
+        return (left << self._half_bits) | right
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __getitem__(self, position: int) -> int:
+        if not 0 <= position < self.n:
+            raise IndexError(position)
+        x = self._encrypt(position)
+        while x >= self.n:
+            x = self._encrypt(x)
+        return x
+
+    def index(self, value: int) -> int:
+        if not 0 <= value < self.n:
+            raise ValueError(value)
+        y = self._decrypt(value)
+        while y >= self.n:
+            y = self._decrypt(y)
+        return y
+
 
+def _session_seed() -> int:
+    """セッションの出題順の元になるシード（スライスを作るときに決める）。"""
+    if "session_seed" not in st.session_state:
+        st.session_state.session_seed = int(st.secrets.get("session_seed", 0)) or random.getrandbits(32)
+    return st.session_state.session_seed
 
-def _call_gemini(prompt: str, api_key: str, max_tokens: int = None) -> str:
-    """Gemini REST APIを共通呼び出し関数（検索連携あり・リトライ処理付き）。"""
-    url = (
-        "https://generativelanguage.googleapis.com/v1beta/"
-        f"models/gemini-flash-lite-latest:generateContent?key={api_key}"
+
+def _derive_seed(*parts) -> int:
+    """セッションのシードから、用途・周回ごとのシードを作る。"""
+    digest = hashlib.sha256(repr((_session_seed(),) + parts).encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "big")
+
+
+def _order_index(perm, position: int) -> int:
+    """出題順の position 番目のデータ位置。並べ替えの後ろはスライスに後から足したカード。"""
+    return perm[position] if position < len(perm) else position
+
+
+def _card_key(item: dict) -> tuple[str, str]:
+    return item.get("deck_url", ""), item["front"]
+
+
+def _remove_from_session():
+    """非表示にしたカードは各モードが取り出すときに読み飛ばす。ブラウザ側のカードだけ作り直す。"""
+    if st.session_state.get("session_data_cache") is not None:
+        st.session_state.fc_rev = st.session_state.get("fc_rev", 0) + 1
+
+
+def _restore_to_session(item: dict):
+    """表示に戻したカードを出題に戻す（スライスに無ければ末尾に足す）。"""
+    data = st.session_state.get("session_data_cache")
+    if data is None:
+        return
+    keys = st.session_state.get("session_data_keys")
+    if keys is None:
+        keys = st.session_state.session_data_keys = {_card_key(d) for d in data}
+    key = _card_key(item)
+    if key not in keys:
+        keys.add(key)
+        data.append(item)
+    st.session_state.fc_rev = st.session_state.get("fc_rev", 0) + 1
+
+
+def _order_position(perm, index: int) -> int:
+    """_order_index の逆（データ位置 -> 出題順の何番目か）。"""
+    return perm.index(index) if index < len(perm) else index
+
+
+def _session_progress(data: list[dict], perm, position: int) -> tuple[int, int]:
+    """非表示のカードを除いた進捗 (position までに出した枚数, 全体の枚数)。
+
+    非表示カードの位置は、非表示・表示に戻したとき (fc_rev) か出題順が変わったときだけ数え直す。
+    """
+    source = (st.session_state.get("session_cache_key"), id(perm), st.session_state.get("fc_rev", 0), len(data))
+    cached = st.session_state.get("session_hidden_positions")
+    if cached is None or cached[0] != source:
+        positions = sorted(_order_position(perm, i) for i, d in enumerate(data) if d.get("hidden"))
+        cached = st.session_state.session_hidden_positions = (source, positions)
+    hidden = cached[1]
+    return position - bisect.bisect_left(hidden, position), len(data) - len(hidden)
+
+
+GEMINI_MODEL = "gemini-flash-lite-latest"
+
+
+class _Flight:
+    """実行中の1回分の呼び出し（結果と、待っている呼び出しの中で最も高い優先度）。"""
+
+    def __init__(self, priority: int):
+        self.future = Future()
+        self.priority = priority
+
+
+class _SingleFlight:
+    """同じキーの同時呼び出しを1回の実行にまとめる（プロセス共有）。
+
+    実行中の呼び出しがあれば後から来た呼び出しはその完了を待ち、同じ結果（または例外）を受け取る。
+    完了した結果は保持しない。
+    後から来た呼び出しの優先度（小さいほど優先）の方が高ければ実行中の呼び出しの優先度を引き上げる
+    （先読みと同じ解説をボタンで要求したとき、先読みの低い優先度のまま待たされないように）。
+    fn は現在の優先度を返す関数を受け取る。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> _Flight
+        self.executed = 0
+        self.shared = 0
+        self.raised = 0
+
+    def do(self, key: str, fn, priority: int = 0, on_raise=None):
+        with self._lock:
+            flight = self._calls.get(key)
+            leader = flight is None
+            raised = False
+            if leader:
+                flight = _Flight(priority)
+                self._calls[key] = flight
+                self.executed += 1
+            else:
+                self.shared += 1
+                if priority < flight.priority:
+                    flight.priority = priority
+                    self.raised += 1
+                    raised = True
+        if not leader:
+            if raised and on_raise is not None:
+                on_raise()
+            return flight.future.result()
+        try:
+            result = fn(lambda: flight.priority)
+            flight.future.set_result(result)
+            return result
+        except BaseException as e:
+            flight.future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+
+@st.cache_resource
+def _gemini_single_flight() -> _SingleFlight:
+    return _SingleFlight()
+
+
+# Gemini 呼び出しの優先度（小さいほど優先）
+GEMINI_PRIORITY_INTERACTIVE = 0  # 学習者がボタンで要求した解説
+GEMINI_PRIORITY_GENERATION = 1   # 学習者が要求した問題生成
+GEMINI_PRIORITY_BACKGROUND = 2   # 先読み・一括生成などの裏方処理
+GEMINI_PRIORITY_LABELS = {0: "解説", 1: "問題生成", 2: "バックグラウンド"}
+
+
+class _PriorityRateLimiter:
+    """優先度付きのトークンバケット（リクエスト数/分・トークン数/分）。
+
+    待ち行列は優先度順（同じ優先度なら到着順）で、先頭だけがバケットから取り出せる。
+    429 を受けたら流量を半分に絞り（乗算的減少）、成功するたびに少しずつ戻す（加算的増加）。
+    """
+
+    def __init__(self, rpm: float, tpm: float | None = None, min_scale: float = 0.1,
+                 increase: float = 0.05, decrease_cooldown: float = 5.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.min_scale = min_scale
+        self.increase = increase
+        self.decrease_cooldown = decrease_cooldown
+        self.scale = 1.0
+        self._cond = threading.Condition()
+        self._req_tokens = float(rpm)
+        self._tpm_tokens = float(tpm or 0)
+        self._updated = time.monotonic()
+        self._last_decrease = 0.0
+        self._waiters = []  # (priority, seq) のヒープ
+        self._seq = itertools.count()
+        self.throttled = 0
+        self.wait_count = {}
+        self.wait_total = {}
+        self.wait_max = {}
+
+    def _capacity(self, limit: float) -> float:
+        return max(1.0, limit * self.scale)
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._req_tokens = min(self._capacity(self.rpm),
+                               self._req_tokens + elapsed * self.rpm * self.scale / 60.0)
+        if self.tpm:
+            self._tpm_tokens = min(self._capacity(self.tpm),
+                                   self._tpm_tokens + elapsed * self.tpm * self.scale / 60.0)
+
+    def _seconds_until_available(self, cost: float) -> float:
+        wait = max(0.0, 1.0 - self._req_tokens) * 60.0 / (self.rpm * self.scale)
+        if self.tpm:
+            need = min(cost, self._capacity(self.tpm)) - self._tpm_tokens
+            wait = max(wait, max(0.0, need) * 60.0 / (self.tpm * self.scale))
+        return wait
+
+    def acquire(self, priority=0, cost: float = 0) -> float:
+        """順番とバケットの空きを待って1リクエスト分を取り出す。待った秒数を返す。
+
+        priority に関数を渡すと待っている間も読み直し、引き上げられたら並び直す（到着順は保つ）。
+        """
+        current = priority if callable(priority) else (lambda: priority)
+        ticket = (current(), next(self._seq))
+        started = time.monotonic()
+        with self._cond:
+            heapq.heappush(self._waiters, ticket)
+            while True:
+                self._refill()
+                raised = current()
+                if raised < ticket[0]:
+                    self._waiters.remove(ticket)
+                    ticket = (raised, ticket[1])
+                    self._waiters.append(ticket)
+                    heapq.heapify(self._waiters)
+                if self._waiters[0] == ticket:
+                    wait = self._seconds_until_available(cost)
+                    if wait <= 0:
+                        self._req_tokens -= 1.0
+                        if self.tpm:
+                            self._tpm_tokens -= min(cost, self._capacity(self.tpm))
+                        heapq.heappop(self._waiters)
+                        self._cond.notify_all()
+                        break
+                    self._cond.wait(timeout=wait)
+                else:
+                    # 先頭が取り出したら notify_all で起こされる
+                    self._cond.wait(timeout=1.0)
+            waited = time.monotonic() - started
+            priority = ticket[0]
+            self.wait_count[priority] = self.wait_count.get(priority, 0) + 1
+            self.wait_total[priority] = self.wait_total.get(priority, 0.0) + waited
+            self.wait_max[priority] = max(self.wait_max.get(priority, 0.0), waited)
+        return waited
+
+    def wake(self):
+        """待っている呼び出しを起こして優先度を読み直させる。"""
+        with self._cond:
+            self._cond.notify_all()
+
+    def on_throttled(self):
+        """429 を受けたとき：流量を半分にし、バケットを空にして全体で一旦待つ。"""
+        with self._cond:
+            self.throttled += 1
+            now = time.monotonic()
+            # 同時に返ってきた複数の 429 で一気に絞りすぎないよう、減少は一定間隔に1回
+            if now - self._last_decrease >= self.decrease_cooldown:
+                self.scale = max(self.min_scale, self.scale * 0.5)
+                self._last_decrease = now
+            self._req_tokens = 0.0
+            self._cond.notify_all()
+
+    def on_success(self):
+        with self._cond:
+            self.scale = min(1.0, self.scale + self.increase)
+
+    def metrics(self) -> dict:
+        with self._cond:
+            return {
+                "queue_depth": len(self._waiters),
+                "effective_rpm": self.rpm * self.scale,
+                "throttled": self.throttled,
+                "avg_wait": {p: self.wait_total[p] / self.wait_count[p] for p in self.wait_count},
+                "max_wait": dict(self.wait_max),
+            }
+
+
+@st.cache_resource
+def _gemini_rate_limiter() -> _PriorityRateLimiter:
+    """サーバー全体で共有する Gemini のレート制限（secrets の gemini_rpm / gemini_tpm で調整）。"""
+    return _PriorityRateLimiter(
+        rpm=float(st.secrets.get("gemini_rpm", 15)),
+        tpm=float(st.secrets.get("gemini_tpm", 250000)) or None,
+    )
+
+
+class GeminiHTTPStatusError(Exception):
+    """Gemini が 4xx/5xx を返した。"""
+
+    def __init__(self, status_code: int):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+class GeminiTransportError(Exception):
+    """接続・タイムアウトなど、HTTP の応答が得られなかった。"""
+
+
+class _CountingHTTPAdapter(HTTPAdapter):
+    """新しく張った接続（= TCP/TLS ハンドシェイク）を張った時点で数える HTTPAdapter。
+
+    プールに戻らない一時的な接続（pool_block=False であふれた分）や、追い出されたプールの接続も数える。
+    """
+
+    def __init__(self, on_connect, **kwargs):
+        self._on_connect = on_connect
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        on_connect = self._on_connect
+
+        def counting(pool_cls):
+            class CountingPool(pool_cls):
+                def _new_conn(self):
+                    on_connect()
+                    return super()._new_conn()
+            return CountingPool
+
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: counting(pool_cls) for scheme, pool_cls in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+
+class _GeminiHTTPClient:
+    """Gemini 用の共有 HTTP クライアント（keep-alive の接続プール・スレッドセーフ）。
+
+    既定は requests.Session + 接続プール。http2=True かつ httpx[http2] があれば
+    HTTP/2 の1本の接続に多重化する。接続数（= TCP/TLS ハンドシェイク数）と
+    リクエスト数を数え、接続の再利用率を確認できるようにする。
+    """
+
+    def __init__(self, pool_size: int = 10, http2: bool = False):
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self._client = None
+        if http2 and HTTPX_AVAILABLE:
+            try:
+                self._client = httpx.Client(
+                    http2=True,
+                    limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+                )
+            except ImportError:
+                # h2 が入っていなければ HTTP/1.1 のプールを使う
+                self._client = None
+        self.http2 = self._client is not None
+        if not self.http2:
+            self._session = _requests.Session()
+            # 複数スレッドから共有するので Cookie は保持しない
+            self._session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            # pool_block=False: 同時リクエストがプールを超えたら一時的な接続で送り、プールには戻さない
+            self._adapter = _CountingHTTPAdapter(self._count_connection, pool_connections=4,
+                                                 pool_maxsize=pool_size, pool_block=False)
+            self._session.mount("https://", self._adapter)
+            self._session.mount("http://", self._adapter)
+
+    def post_json(self, url: str, payload: dict, timeout: float = 30) -> dict:
+        with self._lock:
+            self.requests += 1
+        if self.http2:
+            try:
+                resp = self._client.post(url, json=payload, timeout=timeout,
+                                         extensions={"trace": self._trace_h2})
+            except httpx.TransportError as e:
+                raise GeminiTransportError(str(e)) from e
+        else:
+            try:
+                resp = self._session.post(url, json=payload, timeout=timeout)
+            except _requests.exceptions.RequestException as e:
+                raise GeminiTransportError(str(e)) from e
+        if resp.status_code >= 400:
+            raise GeminiHTTPStatusError(resp.status_code)
+        return resp.json()
+
+    def _count_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def _trace_h2(self, event_name: str, info: dict):
+        if event_name == "connection.connect_tcp.complete":
+            self._count_connection()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            connections = self.connections
+        return {
+            "protocol": "HTTP/2" if self.http2 else "HTTP/1.1",
+            "requests": self.requests,
+            "connections": connections,
+            "reused": max(0, self.requests - connections),
+        }
+
+
+@st.cache_resource
+def _gemini_http_client() -> _GeminiHTTPClient:
+    """全セッション・先読みスレッドで共有する接続プール（secrets の gemini_http_pool_size / gemini_http2 で調整）。"""
+    return _GeminiHTTPClient(
+        pool_size=int(st.secrets.get("gemini_http_pool_size", 10)),
+        http2=bool(st.secrets.get("gemini_http2", False)),
     )
+
+
+def _call_gemini(prompt: str, api_key: str, max_tokens: int = None, temperature: float = None,
+                 priority: int = GEMINI_PRIORITY_INTERACTIVE) -> str:
+    """Gemini REST APIを共通呼び出し関数（検索連携あり・リトライ処理付き）。
+
+    バックグラウンドスレッドから呼ぶ場合は session_state を参照できないため、
+    max_tokens と temperature を明示的に渡すこと。
+    同じプロンプト・設定の同時リクエストは全セッションで1回の呼び出しにまとめる。
+    送信は全体のレート制限を通り、priority の小さい呼び出しから順に行われる。
+    """
+    # gemini_api_base は負荷試験などでスタブサーバーへ向けるときに使う
+    api_base = st.secrets.get("gemini_api_base", "https://generativelanguage.googleapis.com")
+    url = f"{api_base.rstrip('/')}/v1beta/models/{GEMINI_MODEL}:generateContent?key={api_key}"
     base_tokens = max_tokens if max_tokens else st.session_state.get("ai_max_tokens", 500)
+    if temperature is None:
+        temperature = st.session_state.get("ai_temperature", 0.3)
     payload = {
         "contents": [{"parts": [{"text": prompt}]}],
         "tools": [{"googleSearch": {}}],
         "generationConfig": {
             "maxOutputTokens": base_tokens + 300,
-            "temperature": st.session_state.get("ai_temperature", 0.3),
+            "temperature": temperature,
         }
     }
-    
+    key = hashlib.sha256(
+        json.dumps([GEMINI_MODEL, payload], ensure_ascii=False, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+    # トークン数の目安：入力は1文字≒1トークン、出力は上限値で見積もる
+    cost = len(prompt) + payload["generationConfig"]["maxOutputTokens"]
+    # 同じ内容を先に要求した呼び出しがあればそれを待つ。こちらの方が優先なら待ち行列での順番を引き上げる
+    return _gemini_single_flight().do(
+        key, lambda current: _post_gemini(url, payload, current, cost), priority,
+        on_raise=_gemini_rate_limiter().wake,
+    )
+
+
+def _post_gemini(url: str, payload: dict, priority=GEMINI_PRIORITY_INTERACTIVE, cost: float = 0) -> str:
+    """Gemini へのPOST（レート制限・リトライ・エラーメッセージの日本語化）。
+
+    priority は優先度か、現在の優先度を返す関数（同じ呼び出しを待つ側に引き上げられることがある）。
+    """
+    limiter = _gemini_rate_limiter()
+    client = _gemini_http_client()
     max_retries = 3
     for i in range(max_retries):
         try:
-            resp = _requests.post(url, json=payload, timeout=30)
-            resp.raise_for_status()
-            data = resp.json()
+            limiter.acquire(priority, cost)
+            data = client.post_json(url, payload, timeout=30)
+            limiter.on_success()
             return data["candidates"][0]["content"]["parts"][0]["text"].strip()
-        except _requests.exceptions.HTTPError as e:
-            status_code = e.response.status_code
-            if status_code in [429, 500, 503, 504] and i < max_retries - 1:
+        except GeminiHTTPStatusError as e:
+            status_code = e.status_code
+            if status_code == 429 and i < max_retries - 1:
+                # 全体の流量を絞り、次の acquire で順番と空きを待つ（固定時間の sleep はしない）
+                limiter.on_throttled()
+                continue
+            if status_code in [500, 503, 504] and i < max_retries - 1:
                 # 指数バックオフ (2, 4, 8秒)
                 wait_time = (2 ** (i + 1))
                 time.sleep(wait_time)
@@ -771,7 +3169,7 @@ def _call_gemini(prompt: str, api_key: str, max_tokens: int = None) -> str:
                 raise Exception("AIサーバーでエラーが発生しました。時間を置いて再度お試しください。")
             else:
                 raise Exception(f"通信エラーが発生しました (Status: {status_code})")
-        except _requests.exceptions.RequestException as e:
+        except GeminiTransportError as e:
             if i < max_retries - 1:
                 time.sleep(2)
                 continue
@@ -780,12 +3178,193 @@ def _call_gemini(prompt: str, api_key: str, max_tokens: int = None) -> str:
     raise Exception("AIからの応答が得られませんでした。")
 
 
-def render_mermaid(code: str):
-    """Mermaidコードをmermaid.ink経由で画像として表示する。"""
+# ===================================================================
+# Mermaid 図のレンダリング（内容ハッシュでキャッシュ）
+# ===================================================================
+MERMAID_FAILURE_TTL = 60  # 失敗した図を再試行しない秒数（オフライン時に毎回待たないため）
+
+
+class _MermaidCache:
+    """Mermaid 図の PNG を内容ハッシュで保持する LRU キャッシュ（プロセス共有）。
+
+    メモリ上の合計サイズが max_bytes を超えたら古いものから捨てる。
+    disk_dir を指定するとディスクにも保存し、再起動後も使えるようにする（こちらも max_bytes で古い順に削除）。
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: str = ""):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> png bytes
+        self._size = 0
+        self._failures = {}  # key -> 失敗時刻
+        self.hits = 0
+        self.misses = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.png")
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            png = self._entries.get(key)
+            if png is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return png
+        if self.disk_dir and os.path.exists(self._disk_path(key)):
+            with open(self._disk_path(key), "rb") as f:
+                png = f.read()
+            self.put(key, png, write_disk=False)
+            with self._lock:
+                self.hits += 1
+            return png
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, png: bytes, write_disk: bool = True):
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            self._entries[key] = png
+            self._size += len(png)
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+        if self.disk_dir and write_disk:
+            with open(self._disk_path(key), "wb") as f:
+                f.write(png)
+            self._trim_disk()
+
+    def _trim_disk(self):
+        files = [os.path.join(self.disk_dir, n) for n in os.listdir(self.disk_dir) if n.endswith(".png")]
+        files.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(f) for f in files)
+        for f in files[:-1]:
+            if total <= self.max_bytes:
+                break
+            total -= os.path.getsize(f)
+            os.remove(f)
+
+    def recently_failed(self, key: str) -> bool:
+        with self._lock:
+            failed_at = self._failures.get(key)
+        return failed_at is not None and time.time() - failed_at < MERMAID_FAILURE_TTL
+
+    def mark_failed(self, key: str):
+        with self._lock:
+            self._failures[key] = time.time()
+
+    def stats(self) -> tuple[int, int, int, int]:
+        """(件数, 合計バイト数, ヒット数, ミス数)"""
+        with self._lock:
+            return len(self._entries), self._size, self.hits, self.misses
+
+
+@st.cache_resource
+def _mermaid_cache() -> _MermaidCache:
+    """secrets の mermaid_cache_mb（既定 32MB）/ mermaid_cache_dir（指定時のみディスク保存）で調整。"""
+    return _MermaidCache(
+        max_bytes=int(float(st.secrets.get("mermaid_cache_mb", 32)) * 1024 * 1024),
+        disk_dir=st.secrets.get("mermaid_cache_dir", ""),
+    )
+
+
+def _render_mermaid_local(code: str) -> bytes:
+    """mermaid-cli (mmdc) でローカルに PNG を生成する（ネットワーク不要）。"""
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "diagram.mmd")
+        out = os.path.join(tmp, "diagram.png")
+        with open(src, "w", encoding="utf-8") as f:
+            f.write(code)
+        subprocess.run(
+            [shutil.which("mmdc"), "-i", src, "-o", out, "-b", "white"],
+            check=True, capture_output=True, timeout=60,
+        )
+        with open(out, "rb") as f:
+            return f.read()
+
+
+def _render_mermaid_remote(code: str) -> bytes:
+    """mermaid.ink で PNG を生成する。"""
     import base64
     encoded = base64.urlsafe_b64encode(code.encode("utf-8")).decode("ascii")
-    img_url = f"https://mermaid.ink/img/{encoded}"
-    st.image(img_url, use_container_width=True)
+    resp = _requests.get(f"https://mermaid.ink/img/{encoded}?type=png", timeout=15)
+    resp.raise_for_status()
+    return resp.content
+
+
+def render_mermaid_png(code: str) -> bytes | None:
+    """Mermaidコードを PNG にする（キャッシュ優先）。レンダリングできなければ None。
+
+    secrets の mermaid_renderer: "auto"（mmdc があればローカル、なければ mermaid.ink）/ "local" / "remote"
+    """
+    key = hashlib.sha256(code.strip().encode("utf-8")).hexdigest()
+    cache = _mermaid_cache()
+    png = cache.get(key)
+    if png is not None:
+        return png
+    if cache.recently_failed(key):
+        return None
+
+    renderer = st.secrets.get("mermaid_renderer", "auto")
+    backends = []
+    if renderer in ("auto", "local") and shutil.which("mmdc"):
+        backends.append(_render_mermaid_local)
+    if renderer in ("auto", "remote"):
+        backends.append(_render_mermaid_remote)
+    for backend in backends:
+        try:
+            png = backend(code)
+        except Exception:
+            continue
+        cache.put(key, png)
+        return png
+    cache.mark_failed(key)
+    return None
+
+
+def render_mermaid(code: str):
+    """Mermaidコードを画像として表示する（描画済みの図はキャッシュから、描画できなければコードを表示）。"""
+    png = render_mermaid_png(code)
+    if png is None:
+        st.caption("⚠️ 図を描画できませんでした（オフライン、またはMermaidの記述エラー）")
+        st.code(code, language="mermaid")
+        return
+    st.image(png, use_container_width=True)
+
+
+def _notes_prompt(front: str, back: str, custom_prompt: str, target_chars: int) -> str:
+    """[Button 1] のプロンプトを組み立てる。"""
+    if custom_prompt.strip():
+        return (
+            f"以下のクイズの設問と正解について、次の指示または質問に答えてください：\n"
+            f"指示・質問：{custom_prompt}\n\n"
+            f"設問: {front}\n"
+            f"正解: {back}\n"
+            f"文字数の目安: 【約{target_chars}文字】のボリュームで回答してください。\n"
+        )
+    return (
+        f"以下の用語と定義を核としつつ、必要に応じて一般的なビジネス知識や実例を用いて、初心者にも分かりやすく「なぜこの回答なのか」「認識のポイント」「記憶のコツ」を【約{target_chars}文字】のボリュームでかみ砕いて解説してください。\n"
+        f"ただし、解説の内容が元の定義から逸脱しないように注意すること。\n\n"
+        f"用語: {front}\n"
+        f"定義: {back}\n"
+    )
+
+
+def _options_prompt(front: str, back: str, options: list[str], target_chars: int) -> str:
+    """[Button 2] のプロンプトを組み立てる。"""
+    options_text = "\n".join([f"-  {opt}" for opt in options])
+    return (
+        f"以下のクイズの全選択肢を見て、各選択肢の意味、正解との違いを日本語で解説してください。\n"
+        f"この用語と定義を核としつつ、必要に応じて一般的なビジネス知識や実例を用いて、実務上の違いが分かるように各選択肢を【全体で約{target_chars}文字になるボリュームで】説明してください。\n"
+        f"ただし、解説の内容が元の定義から逸脱しないように注意すること。\n\n"
+        f"用語: {front}\n"
+        f"正解: {back}\n"
+        f"選択肢:\n{options_text}\n"
+    )
 
 
 def ai_generate_notes(front: str, back: str, custom_prompt: str = "") -> str:
@@ -795,21 +3374,10 @@ def ai_generate_notes(front: str, back: str, custom_prompt: str = "") -> str:
         return ""
     try:
         target_chars = st.session_state.get("ai_max_tokens", 500)
-        if custom_prompt.strip():
-            prompt = (
-                f"以下のクイズの設問と正解について、次の指示または質問に答えてください：\n"
-                f"指示・質問：{custom_prompt}\n\n"
-                f"設問: {front}\n"
-                f"正解: {back}\n"
-                f"文字数の目安: 【約{target_chars}文字】のボリュームで回答してください。\n"
-            )
-        else:
-            prompt = (
-                f"以下の用語と定義を核としつつ、必要に応じて一般的なビジネス知識や実例を用いて、初心者にも分かりやすく「なぜこの回答なのか」「認識のポイント」「記憶のコツ」を【約{target_chars}文字】のボリュームでかみ砕いて解説してください。\n"
-                f"ただし、解説の内容が元の定義から逸脱しないように注意すること。\n\n"
-                f"用語: {front}\n"
-                f"定義: {back}\n"
-            )
+        prompt = _notes_prompt(front, back, custom_prompt, target_chars)
+        prefetched = _take_prefetched_ai(prompt)
+        if prefetched:
+            return prefetched
         return _call_gemini(prompt, api_key, max_tokens=target_chars)
     except Exception as e:
         st.error(f"AI解説の取得に失敗しました: {e}")
@@ -822,40 +3390,386 @@ def ai_explain_options(front: str, back: str, options: list[str]) -> str:
     if not api_key:
         return ""
     try:
-        options_text = "\n".join([f"-  {opt}" for opt in options])
         target_chars = st.session_state.get("ai_max_tokens", 500)
-        prompt = (
-            f"以下のクイズの全選択肢を見て、各選択肢の意味、正解との違いを日本語で解説してください。\n"
-            f"この用語と定義を核としつつ、必要に応じて一般的なビジネス知識や実例を用いて、実務上の違いが分かるように各選択肢を【全体で約{target_chars}文字になるボリュームで】説明してください。\n"
-            f"ただし、解説の内容が元の定義から逸脱しないように注意すること。\n\n"
-            f"用語: {front}\n"
-            f"正解: {back}\n"
-            f"選択肢:\n{options_text}\n"
-        )
+        prompt = _options_prompt(front, back, options, target_chars)
+        prefetched = _take_prefetched_ai(prompt)
+        if prefetched:
+            return prefetched
         return _call_gemini(prompt, api_key, max_tokens=target_chars)
     except Exception as e:
         st.error(f"他の回答解説の取得に失敗しました: {e}")
         return ""
 
 
+# ===================================================================
+# AI解説の先読み
+# ===================================================================
+@st.cache_resource
+def _ai_prefetch_pool() -> ThreadPoolExecutor:
+    """先読み用のスレッドプール（プロセス共有。同時実行数で Gemini への負荷を抑える）。"""
+    return ThreadPoolExecutor(
+        max_workers=int(st.secrets.get("ai_prefetch_workers", 2)),
+        thread_name_prefix="ai-prefetch",
+    )
+
+
+def prefetch_ai_explanations(q: dict, options: list[str], next_item: dict | None = None,
+                             next_options: list[str] | None = None):
+    """回答中に、現在の問題と次の問題のAI解説を裏で生成しておく（オプトイン）。
+
+    先読み結果は (プロンプト, temperature) をキーに保持し、ボタン押下時に同じプロンプトなら即座に使う。
+    現在・次の問題以外の先読みは取り消す。
+    """
+    if not st.session_state.get("ai_prefetch_enabled"):
+        return
+    api_key = st.secrets.get("gemini_api_key", "")
+    if not api_key:
+        return
+    target_chars = st.session_state.get("ai_max_tokens", 500)
+    temperature = st.session_state.get("ai_temperature", 0.3)
+    prompts = [
+        _notes_prompt(q["front"], q["back"], "", target_chars),
+        _options_prompt(q["front"], q["back"], options, target_chars),
+    ]
+    if next_item:
+        prompts.append(_notes_prompt(next_item["front"], next_item["back"], "", target_chars))
+        if next_options:
+            prompts.append(_options_prompt(next_item["front"], next_item["back"], next_options, target_chars))
+
+    registry = st.session_state.setdefault("ai_prefetch", {})
+    wanted = {(prompt, temperature) for prompt in prompts}
+    for key in list(registry):
+        if key not in wanted:
+            registry.pop(key).cancel()
+    for key in wanted:
+        if key not in registry:
+            registry[key] = _ai_prefetch_pool().submit(
+                _call_gemini, key[0], api_key, max_tokens=target_chars, temperature=key[1],
+                priority=GEMINI_PRIORITY_BACKGROUND,
+            )
+
+
+def _take_prefetched_ai(prompt: str) -> str:
+    """先読みが済んでいればその結果を返す。失敗・未登録・まだ終わっていないなら ""。
+
+    先読みの待ち行列は全セッションで共有しているので、終わっていない先読みは待たずに取り消し、
+    呼び出し側の画面操作の優先度の呼び出しに任せる（実行中の同じ呼び出しがあればそれに合流し、優先度を上げる）。
+    """
+    registry = st.session_state.get("ai_prefetch", {})
+    future = registry.pop((prompt, st.session_state.get("ai_temperature", 0.3)), None)
+    if future is None or future.cancelled():
+        return ""
+    if not future.done():
+        future.cancel()
+        return ""
+    try:
+        return future.result()
+    except Exception:
+        # 先読みの失敗は通常の呼び出しでやり直す
+        return ""
+
+
+def cancel_ai_prefetch():
+    """デッキ切り替え時などに、未実行の先読みを取り消して結果も破棄する。"""
+    for future in st.session_state.pop("ai_prefetch", {}).values():
+        future.cancel()
+
+
+# ===================================================================
+# AI解説の一括補完（6列目が空のカード）
+# ===================================================================
+# cli.py backfill から画面なしで実行する。生成は [Button 1] と同じプロンプトを先読みと同じ
+# 優先度で全体のレート制限に通し、同時実行数は workers まで。生成した解説は1件ずつ
+# チェックポイント（JSONL）に追記してから、batch_size 件ごとに1回の batch_update で6列目へ書き込む。
+# 途中で止まっても、次回は書き込み済みを飛ばし、生成済みで未書き込みの分は生成し直さずに書き込む。
+class _BackfillCheckpoint:
+    """生成済み・書き込み済みの解説を1行1件で追記するファイル。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.generated = {}  # (デッキURL, 表面) -> 生成済みで未書き込みの解説
+        self.written = set()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue  # 追記の途中で止まった最後の行
+                    key = (event["url"], event["front"])
+                    if event.get("written"):
+                        self.written.add(key)
+                        self.generated.pop(key, None)
+                    else:
+                        self.generated[key] = event["explanation"]
+        self._lock = threading.Lock()
+        # 途中で止まった最後の行に続けて書かないよう、改行で閉じてから追記する
+        unterminated = False
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                unterminated = f.read(1) != b"\n"
+        self._file = open(path, "a", encoding="utf-8")
+        if unterminated:
+            self._file.write("\n")
+
+    def _append(self, events: list[dict]):
+        with self._lock:
+            for event in events:
+                self._file.write(json.dumps(event, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def record_generated(self, url: str, front: str, explanation: str):
+        self._append([{"url": url, "front": front, "explanation": explanation}])
+
+    def record_written(self, url: str, fronts: list[str]):
+        self._append([{"url": url, "front": front, "written": True} for front in fronts])
+
+    def close(self):
+        self._file.close()
+
+
+def backfill_explanations(url: str, api_key: str, checkpoint_path: str, target_chars: int = 500,
+                          temperature: float = 0.3, workers: int = 2, batch_size: int = 20,
+                          limit: int | None = None, dry_run: bool = False, max_failures: int = 5,
+                          log=print) -> dict:
+    """デッキの解説（6列目）が空のカードに AI 解説を生成して書き込む。件数の集計を返す。
+
+    dry_run なら生成してチェックポイントに残すだけで、シートには書き込まない。
+    生成の失敗が max_failures 回続いたら（APIキーの誤りなど）残りを打ち切る。
+    """
+    if is_local_deck(url) and not dry_run:
+        raise ValueError("ローカルファイルのデッキは読み取り専用です（--dry-run なら生成だけ試せます）")
+    with sheets_priority(SHEETS_PRIORITY_BACKGROUND):
+        items = _fetch_deck(url)
+    checkpoint = _BackfillCheckpoint(checkpoint_path)
+    stats = {"targets": 0, "generated": 0, "resumed": 0, "written": 0, "failed": 0}
+    pending = {}  # 表面 -> 書き込み待ちの解説
+    todo = []
+    seen = set()
+    for item in items:
+        key = (url, item["front"])
+        if item.get("explanation") or item.get("hidden") or key in checkpoint.written or key in seen:
+            continue
+        seen.add(key)
+        if key in checkpoint.generated:
+            pending[item["front"]] = checkpoint.generated[key]
+        else:
+            todo.append(item)
+    stats["resumed"] = len(pending)
+    if limit is not None:
+        todo = todo[:limit]
+    stats["targets"] = len(todo) + len(pending)
+    log(f"解説なし {stats['targets']}件（前回の生成済み {stats['resumed']}件を含む）")
+
+    def flush():
+        if not pending or dry_run:
+            return
+        fronts = list(pending)
+        with sheets_priority(SHEETS_PRIORITY_BACKGROUND):
+            write_cell_edits(url, {(front, 6): ("append", pending[front]) for front in fronts})
+        checkpoint.record_written(url, fronts)
+        stats["written"] += len(fronts)
+        for front in fronts:
+            del pending[front]
+        log(f"書き込み {stats['written']}件")
+
+    def generate(item: dict) -> str:
+        prompt = _notes_prompt(item["front"], item["back"], "", target_chars)
+        explanation = _call_gemini(prompt, api_key, max_tokens=target_chars, temperature=temperature,
+                                   priority=GEMINI_PRIORITY_BACKGROUND)
+        # 書き込みの失敗で中断しても生成し直さないよう、生成したその場で記録する
+        checkpoint.record_generated(url, item["front"], explanation)
+        return explanation
+
+    failures = 0
+    try:
+        flush()
+        queue = iter(todo)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ai-backfill") as pool:
+            # 投入するのは同時実行数の2倍まで（デッキが大きくても待ち行列を溜めない）
+            running = {}
+            for item in itertools.islice(queue, workers * 2):
+                running[pool.submit(generate, item)] = item
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = running.pop(future)
+                    try:
+                        explanation = future.result()
+                    except Exception as e:
+                        stats["failed"] += 1
+                        failures += 1
+                        log(f"⚠️ {item['front']}: {e}")
+                    else:
+                        failures = 0
+                        stats["generated"] += 1
+                        pending[item["front"]] = explanation
+                if failures >= max_failures:
+                    for future in running:
+                        future.cancel()
+                    log(f"⚠️ 生成の失敗が{failures}回続いたため中断します")
+                    break
+                if len(pending) >= batch_size:
+                    flush()
+                for item in itertools.islice(queue, len(done)):
+                    running[pool.submit(generate, item)] = item
+        flush()
+    finally:
+        checkpoint.close()
+    return stats
+
+
+# ===================================================================
+# カードごとの画面状態（セッション内・上限付き）
+# ===================================================================
+CARD_STATE_SPILL_FIELDS = ("ai_result", "ai_opts_result", "notes")
+
+
+class _AITextCache:
+    """セッションから追い出された AI 解説などのテキストを預かる LRU（プロセス共有）。
+
+    キーにユーザーIDを含めるので、他の学習者の結果が見えることはない。
+    合計サイズが max_bytes を超えたら古いものから捨てる。
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> text
+        self._size = 0
+
+    def put(self, key: tuple, text: str):
+        size = len(text.encode("utf-8"))
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key).encode("utf-8"))
+            self._entries[key] = text
+            self._size += size
+            while self._size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted.encode("utf-8"))
+
+    def pop(self, key: tuple) -> str | None:
+        with self._lock:
+            text = self._entries.pop(key, None)
+            if text is not None:
+                self._size -= len(text.encode("utf-8"))
+        return text
+
+    def stats(self) -> tuple[int, int]:
+        """(件数, 合計バイト数)"""
+        with self._lock:
+            return len(self._entries), self._size
+
+
+@st.cache_resource
+def _ai_text_cache() -> _AITextCache:
+    """secrets の ai_text_cache_mb（既定 32MB）で調整。"""
+    return _AITextCache(int(float(st.secrets.get("ai_text_cache_mb", 32)) * 1024 * 1024))
+
+
+def _card_state_bytes(state: dict) -> int:
+    return sum(len(v.encode("utf-8")) for v in state.values() if isinstance(v, str))
+
+
+class _CardStateStore:
+    """カードごとの画面状態（AI解説の結果・メモ・メモ欄の版数）を持つセッション内の LRU。
+
+    カードごとに session_state のキーを増やすと長いセッションで際限なく溜まるため、
+    1つの OrderedDict にまとめ、max_cards 枚か max_bytes を超えたら最後に触れてから
+    最も時間のたったカードを捨てる。捨てるカードの AI 解説と未保存のメモは
+    共有の AI テキストキャッシュへ退避し、同じカードに戻ったときに取り戻す。
+    """
+
+    def __init__(self, max_cards: int, max_bytes: int, owner: str):
+        self.max_cards = max_cards
+        self.max_bytes = max_bytes
+        self.owner = owner
+        self._cards = OrderedDict()  # (deck_url, front) -> 状態 dict
+        self.evicted = 0
+        self.restored = 0
+
+    def _spill_key(self, key: tuple, field: str) -> tuple:
+        return (self.owner, *key, field)
+
+    def card(self, item: dict) -> dict:
+        """カードの状態を返す（無ければ作る）。返した dict はそのまま書き換えてよい。"""
+        key = _card_key(item)
+        state = self._cards.get(key)
+        if state is not None:
+            self._cards.move_to_end(key)
+            # 前回の表示で書き込まれた AI 解説の分もここで上限に収める
+            self._trim()
+            return state
+        state = {"notes": item.get("notes", ""), "notes_counter": 0}
+        cache = _ai_text_cache()
+        for field in CARD_STATE_SPILL_FIELDS:
+            text = cache.pop(self._spill_key(key, field))
+            if text is not None:
+                state[field] = text
+                if field == "notes":
+                    state["notes_unsaved"] = True
+                self.restored += 1
+        self._cards[key] = state
+        self._trim()
+        return state
+
+    def _trim(self):
+        total = self.nbytes()
+        # いま表示中のカード（末尾）は捨てない
+        while len(self._cards) > 1 and (len(self._cards) > self.max_cards or total > self.max_bytes):
+            key, state = self._cards.popitem(last=False)
+            total -= _card_state_bytes(state)
+            self.evicted += 1
+            for field in CARD_STATE_SPILL_FIELDS:
+                if field == "notes" and not state.get("notes_unsaved"):
+                    continue  # シートに保存済みのメモは次に読み込むときにデッキから戻る
+                if state.get(field):
+                    _ai_text_cache().put(self._spill_key(key, field), state[field])
+
+    def nbytes(self) -> int:
+        return sum(_card_state_bytes(state) for state in self._cards.values())
+
+    def __len__(self) -> int:
+        return len(self._cards)
+
+
+def _card_state() -> _CardStateStore:
+    """現在のセッション・ユーザーのカード状態ストア。
+
+    secrets の card_state_max_cards（既定 50枚）/ card_state_max_kb（既定 512KB）で調整。
+    """
+    user_id = current_user_id()
+    store = st.session_state.get("card_state")
+    if store is None or store.owner != user_id:
+        store = _CardStateStore(
+            max_cards=int(st.secrets.get("card_state_max_cards", 50)),
+            max_bytes=int(float(st.secrets.get("card_state_max_kb", 512)) * 1024),
+            owner=user_id,
+        )
+        st.session_state.card_state = store
+    return store
+
+
 
 
 
-def get_current_sheet_title() -> str:
+def get_current_sheet_title(url: str | None = None) -> str:
     """現在のスプレッドシートのタイトル（ファイル名）を取得する"""
-    if "current_sheet_title" in st.session_state:
-        return st.session_state.current_sheet_title
+    url = url or st.session_state.get("current_deck_url") or st.secrets.get("spreadsheet_url")
+    titles = st.session_state.setdefault("sheet_titles", {})
+    if url in titles:
+        return titles[url]
     
     try:
-        url = st.session_state.get("current_deck_url") or st.secrets.get("spreadsheet_url")
         if not url:
             return "専門分野"
-        scope = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
-        creds_dict = dict(st.secrets["gcp_service_account"])
-        creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
-        client = gspread.authorize(creds)
-        sh = client.open_by_url(url)
-        st.session_state.current_sheet_title = sh.title
+        if is_local_deck(url):
+            titles[url] = os.path.splitext(os.path.basename(_local_deck_path(url).rstrip("/")))[0]
+            return titles[url]
+        sh = _open_spreadsheet(url, "get_current_sheet_title", readonly=True)
+        titles[url] = sh.title
         return sh.title
     except Exception:
         return "専門分野"
@@ -893,7 +3807,7 @@ def ai_generate_new_quiz(mode: str, question_item: dict, target_sheet_name: str)
 
     try:
         # クイズ生成は構造化JSONデータなので途切れないように固定で1000を指定
-        resp = _call_gemini(prompt, api_key, max_tokens=1000)
+        resp = _call_gemini(prompt, api_key, max_tokens=1000, priority=GEMINI_PRIORITY_GENERATION)
         # Markdownのコードブロックや余計な会話文を取り除き、最初の'{'から最後の'}'までを抽出
         match = re.search(r'\{.*\}', resp, re.DOTALL)
         if match:
@@ -909,19 +3823,29 @@ def ai_generate_new_quiz(mode: str, question_item: dict, target_sheet_name: str)
         st.error(f"問題生成に失敗しました: {e}")
         return None
 
-def append_quiz_to_sheet(quiz_data: dict) -> bool:
+def append_quiz_to_sheet(quiz_data: dict, url: str | None = None) -> bool:
     try:
-        url = st.session_state.get("current_deck_url") or st.secrets.get("spreadsheet_url")
+        url = url or st.session_state.get("current_deck_url") or st.secrets.get("spreadsheet_url")
         if not url:
             return False
-            
-        scope = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
-        creds_dict = dict(st.secrets["gcp_service_account"])
-        creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
-        client = gspread.authorize(creds)
-        sh = client.open_by_url(url)
-        worksheet = sh.sheet1
-        
+        if is_local_deck(url):
+            st.warning("ローカルファイルのデッキには追記できません。生成した問題は今回のセッションでのみ出題されます。")
+            return False
+
+        # secrets の block_near_duplicates が有効なら、既存の問題とほぼ同じものは追記しない
+        if st.secrets.get("block_near_duplicates", False):
+            threshold = float(st.secrets.get("near_duplicate_threshold", NEAR_DUPLICATE_THRESHOLD))
+            index = _near_duplicate_indexes().get(url, load_data_by_url(url))
+            matches = index.similar(quiz_data["question"], quiz_data["correct"], threshold)
+            if matches:
+                similarity, item = matches[0]
+                st.warning(f"よく似た問題がすでにあるため追加しませんでした（類似度 {similarity:.0%}）: {item['front']}")
+                return False
+
+        sh = _open_spreadsheet(url, "append_quiz_to_sheet")
+        worksheet = sheets_read("append_quiz_to_sheet", sh.get_worksheet, 0)
+
+
         # A, B, C, D, E列に追記
         row_data = [
             quiz_data["question"],
@@ -932,13 +3856,15 @@ def append_quiz_to_sheet(quiz_data: dict) -> bool:
             quiz_data.get("explanation", ""),
             quiz_data.get("hint", "")
         ]
-        worksheet.append_row(row_data)
-        
+        sheets_write("append_quiz_to_sheet", worksheet.append_row, row_data)
+
         # Google Sheetsへの追記後にキャッシュをクリアする
-        st.cache_data.clear()
+        clear_deck_cache(url)
         return True
     except Exception as e:
-        if "403" in str(e):
+        if _sheets_status(e) == 429:
+            st.error("Google Sheets の利用上限（1分あたりの書き込み回数）に達しました。1分ほど待ってからもう一度お試しください。")
+        elif "403" in str(e):
             client_email = st.secrets.get("gcp_service_account", {}).get("client_email", "不明")
             st.error(f"⚠️ スプレッドシートの権限エラー (403)\\n\\nこの機能を使うには、スプレッドシートの画面右上の「共有」ボタンから、以下のメールアドレスを「編集者」として追加してください：\\n\\n`{client_email}`")
         else:
@@ -949,13 +3875,33 @@ def append_quiz_to_sheet(quiz_data: dict) -> bool:
 
 
 
-def get_word_status(word: str) -> str | None:
-    """直近の学習結果を返す ('correct' / 'wrong' / None)。"""
+def _word_status_map() -> dict[str, str]:
+    """単語 -> 直近の正誤。履歴か集約が差し替えられたときだけ作り直す。
+
+    集約済みの単語は集約の最後の正誤から始め、それより新しい生履歴で上書きする。
+    """
     history = st.session_state.get("history", [])
-    for rec in reversed(history):
-        if rec["word"] == word:
-            return "correct" if rec["correct"] else "wrong"
-    return None
+    summary = st.session_state.setdefault("history_summary", {})
+    source = (len(history), id(summary))
+    if st.session_state.get("word_status_source") != source or "word_status" not in st.session_state:
+        status = {w: "correct" if s["last_correct"] else "wrong" for w, s in summary.items()}
+        for rec in history:
+            s = summary.get(rec["word"])
+            # LocalStorage に残っている集約前の古い記録で集約の結果を上書きしない
+            if s and rec.get("timestamp", "") < s["last_timestamp"]:
+                continue
+            status[rec["word"]] = "correct" if rec["correct"] else "wrong"
+        st.session_state.word_status = status
+        st.session_state.word_status_source = source
+    return st.session_state.word_status
+
+
+def get_word_status(word: str) -> str | None:
+    """直近の学習結果を返す ('correct' / 'wrong' / None)。
+
+    セッションの履歴は現在のユーザー分だけなので、他の学習者の記録は参照しない。
+    """
+    return _word_status_map().get(word)
 
 
 # ===================================================================
@@ -983,6 +3929,54 @@ def create_calendar_link(summary: str, description: str = "") -> str:
     return f"{base_url}?{query}"
 
 
+# ===================================================================
+# 操作トレースの記録（負荷試験用）
+# ===================================================================
+# secrets の trace_path を設定すると、学習者の操作（回答・めくり・カードのクリックなど）を
+# 1行1操作の JSON で追記する。loadtest.py がこれを複数セッションで再生する。
+class _TraceWriter:
+    """操作トレースの JSONL 追記（プロセス共有・スレッドセーフ）。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, event: dict):
+        line = json.dumps(event, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+@st.cache_resource
+def _trace_writer() -> _TraceWriter | None:
+    path = st.secrets.get("trace_path", "")
+    return _TraceWriter(path) if path else None
+
+
+def record_trace(action: str, **fields):
+    """操作を1件記録する（trace_path 未設定なら何もしない）。
+
+    記録するのは操作の種類と意味（正解したか等）だけで、カードの内容は含めない。
+    再生時は同じ意味の操作を、その時点の画面に合わせて選び直す。
+    """
+    try:
+        writer = _trace_writer()
+    except Exception:
+        return
+    if writer is None:
+        return
+    if "trace_session" not in st.session_state:
+        st.session_state.trace_session = os.urandom(6).hex()
+        st.session_state.trace_started = time.monotonic()
+    writer.write({
+        "session": st.session_state.trace_session,
+        "t": round(time.monotonic() - st.session_state.trace_started, 3),
+        "action": action,
+        **fields,
+    })
+
+
 # ===================================================================
 # セッションステート初期化
 # ===================================================================
@@ -1019,11 +4013,35 @@ def init_session_state():
                      time.sleep(1.0)
                 st.rerun()
 
-    # Google Sheetsからの履歴読み込み（バックアップとして結合、または初期ロード）
-    if st.session_state.history_loaded and not st.session_state.get("sheets_history_loaded", False):
+    # 履歴ストア(SQLite)からの読み込み（LocalStorageの履歴と結合）
+    if st.session_state.history_loaded and not st.session_state.get("store_history_loaded", False):
         try:
-            sheets_history = load_history_from_sheets()
-            if sheets_history:
+            # 複数デッキ学習時は各デッキ分を並列に読み込む（初回のみシートから取り込み）
+            user_id = current_user_id()
+            deck_urls = [
+                url for url in st.session_state.get("active_deck_urls")
+                or [st.session_state.get("current_deck_url") or st.secrets.get("spreadsheet_url")]
+                if url
+            ]
+
+            def load_one(url: str) -> tuple[list[dict], Exception | None]:
+                # st.warning はスクリプトのスレッドでしか表示されないので、エラーは呼び出し側で出す
+                try:
+                    return _query_store_history(url, user_id), None
+                except Exception as e:
+                    return [], e
+
+            with ThreadPoolExecutor(max_workers=max(1, min(8, len(deck_urls)))) as pool:
+                loaded = map_in_context(pool, load_one, deck_urls)
+            store_history = []
+            for url, (records, error) in zip(deck_urls, loaded):
+                if error is not None:
+                    st.warning(f"学習履歴を読み込めませんでした ({url}): {error}")
+                store_history.extend(records)
+            st.session_state.history_summary = _merge_history_summaries(
+                [load_history_summary_from_store(url, user_id) for url in deck_urls]
+            )
+            if store_history:
                 # 既存の履歴を (timestamp, word) のセットにして重複チェック
                 existing_keys = set()
                 for r in st.session_state.history:
@@ -1031,24 +4049,25 @@ def init_session_state():
                      ts = r.get("timestamp", "")
                      wd = r.get("word", "")
                      existing_keys.add((ts, wd))
-                
-                for rec in sheets_history:
+
+                for rec in store_history:
                     # 重複していなければ追加
                     ts = rec.get("timestamp", "")
                     wd = rec.get("word", "")
                     if (ts, wd) not in existing_keys:
                         st.session_state.history.append(rec)
                         existing_keys.add((ts, wd))
-                
+
                 # 並び替え（古い順->新しい順）
                 st.session_state.history.sort(key=lambda x: x.get("timestamp", ""))
-                
-            st.session_state.sheets_history_loaded = True
-            if sheets_history:
-                st.toast(f"シートから {len(sheets_history)} 件の履歴を統合しました", icon="📊")
+                # 並びが変わったので集計の差分更新は使えない
+                st.session_state.history_version = st.session_state.get("history_version", 0) + 1
+
+            st.session_state.store_history_loaded = True
+            if store_history:
+                st.toast(f"{len(store_history)} 件の履歴を統合しました", icon="📊")
         except Exception as e:
-            # st.error(f"DEBUG: Sheets Load Error: {e}") # 本番用は非表示
-            pass
+            st.warning(f"学習履歴の読み込みに失敗しました: {e}")
 
     if "initialized" not in st.session_state:
         st.session_state.initialized = True
@@ -1061,7 +4080,7 @@ def init_session_state():
         st.session_state.quiz_correct = False
         st.session_state.quiz_score = 0
         st.session_state.quiz_total = 0
-        st.session_state.quiz_pool = None
+        st.session_state.quiz_perm = None
         st.session_state.quiz_finished = False
         # マッチング用
         st.session_state.match_cards = []
@@ -1073,62 +4092,81 @@ def init_session_state():
         st.session_state.match_elapsed = 0
         st.session_state.match_attempts = 0
 
-    if "pending_history" not in st.session_state:
-        st.session_state.pending_history = []
-
+    if "unsynced_count" not in st.session_state:
+        st.session_state.unsynced_count = 0
 
-init_session_state()
 
+def filter_and_slice_data(data: list[dict], limit_str: str, filter_mastered: bool, mastered_rate: int = 20,
+                          difficulty_order: str = "ランダム") -> list[dict]:
+    """設定に基づいてデータをフィルタリングおよびスライスする。
 
-def filter_and_slice_data(data: list[dict], limit_str: str, filter_mastered: bool, mastered_rate: int = 20) -> list[dict]:
-    """設定に基づいてデータをフィルタリングおよびスライスする。"""
+    結果はセッション内で一貫性を保つため session_state にキャッシュし、設定が変わったときだけ作り直す。
+    スライスはデッキの並びのままで、出題順は各モードがシードから計算する。
+    difficulty_order が「やさしい順」「難しい順」のときは予想正答率で並べ、その並びのまま出題する。
+    """
     if not data:
         return []
+    # スライスの作り直し判定には非表示を除く前の件数を使う（1枚の非表示でシャッフルし直さない）
+    total_count = len(data)
 
-    # 0. 非表示フィルター
-    data = [d for d in data if not d.get("hidden", False)]
-    if not data:
-        return []
-
-    # 1. 習熟度フィルター
-    if filter_mastered:
-        # 正解履歴がないもの（未習熟）
-        unmastered = [d for d in data if get_word_status(d["front"]) != "correct"]
-        # 正解履歴があるもの（既習）
-        mastered = [d for d in data if get_word_status(d["front"]) == "correct"]
-        
-        # 既習問題から指定割合をランダムに混ぜる
-        num_mastered_to_include = max(1, len(mastered) * mastered_rate // 100) if mastered and mastered_rate > 0 else 0
-        sampled_mastered = random.sample(mastered, min(num_mastered_to_include, len(mastered)))
-        
-        filtered = unmastered + sampled_mastered
-    else:
-        filtered = list(data)
-    
-    # 2. ランダムシャッフル & スライス
-    # セッション内で一貫性を保つため、session_state にキャッシュする
-    
     # 現在の設定状況を表すキー
-    current_key = f"{st.session_state.get('current_deck_url')}_{limit_str}_{filter_mastered}_{mastered_rate}_len{len(data)}"
+    deck_key = "|".join(st.session_state.get("active_deck_urls") or [str(st.session_state.get("current_deck_url"))])
+    restrict = st.session_state.get("search_restrict")
+    if restrict:
+        deck_key += f"_search:{restrict['query']}"
+    current_key = f"{deck_key}_{limit_str}_{filter_mastered}_{mastered_rate}_{difficulty_order}_len{total_count}"
     
     # キャッシュがない、またはキーが変わった場合は再生成
     if "session_data_cache" not in st.session_state or st.session_state.get("session_cache_key") != current_key:
-        # シャッフル
-        random.shuffle(filtered)
-        
-        # スライス
+        st.session_state.session_seed = int(st.secrets.get("session_seed", 0)) or random.getrandbits(32)
+
+        # 0. 非表示フィルター
+        filtered = [d for d in data if not d.get("hidden", False)]
+
+        # 1. 習熟度フィルター
+        if filter_mastered:
+            status = _word_status_map()
+            # 正解履歴がないもの（未習熟）
+            unmastered = [d for d in filtered if status.get(d["front"]) != "correct"]
+            # 正解履歴があるもの（既習）
+            mastered = [d for d in filtered if status.get(d["front"]) == "correct"]
+
+            # 既習問題から指定割合をランダムに混ぜる
+            num_mastered_to_include = max(1, len(mastered) * mastered_rate // 100) if mastered and mastered_rate > 0 else 0
+            sampled_mastered = random.Random(_derive_seed("mastered")).sample(
+                mastered, min(num_mastered_to_include, len(mastered))
+            )
+            filtered = unmastered + sampled_mastered
+
+        # 2. スライス（並べ替えの先頭 limit 件だけを取り出す。全体はシャッフルしない）
+        limit = None
         if limit_str != "すべて":
             try:
                 limit = int(limit_str.replace("問", ""))
-                filtered = filtered[:limit]
             except ValueError:
                 pass
-        
+        st.session_state.session_fixed_order = difficulty_order in ("やさしい順", "難しい順")
+        if difficulty_order != "ランダム" and filtered:
+            probs = success_probabilities(filtered)
+            if st.session_state.session_fixed_order:
+                # 予想正答率の高い順（難しい順は低い順）。同じ値はデッキの並びのまま
+                order = np.argsort(-probs if difficulty_order == "やさしい順" else probs, kind="stable")
+            else:
+                # 正解しにくいカードほど選ばれやすい重み付き抽出（各カードに u^(1/重み) の鍵を振って大きい順）
+                rng = np.random.default_rng(_derive_seed("weighted"))
+                weights = np.maximum(1.0 - probs, 0.05)
+                order = np.argsort(-(rng.random(len(filtered)) ** (1.0 / weights)))
+            filtered = [filtered[i] for i in order[:limit]]
+        elif limit is not None:
+            pick = _SeededPermutation(len(filtered), _derive_seed("slice"))
+            filtered = [filtered[pick[i]] for i in range(min(limit, len(filtered)))]
+
         st.session_state.session_data_cache = filtered
+        st.session_state.session_data_keys = {_card_key(d) for d in filtered}
         st.session_state.session_cache_key = current_key
         
         # クイズ・フラッシュカードの状態もリセット（データが変わったため）
-        st.session_state.quiz_pool = None
+        st.session_state.quiz_perm = None
         
         if "next_forced_quiz" in st.session_state:
             fq = st.session_state.pop("next_forced_quiz")
@@ -1155,7 +4193,7 @@ def filter_and_slice_data(data: list[dict], limit_str: str, filter_mastered: boo
             
         st.session_state.fc_index = 0
         st.session_state.fc_flipped = False
-        st.session_state.fc_order = []
+        st.session_state.fc_perm = None
         
         st.session_state.match_finished = False
         st.session_state.match_cards = []
@@ -1166,47 +4204,108 @@ def filter_and_slice_data(data: list[dict], limit_str: str, filter_mastered: boo
 # ===================================================================
 # 4択クイズモード
 # ===================================================================
-def generate_quiz(data: list[dict]):
-    """新しいクイズ問題を生成する。"""
-    if len(data) < 4:
-        st.error("データが4件以上必要です。")
-        return
+QUIZ_LOOKAHEAD = 3  # 先に組み立てておく問題数
 
-    # プールがNoneなら補充（初回のみ、またはリセット後）
-    if st.session_state.quiz_pool is None and not st.session_state.quiz_finished:
-        st.session_state.quiz_pool = list(data)
-        random.shuffle(st.session_state.quiz_pool)
 
-    # 次の問題を取り出す
-    if st.session_state.quiz_pool:
-        question_item = st.session_state.quiz_pool.pop(0)
-    else:
-        # 全ての問題を解き終わった
-        st.session_state.quiz_finished = True
-        st.session_state.quiz_question = None
-        return
+def _sample_distractors(data: list[dict], question_item: dict, exclude_backs: list[str], needed: int) -> list[dict]:
+    """誤答候補を needed 件選ぶ。
 
+    ランダムな位置を引いて条件に合わなければ引き直すので、デッキの大きさに関係なく
+    ほぼ一定時間で終わる。小さいデッキで引き直しが続く場合だけ全件から選ぶ。
+    """
+    if needed <= 0:
+        return []
+    picked = {}
+    for _ in range(needed * 8):
+        i = random.randrange(len(data))
+        d = data[i]
+        if i in picked or d["front"] == question_item["front"] or d["back"] in exclude_backs or d.get("hidden"):
+            continue
+        picked[i] = d
+        if len(picked) == needed:
+            return list(picked.values())
+    wrong_pool = [d for d in data if d["front"] != question_item["front"] and d["back"] not in exclude_backs
+                  and not d.get("hidden")]
+    return random.sample(wrong_pool, min(needed, len(wrong_pool)))
+
+
+def _build_question(question_item: dict, data: list[dict]) -> dict:
+    """出題1問分（問題・シャッフル済み選択肢・色分けクラス・ヒント）を組み立てる。"""
     # スプレッドシートに固定の誤答が設定されているか確認
     fixed_wrongs = question_item.get("wrong_choices", [])
-    
+
     if len(fixed_wrongs) >= 3:
         # 固定の誤答をそのまま使用
         wrong_items_text = fixed_wrongs[:3]
     else:
         # 足りない分、または全てを従来通りランダムに生成
-        wrong_pool = [d for d in data if d["front"] != question_item["front"]]
         # 既に固定値がある場合はそれを除外対象にする（重複防止）
-        wrong_pool = [d for d in wrong_pool if d["back"] not in fixed_wrongs]
-        
-        needed = 3 - len(fixed_wrongs)
-        sampled = random.sample(wrong_pool, min(needed, len(wrong_pool)))
+        sampled = _sample_distractors(data, question_item, fixed_wrongs, 3 - len(fixed_wrongs))
         wrong_items_text = fixed_wrongs + [w["back"] for w in sampled]
 
     options = [question_item["back"]] + wrong_items_text
     random.shuffle(options)
 
-    st.session_state.quiz_question = question_item
-    st.session_state.quiz_options = options
+    word_status = get_word_status(question_item["front"])
+    status_class = ""
+    if word_status == "correct":
+        status_class = "history-correct"
+    elif word_status == "wrong":
+        status_class = "history-wrong"
+
+    return {
+        "item": question_item,
+        "options": options,
+        "status_class": status_class,
+        "hint": question_item.get("notes", ""),
+    }
+
+
+def _refill_quiz_pipeline(data: list[dict]):
+    """先読みバッファが QUIZ_LOOKAHEAD 問になるまで、出題順の続きから組み立てて補充する。"""
+    pipeline = st.session_state.setdefault("quiz_pipeline", deque())
+    perm = st.session_state.get("quiz_perm")
+    if perm is None:
+        return
+    while len(pipeline) < QUIZ_LOOKAHEAD and st.session_state.quiz_pos < len(data):
+        item = data[_order_index(perm, st.session_state.quiz_pos)]
+        st.session_state.quiz_pos += 1
+        if item.get("hidden"):
+            continue  # 出題待ちの間に非表示にされた
+        pipeline.append(_build_question(item, data))
+
+
+def generate_quiz(data: list[dict]):
+    """新しいクイズ問題を生成する（組み立て済みの先読みバッファから取り出す）。"""
+    if len(data) < 4:
+        st.error("データが4件以上必要です。")
+        return
+
+    # 出題順が無ければ作る（初回のみ、またはリセット後）。周回ごとにシードを変える
+    if st.session_state.get("quiz_perm") is None and not st.session_state.quiz_finished:
+        st.session_state.quiz_round = st.session_state.get("quiz_round", 0) + 1
+        st.session_state.quiz_perm = _session_order(len(data), "quiz", st.session_state.quiz_round)
+        st.session_state.quiz_pos = 0
+        st.session_state.quiz_pipeline = deque()
+
+    # 先読み済みの問題のうち、その後に非表示にされたものを除く（最大 QUIZ_LOOKAHEAD 件）
+    pipeline = st.session_state.setdefault("quiz_pipeline", deque())
+    if any(built["item"].get("hidden") for built in pipeline):
+        st.session_state.quiz_pipeline = deque(b for b in pipeline if not b["item"].get("hidden"))
+    _refill_quiz_pipeline(data)
+
+    # 次の問題を取り出す
+    pipeline = st.session_state.quiz_pipeline
+    if not pipeline:
+        # 全ての問題を解き終わった
+        st.session_state.quiz_finished = True
+        st.session_state.quiz_question = None
+        return
+    built = pipeline.popleft()
+
+    st.session_state.quiz_question = built["item"]
+    st.session_state.quiz_options = built["options"]
+    st.session_state.quiz_status_class = built["status_class"]
     st.session_state.quiz_answered = False
     st.session_state.quiz_correct = False
 
@@ -1245,7 +4344,7 @@ def quiz_mode(data: list[dict]):
             st.session_state.quiz_finished = False
             st.session_state.quiz_total = 0
             st.session_state.quiz_score = 0
-            st.session_state.quiz_pool = None
+            st.session_state.quiz_perm = None
             st.session_state.quiz_question = None
             st.rerun()
         return
@@ -1261,13 +4360,15 @@ def quiz_mode(data: list[dict]):
     if q is None:
         return
 
-    # 問題文の色分け
-    word_status = get_word_status(q["front"])
-    status_class = ""
-    if word_status == "correct":
-        status_class = "history-correct"
-    elif word_status == "wrong":
-        status_class = "history-wrong"
+    # 問題文の色分け（未回答時は組み立て時の値、回答後は最新の結果で）
+    status_class = st.session_state.get("quiz_status_class", "")
+    if st.session_state.quiz_answered:
+        word_status = get_word_status(q["front"])
+        status_class = ""
+        if word_status == "correct":
+            status_class = "history-correct"
+        elif word_status == "wrong":
+            status_class = "history-wrong"
 
     # スコア計算 (表示は回答後のみ)
     total = st.session_state.quiz_total
@@ -1282,11 +4383,24 @@ def quiz_mode(data: list[dict]):
             f'</div>',
             unsafe_allow_html=True,
         )
+        model = _difficulty_models().get(q.get("deck_url") or st.session_state.get("current_deck_url") or "",
+                                         wait=False)
+        if model is not None and q["front"] in model.difficulty:
+            st.caption(f"📊 予想正答率 {model.success_probability(q['front'], current_user_id()):.0%}（全員の学習履歴から）")
         # ヒントの表示 (Notes/7列目にヒントが格納されている想定)
         hint_text = q.get("notes", "")
         if hint_text:
             st.info(f"💡 ヒント: {hint_text}")
 
+        # 回答している間にAI解説を先読み（設定で有効な場合のみ）
+        pipeline = st.session_state.get("quiz_pipeline") or []
+        upcoming = pipeline[0] if pipeline else None
+        prefetch_ai_explanations(
+            q, st.session_state.quiz_options,
+            upcoming["item"] if upcoming else None,
+            upcoming["options"] if upcoming else None,
+        )
+
     # 回答済みなら結果表示
     if st.session_state.quiz_answered:
         # 画面トップへスクロール
@@ -1316,11 +4430,12 @@ def quiz_mode(data: list[dict]):
         c_next, c_hide = st.columns([2, 1])
         with c_next:
             if st.button("▶️ 次の問題", key="next_q", use_container_width=True, type="primary"):
+                record_trace("quiz_next")
                 generate_quiz(data)
                 st.rerun()
         with c_hide:
             if st.button("🗑️ 非表示", key="quiz_hide", use_container_width=True, help="この問題を非表示にして除外します"):
-                if save_hidden_to_sheet(q["front"]):
+                if save_hidden_to_sheet(q["front"], q.get("deck_url")):
                     st.success("非表示にしました")
                     time.sleep(1)
                     generate_quiz(data)
@@ -1345,6 +4460,9 @@ def quiz_mode(data: list[dict]):
             else:
                 st.text(f"・ {opt}")
 
+        # このカードの画面状態（AI解説の結果・メモ）
+        card = _card_state().card(q)
+
         # --- AI機能（メモ欄より上に配置） ---
         gemini_api_key = st.secrets.get("gemini_api_key", "")
         if GEMINI_AVAILABLE and gemini_api_key:
@@ -1357,10 +4475,11 @@ def quiz_mode(data: list[dict]):
             col_btn1, col_btn2 = st.columns(2)
             with col_btn1:
                 if st.button("🤖 AI解説", key=f"ai_gen_{q['front']}", use_container_width=True):
+                    record_trace("quiz_ai")
                     with st.spinner("AIが解説を生成中..."):
                         ai_text = ai_generate_notes(q["front"], q["back"], custom_prompt)
                     if ai_text:
-                        st.session_state[f"ai_result_{q['front']}"] = ai_text
+                        card["ai_result"] = ai_text
 
             with col_btn2:
                 if st.button("🔍 他も解説", key=f"ai_opts_{q['front']}", use_container_width=True):
@@ -1370,35 +4489,19 @@ def quiz_mode(data: list[dict]):
                             options=st.session_state.get("quiz_options", [])
                         )
                     if opts_text:
-                        st.session_state[f"ai_opts_result_{q['front']}"] = opts_text
+                        card["ai_opts_result"] = opts_text
 
         # 6. メモ・参考URL入力欄
         st.divider()
         st.markdown("####  📝 メモ・参考URLメモ")
         st.caption("調べた内容やURLをメモしておくと次回から表示されます。")
 
-        # メモのキャッシュキー
-        notes_cache_key = f"notes_{q['front']}"
-        ai_pending_key = f"ai_pending_{q['front']}"
-        kw_pending_key = f"kw_pending_{q['front']}"
-        notes_counter_key = f"notes_counter_{q['front']}"
-        if notes_counter_key not in st.session_state:
-            st.session_state[notes_counter_key] = 0
-
-        # ペンディングの適用
-        for pkey in [ai_pending_key, kw_pending_key]:
-            if pkey in st.session_state:
-                st.session_state[notes_cache_key] = st.session_state.pop(pkey)
-                st.session_state[notes_counter_key] += 1
-
-        if notes_cache_key not in st.session_state:
-            st.session_state[notes_cache_key] = q.get("notes", "")
-
-        notes_widget_key = f"notes_area_{q['front']}_{st.session_state[notes_counter_key]}"
+        # メモ欄は版数をキーに含め、AI解説をメモに採用したときに入力欄を作り直す
+        notes_widget_key = f"notes_area_{q['front']}_{card['notes_counter']}"
 
         notes_input = st.text_area(
             "メモ入力欄",
-            value=st.session_state[notes_cache_key],
+            value=card["notes"],
             height=120,
             key=notes_widget_key,
             label_visibility="collapsed",
@@ -1410,17 +4513,19 @@ def quiz_mode(data: list[dict]):
         col_save, col_adopt = st.columns(2)
         with col_save:
             if st.button("💾 メモを保存", key=f"save_notes_{q['front']}", use_container_width=True):
-                if save_notes_to_sheet(q["front"], notes_input):
-                    st.session_state[notes_cache_key] = notes_input
+                if save_notes_to_sheet(q["front"], notes_input, q.get("deck_url")):
+                    card["notes"] = notes_input
+                    card.pop("notes_unsaved", None)
                     st.success("メモを保存しました！")
                 else:
                     # シートが見つからなかった場合はセッションのみ保存
-                    st.session_state[notes_cache_key] = notes_input
+                    card["notes"] = notes_input
+                    card["notes_unsaved"] = True
                     st.warning("シートへの保存は失敗しましたが、セッション内に保持しています。")
         with col_adopt:
             if st.button("📝 解説として採用 (列６に追記)", key=f"adopt_expl_{q['front']}", use_container_width=True):
                 if notes_input.strip():
-                    if save_explanation_to_sheet(q["front"], notes_input):
+                    if save_explanation_to_sheet(q["front"], notes_input, q.get("deck_url")):
                         st.success("解説として追記しました！")
                     else:
                         st.error("解説の保存に失敗しました。")
@@ -1432,9 +4537,9 @@ def quiz_mode(data: list[dict]):
         # --- AI結果表示セクション ---
         if GEMINI_AVAILABLE and gemini_api_key:
             # 定義：各結果に対して保存ボタンを表示するヘルパー（関数内関数）
-            def show_result_with_save_buttons(result_key, title, icon, color_type="info"):
-                if result_key in st.session_state:
-                    content = st.session_state[result_key]
+            def show_result_with_save_buttons(field, title, icon, color_type="info"):
+                if field in card:
+                    content = card[field]
                     if color_type == "info":
                         st.info(f"{icon} {title}:\n\n{content}")
                     elif color_type == "success":
@@ -1442,21 +4547,22 @@ def quiz_mode(data: list[dict]):
                     
                     c1, c2 = st.columns(2)
                     with c1:
-                        if st.button("💾 メモとして保存", key=f"save_n_{result_key}_{q['front']}", use_container_width=True):
-                            if save_notes_to_sheet(q["front"], content):
-                                st.session_state[notes_cache_key] = content
+                        if st.button("💾 メモとして保存", key=f"save_n_{field}_{q['front']}", use_container_width=True):
+                            if save_notes_to_sheet(q["front"], content, q.get("deck_url")):
+                                card["notes"] = content
+                                card.pop("notes_unsaved", None)
                                 # 本体のメモ入力欄ウィジェットを更新するためにカウンターを上げる
-                                st.session_state[notes_counter_key] += 1
-                                del st.session_state[result_key]
+                                card["notes_counter"] += 1
+                                del card[field]
                                 st.toast("メモを保存しました！", icon="✅")
                                 time.sleep(0.5)
                                 st.rerun()
                             else:
                                 st.error("シートへの保存に失敗しました。")
                     with c2:
-                        if st.button("📝 解説欄(列6)に保存", key=f"save_e_{result_key}_{q['front']}", use_container_width=True):
-                            if save_explanation_to_sheet(q["front"], content):
-                                del st.session_state[result_key]
+                        if st.button("📝 解説欄(列6)に保存", key=f"save_e_{field}_{q['front']}", use_container_width=True):
+                            if save_explanation_to_sheet(q["front"], content, q.get("deck_url")):
+                                del card[field]
                                 st.toast("解説欄に保存しました！", icon="📝")
                                 time.sleep(0.5)
                                 st.rerun()
@@ -1464,10 +4570,10 @@ def quiz_mode(data: list[dict]):
                                 st.error("解説の保存に失敗しました。")
 
             # 1. AI解説の結果
-            show_result_with_save_buttons(f"ai_result_{q['front']}", "AI解説", "🤖")
+            show_result_with_save_buttons("ai_result", "AI解説", "🤖")
 
             # 2. 他の回答の解説の結果
-            show_result_with_save_buttons(f"ai_opts_result_{q['front']}", "選択肢の解説", "🔍", "success")
+            show_result_with_save_buttons("ai_opts_result", "選択肢の解説", "🔍", "success")
 
 
 
@@ -1480,23 +4586,21 @@ def quiz_mode(data: list[dict]):
             with c_f:
                 if st.button("👨‍🏫 ファインマン", help="説明を問う問題を作ります", use_container_width=True):
                     with st.spinner("生成中..."):
-                        sheet_title = get_current_sheet_title()
+                        sheet_title = get_current_sheet_title(q.get("deck_url"))
                         quiz_data = ai_generate_new_quiz("feynman", q, sheet_title)
-                        if quiz_data and append_quiz_to_sheet(quiz_data):
+                        if quiz_data and append_quiz_to_sheet(quiz_data, q.get("deck_url")):
                             st.success("登録しました！")
                             st.session_state.next_forced_quiz = quiz_data
-                            st.cache_data.clear()
                             time.sleep(1)
                             st.rerun()
             with c_c:
                 if st.button("👔 クライアント", help="例外や必要性を問う問題を作ります", use_container_width=True):
                     with st.spinner("生成中..."):
-                        sheet_title = get_current_sheet_title()
+                        sheet_title = get_current_sheet_title(q.get("deck_url"))
                         quiz_data = ai_generate_new_quiz("client", q, sheet_title)
-                        if quiz_data and append_quiz_to_sheet(quiz_data):
+                        if quiz_data and append_quiz_to_sheet(quiz_data, q.get("deck_url")):
                             st.success("登録しました！")
                             st.session_state.next_forced_quiz = quiz_data
-                            st.cache_data.clear()
                             time.sleep(1)
                             st.rerun()
 
@@ -1504,34 +4608,31 @@ def quiz_mode(data: list[dict]):
             with c1:
                 if st.button("⚔️ 反論処理", help="NOや疑念への切り返しを問う", use_container_width=True):
                     with st.spinner("生成中..."):
-                        sheet_title = get_current_sheet_title()
+                        sheet_title = get_current_sheet_title(q.get("deck_url"))
                         quiz_data = ai_generate_new_quiz("objection", q, sheet_title)
-                        if quiz_data and append_quiz_to_sheet(quiz_data):
+                        if quiz_data and append_quiz_to_sheet(quiz_data, q.get("deck_url")):
                             st.success("登録しました！")
                             st.session_state.next_forced_quiz = quiz_data
-                            st.cache_data.clear()
                             time.sleep(1)
                             st.rerun()
             with c2:
                 if st.button("🔄 コンテキスト", help="相手に応じた使い分けを問う", use_container_width=True):
                     with st.spinner("生成中..."):
-                        sheet_title = get_current_sheet_title()
+                        sheet_title = get_current_sheet_title(q.get("deck_url"))
                         quiz_data = ai_generate_new_quiz("context_switch", q, sheet_title)
-                        if quiz_data and append_quiz_to_sheet(quiz_data):
+                        if quiz_data and append_quiz_to_sheet(quiz_data, q.get("deck_url")):
                             st.success("登録しました！")
                             st.session_state.next_forced_quiz = quiz_data
-                            st.cache_data.clear()
                             time.sleep(1)
                             st.rerun()
             with c3:
                 if st.button("📉 失敗逆算", help="誤用や見落としのリスクを問う", use_container_width=True):
                     with st.spinner("生成中..."):
-                        sheet_title = get_current_sheet_title()
+                        sheet_title = get_current_sheet_title(q.get("deck_url"))
                         quiz_data = ai_generate_new_quiz("pre_mortem", q, sheet_title)
-                        if quiz_data and append_quiz_to_sheet(quiz_data):
+                        if quiz_data and append_quiz_to_sheet(quiz_data, q.get("deck_url")):
                             st.success("登録しました！")
                             st.session_state.next_forced_quiz = quiz_data
-                            st.cache_data.clear()
                             time.sleep(1)
                             st.rerun()
 
@@ -1563,12 +4664,15 @@ def quiz_mode(data: list[dict]):
         # 4択は gap を狭くする
         if st.button(option, key=f"opt_{i}", use_container_width=True):
             correct = option == q["back"]
+            record_trace("quiz_answer", correct=correct)
             st.session_state.quiz_answered = True
             st.session_state.quiz_correct = correct
             st.session_state.quiz_total += 1
             if correct:
                 st.session_state.quiz_score += 1
-            add_history_record(q["front"], correct)
+            add_history_record(q["front"], correct, q.get("deck_url", ""))
+            # 結果を見ている間に使う次の問題をここで補充しておく
+            _refill_quiz_pipeline(data)
             st.session_state._ls_counter += 1
             st.rerun()
     
@@ -1579,7 +4683,7 @@ def quiz_mode(data: list[dict]):
         st.session_state.quiz_finished = False
         st.session_state.quiz_total = 0
         st.session_state.quiz_score = 0
-        st.session_state.quiz_pool = None
+        st.session_state.quiz_perm = None
         st.session_state.quiz_question = None
         st.success("学習内容を保存しました。最初の画面に戻ります。")
         time.sleep(1)
@@ -1593,27 +4697,38 @@ def init_matching_game(data: list[dict], num_pairs: int = 8):
     """マッチングゲームを初期化する。"""
     st.session_state.match_cleared_pairs = st.session_state.get("match_cleared_pairs", set())
     
-    # 候補データの抽出（習熟度フィルタ済みデータから、さらにクリア済みを除外）
-    available_data = [d for d in data if d['front'] not in st.session_state.match_cleared_pairs]
-    
-    if len(available_data) < num_pairs:
+    # 候補をゲームごとのシードの並べ替え順に見て、必要なペア数だけ取る
+    # （クリア済み・非表示を除き、複数デッキで同じ表面が重なるとペア判定が曖昧になるため表面で一意にする）
+    st.session_state.match_round = st.session_state.get("match_round", 0) + 1
+    seed = _derive_seed("match", st.session_state.match_round)
+    perm = _SeededPermutation(len(data), seed)
+    picked = {}
+    for position in range(len(data)):
+        d = data[perm[position]]
+        if d.get("hidden") or d["front"] in st.session_state.match_cleared_pairs or d["front"] in picked:
+            continue
+        picked[d["front"]] = d
+        if len(picked) == num_pairs:
+            break
+
+    if len(picked) < num_pairs:
         # 足りない場合
         if len(data) >= num_pairs:
             # 元データなら足りる -> リセット提案
-            st.warning(f"未クリアのペアが足りません（残り{len(available_data)}ペア）。リセットしてください。")
+            st.warning(f"未クリアのペアが足りません（残り{len(picked)}ペア）。リセットしてください。")
             return
         else:
             # 元データ自体が足りない
             st.error(f"マッチングゲームには{num_pairs}件以上のデータが必要です。")
             return
 
-    pairs = random.sample(available_data, num_pairs)
     cards = []
-    for p in pairs:
-        cards.append({"id": f"f_{p['front']}", "text": p["front"], "pair_key": p["front"], "side": "front"})
-        cards.append({"id": f"b_{p['front']}", "text": p["back"], "pair_key": p["front"], "side": "back"})
+    for p in picked.values():
+        deck_url = p.get("deck_url", "")
+        cards.append({"id": f"f_{p['front']}", "text": p["front"], "pair_key": p["front"], "side": "front", "deck_url": deck_url})
+        cards.append({"id": f"b_{p['front']}", "text": p["back"], "pair_key": p["front"], "side": "back", "deck_url": deck_url})
 
-    random.shuffle(cards)
+    random.Random(seed).shuffle(cards)
 
     st.session_state.match_cards = cards
     st.session_state.match_revealed = [False] * (num_pairs * 2)
@@ -1635,6 +4750,7 @@ def matching_game(data: list[dict], num_pairs: int = 8):
     col_a, col_b = st.columns(2)
     with col_a:
         if st.button("🔄 新しいゲーム", key="new_match", use_container_width=True):
+            record_trace("match_new")
             init_matching_game(data, num_pairs)
             st.rerun()
     with col_b:
@@ -1697,6 +4813,7 @@ def matching_game(data: list[dict], num_pairs: int = 8):
         
         # 次へボタン
         if st.button("➡️ 次のゲームへ", key="next_match_btn", type="primary", use_container_width=True):
+            record_trace("match_new")
             # 今回クリアしたペアを記録
             current_pairs = {card['pair_key'] for card in st.session_state.match_cards}
             st.session_state.match_cleared_pairs = st.session_state.get("match_cleared_pairs", set()) | current_pairs
@@ -1751,6 +4868,7 @@ def matching_game(data: list[dict], num_pairs: int = 8):
                 else:
                     # 裏向き
                     if st.button("❓", key=f"m_{idx}", use_container_width=True):
+                        record_trace("match_click")
                         handle_card_click(idx)
                         st.rerun()
 
@@ -1783,20 +4901,380 @@ def handle_card_click(idx: int):
             matched.add(first_idx)
             matched.add(idx)
             st.session_state.match_matched = matched
-            add_history_record(first_card["pair_key"], True)
+            add_history_record(first_card["pair_key"], True, first_card.get("deck_url", ""))
         else:
             # ペア不成立 → 両方裏に戻す
             revealed[first_idx] = False
             revealed[idx] = False
             if first_card["pair_key"] != second_card["pair_key"]:
-                add_history_record(first_card["pair_key"], False)
-                add_history_record(second_card["pair_key"], False)
+                add_history_records([
+                    (first_card["pair_key"], False, first_card.get("deck_url", "")),
+                    (second_card["pair_key"], False, second_card.get("deck_url", "")),
+                ])
 
         st.session_state.match_first = None
         st.session_state.match_revealed = revealed
         st.session_state._ls_counter += 1
 
 
+# ===================================================================
+# 学習履歴の集計（列指向・NumPy）
+# ===================================================================
+HISTORY_TZ_OFFSET = 9 * 3600  # 日別集計は日本時間の日付で区切る
+
+
+class _HistoryColumns:
+    """学習履歴を列（単語ID・時刻・正誤）で持ち、集計をベクトル演算で行う。
+
+    履歴の末尾に追加された分だけを取り込む。配列は容量を倍々に確保し、追加のたびにコピーしない。
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.words = []          # 単語ID -> 単語
+        self._word_ids = {}
+        self._word = np.zeros(1024, dtype=np.int32)
+        self._epoch = np.zeros(1024, dtype=np.int64)  # 秒
+        self._correct = np.zeros(1024, dtype=bool)
+        self._results = {}       # 集計結果のキャッシュ（件数が変わったら捨てる）
+
+    def append(self, records: list[dict]):
+        if not records:
+            return
+        need = self.n + len(records)
+        if need > len(self._word):
+            capacity = max(need, len(self._word) * 2)
+            for name in ("_word", "_epoch", "_correct"):
+                grown = np.zeros(capacity, dtype=getattr(self, name).dtype)
+                grown[:self.n] = getattr(self, name)[:self.n]
+                setattr(self, name, grown)
+        ids = []
+        for rec in records:
+            word = rec.get("word", "")
+            word_id = self._word_ids.get(word)
+            if word_id is None:
+                word_id = self._word_ids[word] = len(self.words)
+                self.words.append(word)
+            ids.append(word_id)
+        end = self.n + len(records)
+        self._word[self.n:end] = ids
+        self._epoch[self.n:end] = [int(_timestamp_to_epoch(rec.get("timestamp", ""))) for rec in records]
+        self._correct[self.n:end] = [bool(rec.get("correct")) for rec in records]
+        self.n = end
+        self._results = {}
+
+    def _columns(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """時刻順に並べた (単語ID, 時刻, 正誤)。追加順が時刻順なら並べ替えない。"""
+        if "columns" not in self._results:
+            word, epoch, correct = self._word[:self.n], self._epoch[:self.n], self._correct[:self.n]
+            if self.n > 1 and np.any(epoch[1:] < epoch[:-1]):
+                order = np.argsort(epoch, kind="stable")
+                word, epoch, correct = word[order], epoch[order], correct[order]
+            self._results["columns"] = (word, epoch, correct)
+        return self._results["columns"]
+
+    def totals(self) -> tuple[int, int]:
+        """(回答数, 正解数)"""
+        return self.n, int(self._correct[:self.n].sum())
+
+    def daily(self) -> dict:
+        """日別の回答数・正答率（回答のあった日だけ）。"""
+        if "daily" not in self._results:
+            _word, epoch, correct = self._columns()
+            valid = epoch > 0
+            days = (epoch[valid] + HISTORY_TZ_OFFSET) // 86400
+            if days.size == 0:
+                self._results["daily"] = {"日付": [], "回答数": [], "正答率 (%)": []}
+            else:
+                first = days.min()
+                attempts = np.bincount(days - first)
+                corrects = np.bincount(days - first, weights=correct[valid])
+                active = np.nonzero(attempts)[0]
+                self._results["daily"] = {
+                    "日付": [datetime.fromtimestamp(int(d + first) * 86400, timezone.utc).date() for d in active],
+                    "回答数": attempts[active].tolist(),
+                    "正答率 (%)": np.round(corrects[active] / attempts[active] * 100, 1).tolist(),
+                }
+        return self._results["daily"]
+
+    def per_word(self) -> dict[str, np.ndarray]:
+        """単語IDごとの回答数・正解数・正答率・直近の正誤・連続記録（正=連続正解, 負=連続不正解）。"""
+        if "per_word" not in self._results:
+            word, _epoch, correct = self._columns()
+            count = len(self.words)
+            attempts = np.bincount(word, minlength=count)
+            corrects = np.bincount(word, weights=correct, minlength=count).astype(np.int64)
+
+            # 並べ替えを避け、単語ごとの「最後の回答」と「最後に結果が変わった位置」を ufunc.at で求める
+            position = np.arange(word.size)
+            last = np.full(count, -1)
+            np.maximum.at(last, word, position)
+            last_correct = np.zeros(count, dtype=bool)
+            answered = last >= 0
+            last_correct[answered] = correct[last[answered]]
+            changed = np.full(count, -1)
+            np.maximum.at(changed, word, np.where(correct != last_correct[word], position, -1))
+            # 最後に結果が変わった位置より後の回答数 = 末尾の連続記録
+            run = np.bincount(word, weights=position > changed[word], minlength=count).astype(np.int64)
+            streak = np.where(last_correct, run, -run)
+
+            with np.errstate(invalid="ignore", divide="ignore"):
+                accuracy = np.where(attempts > 0, corrects / attempts, np.nan)
+            self._results["per_word"] = {
+                "attempts": attempts, "corrects": corrects, "accuracy": accuracy,
+                "last_correct": last_correct, "streak": streak,
+            }
+        return self._results["per_word"]
+
+    def weakest(self, n: int = 10, min_attempts: int = 2) -> list[dict]:
+        """正答率の低い順（同率なら回答数の多い順）に n 語。"""
+        stats = self.per_word()
+        candidates = np.nonzero(stats["attempts"] >= min_attempts)[0]
+        if candidates.size == 0:
+            return []
+        order = np.lexsort((-stats["attempts"][candidates], stats["accuracy"][candidates]))[:n]
+        return [
+            {
+                "単語": self.words[i],
+                "正答率 (%)": round(float(stats["accuracy"][i]) * 100, 1),
+                "回答数": int(stats["attempts"][i]),
+                "連続": int(stats["streak"][i]),
+                "直近": "⭕" if stats["last_correct"][i] else "❌",
+            }
+            for i in candidates[order]
+        ]
+
+
+def history_analytics() -> _HistoryColumns:
+    """セッションの履歴の列データ。追加分だけ取り込み、差し替え・並べ替えがあれば作り直す。"""
+    history = st.session_state.get("history", [])
+    source = (id(history), st.session_state.get("history_version", 0))
+    columns = st.session_state.get("history_columns")
+    if columns is None or st.session_state.get("history_columns_source") != source or columns.n > len(history):
+        columns = _HistoryColumns()
+        st.session_state.history_columns = columns
+        st.session_state.history_columns_source = source
+    if columns.n < len(history):
+        columns.append(history[columns.n:])
+    return columns
+
+
+# ===================================================================
+# カードの難易度（全学習者の履歴から推定）
+# ===================================================================
+# 正解の確率を sigmoid(全体の基準 + 学習者の実力 - カードの難しさ) とするモデル（Rasch / Elo と同じ形）を、
+# デッキの全ユーザーの (ユーザー, 単語) ごとの回答数・正解数にまとめて当てはめる。
+# 推定はデッキの読み込み・定期更新と一緒にバックグラウンドで行い、結果はデッキURLごとに保持する。
+# 出題時は辞書を引くだけ（1枚あたり O(1)）。
+DIFFICULTY_ORDERS = ["ランダム", "苦手そうな問題を優先", "やさしい順", "難しい順"]
+
+
+def fit_card_difficulty(users: np.ndarray, cards: np.ndarray, attempts: np.ndarray, corrects: np.ndarray,
+                        l2: float = 1.0, iterations: int = 100, tol: float = 1e-4, max_step: float = 1.0) -> tuple[float, np.ndarray, np.ndarray]:
+    """(基準, 学習者の実力[ユーザーID], カードの難しさ[カードID]) を返す。
+
+    users / cards は 0 始まりのID、attempts / corrects は同じ長さの回答数・正解数。
+    実力・難しさ・基準の順に1ブロックずつ Newton 法で更新する（各ブロックは bincount でまとめて計算）。
+    ロジスティック回帰の Newton 法は遠くから始めると行き過ぎるので、1回の更新幅は max_step までに抑える。
+    実力と難しさには L2 正則化をかけ、回答の少ないユーザー・カードは 0（平均的）に寄せる。
+    """
+    n_users = int(users.max()) + 1 if users.size else 0
+    n_cards = int(cards.max()) + 1 if cards.size else 0
+    theta = np.zeros(n_users)
+    b = np.zeros(n_cards)
+    attempts = attempts.astype(float)
+    corrects = corrects.astype(float)
+    total = attempts.sum()
+    rate = np.clip(corrects.sum() / total, 0.01, 0.99) if total else 0.5
+    mu = float(np.log(rate / (1 - rate)))
+
+    def moments():
+        p = 1.0 / (1.0 + np.exp(-(mu + theta[users] - b[cards])))
+        return corrects - attempts * p, attempts * p * (1 - p)
+
+    for _ in range(iterations):
+        resid, weight = moments()
+        step_theta = (np.bincount(users, resid, n_users) - l2 * theta) / (np.bincount(users, weight, n_users) + l2)
+        step_theta = np.clip(step_theta, -max_step, max_step)
+        theta += step_theta
+        resid, weight = moments()
+        step_b = (-np.bincount(cards, resid, n_cards) - l2 * b) / (np.bincount(cards, weight, n_cards) + l2)
+        step_b = np.clip(step_b, -max_step, max_step)
+        b += step_b
+        resid, weight = moments()
+        step_mu = float(np.clip(resid.sum() / max(weight.sum(), 1e-9), -max_step, max_step))
+        mu += step_mu
+        # 実力・難しさの平均を基準に寄せる（予測は変わらず、基準と両者が同じ向きにずれ続けるのを防ぐ）
+        shift = theta.mean() if n_users else 0.0
+        theta -= shift
+        mu += shift
+        shift = b.mean() if n_cards else 0.0
+        b -= shift
+        mu -= shift
+        largest = max(np.abs(step_theta).max(initial=0.0), np.abs(step_b).max(initial=0.0), abs(step_mu))
+        if largest < tol:
+            break
+    return mu, theta, b
+
+
+class _DifficultyModel:
+    """1デッキ分の推定結果。単語・ユーザーから辞書で引く。"""
+
+    def __init__(self, rows: list[tuple[str, str, int, int]]):
+        self.fitted_at = time.time()
+        self.responses = sum(r[2] for r in rows)
+        user_ids, word_ids = {}, {}
+        users = np.fromiter((user_ids.setdefault(r[0], len(user_ids)) for r in rows), dtype=np.int64, count=len(rows))
+        cards = np.fromiter((word_ids.setdefault(r[1], len(word_ids)) for r in rows), dtype=np.int64, count=len(rows))
+        attempts = np.fromiter((r[2] for r in rows), dtype=np.int64, count=len(rows))
+        corrects = np.fromiter((r[3] for r in rows), dtype=np.int64, count=len(rows))
+        started = time.perf_counter()
+        self.base, theta, b = fit_card_difficulty(users, cards, attempts, corrects)
+        self.fit_seconds = time.perf_counter() - started
+        self.ability = dict(zip(user_ids, theta.tolist()))
+        self.difficulty = dict(zip(word_ids, b.tolist()))
+
+    def success_probability(self, word: str, user_id: str = "") -> float:
+        """このユーザーがこのカードに正解する予想確率（履歴の無いカード・ユーザーは平均として扱う）。"""
+        logit = self.base + self.ability.get(user_id, 0.0) - self.difficulty.get(word, 0.0)
+        return 1.0 / (1.0 + np.exp(-logit))
+
+
+class _DifficultyRegistry:
+    """デッキURLごとの難易度モデル（プロセス共有）。max_age 秒より古いものは refresh で推定し直す。
+
+    推定に失敗したデッキは retry_after 秒から倍々（最長 max_age 秒）に間を空けてから推定し直す。
+    """
+
+    def __init__(self, max_age: float, retry_after: float = 60.0):
+        self.max_age = max_age
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._models = {}
+        self._fitting = set()  # バックグラウンドで推定中のデッキ
+        self._failures = {}    # url -> (最後に失敗した時刻, 連続失敗回数)
+        self._errors = {}
+
+    def errors(self) -> dict[str, str]:
+        """デッキごとの直近の推定エラー（写し）。"""
+        with self._lock:
+            return dict(self._errors)
+
+    def _backing_off(self, url: str) -> bool:
+        failure = self._failures.get(url)
+        if failure is None:
+            return False
+        failed_at, count = failure
+        return time.time() - failed_at < min(self.retry_after * 2 ** (count - 1), self.max_age)
+
+    def _fit(self, url: str) -> _DifficultyModel | None:
+        try:
+            model = _DifficultyModel(_history_store().card_counts(url))
+        except Exception as e:
+            with self._lock:
+                self._errors[url] = str(e)
+                self._failures[url] = (time.time(), self._failures.get(url, (0.0, 0))[1] + 1)
+            return None
+        with self._lock:
+            self._errors.pop(url, None)
+            self._failures.pop(url, None)
+            self._models[url] = model
+        return model
+
+    def _fit_in_background(self, url: str):
+        try:
+            self._fit(url)
+        finally:
+            with self._lock:
+                self._fitting.discard(url)
+
+    def get(self, url: str, wait: bool = True) -> _DifficultyModel | None:
+        """推定済みのモデル。まだ無ければ推定する（最初の1回だけ）。
+
+        wait=False なら推定をバックグラウンドで始めて None を返す（描画のたびに呼ぶところ向け）。
+        """
+        with self._lock:
+            model = self._models.get(url)
+            if model is not None or self._backing_off(url):
+                return model
+            if not wait:
+                if url not in self._fitting:
+                    self._fitting.add(url)
+                    threading.Thread(target=self._fit_in_background, args=(url,),
+                                     name="difficulty-fit", daemon=True).start()
+                return None
+        return self._fit(url)
+
+    def refresh(self, url: str):
+        with self._lock:
+            model = self._models.get(url)
+            if model is None and self._backing_off(url):
+                return
+        if model is None or time.time() - model.fitted_at >= self.max_age:
+            self._fit(url)
+
+    def stats(self) -> tuple[int, int, float]:
+        """(デッキ数, 推定に使った回答数, 推定時間の合計秒)"""
+        with self._lock:
+            models = list(self._models.values())
+        return len(models), sum(m.responses for m in models), sum(m.fit_seconds for m in models)
+
+
+@st.cache_resource
+def _difficulty_models() -> _DifficultyRegistry:
+    """secrets の difficulty_refit_interval（秒）ごとに、定期更新のついでに推定し直す。
+
+    推定に失敗したときは difficulty_retry_interval（秒、既定 60）から間を空けて推定し直す。
+    """
+    return _DifficultyRegistry(float(st.secrets.get("difficulty_refit_interval", 3600)),
+                               float(st.secrets.get("difficulty_retry_interval", 60)))
+
+
+def success_probabilities(items: list[dict]) -> np.ndarray:
+    """現在のユーザーが各カードに正解する予想確率（デッキごとのモデルを引く）。"""
+    default_url = st.session_state.get("current_deck_url") or ""
+    user_id = current_user_id()
+    registry = _difficulty_models()
+    models = {}
+    probs = np.empty(len(items))
+    for i, item in enumerate(items):
+        url = item.get("deck_url") or default_url
+        if url not in models:
+            models[url] = registry.get(url)
+        model = models[url]
+        probs[i] = model.success_probability(item["front"], user_id) if model is not None else 0.5
+    return probs
+
+
+class _FixedOrder:
+    """並べ替えない出題順（スライスの並びのまま）。_SeededPermutation と同じように使う。"""
+
+    __slots__ = ("n",)
+
+    def __init__(self, n: int):
+        self.n = n
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __getitem__(self, position: int) -> int:
+        if not 0 <= position < self.n:
+            raise IndexError(position)
+        return position
+
+    def index(self, value: int) -> int:
+        if not 0 <= value < self.n:
+            raise ValueError(value)
+        return value
+
+
+def _session_order(n: int, *parts):
+    """モードの出題順。難易度順のスライスはその並びのまま、それ以外はシードから並べ替える。"""
+    if st.session_state.get("session_fixed_order"):
+        return _FixedOrder(n)
+    return _SeededPermutation(n, _derive_seed(*parts))
+
+
 # ===================================================================
 # 学習履歴パネル
 # ===================================================================
@@ -1810,8 +5288,8 @@ def history_panel():
         return
 
     # 統計
-    total = len(history)
-    correct = sum(1 for h in history if h["correct"])
+    analytics = history_analytics()
+    total, correct = analytics.totals()
     wrong = total - correct
     rate = int(correct / total * 100) if total > 0 else 0
 
@@ -1819,6 +5297,26 @@ def history_panel():
     c1.metric("合計", f"{total}問")
     c2.metric("正解", f"{correct}問", delta=f"{rate}%")
     c3.metric("不正解", f"{wrong}問")
+    summary = st.session_state.get("history_summary") or {}
+    if summary:
+        summary_attempts = sum(s["attempts"] for s in summary.values())
+        summary_corrects = sum(s["corrects"] for s in summary.values())
+        st.caption(
+            f"📦 保存期間より前の履歴: {len(summary)}語 / {summary_attempts}回答 "
+            f"(正答率 {int(summary_corrects / summary_attempts * 100) if summary_attempts else 0}%)"
+        )
+
+    # 日別の推移
+    daily = analytics.daily()
+    if len(daily["日付"]) > 1:
+        st.caption("日別の正答率")
+        st.line_chart(daily, x="日付", y="正答率 (%)")
+
+    # 苦手な単語
+    weakest = analytics.weakest(10)
+    if weakest:
+        st.caption("苦手な単語（2回以上回答・正答率の低い順）")
+        st.dataframe(weakest, hide_index=True, use_container_width=True)
 
     st.divider()
 
@@ -1854,19 +5352,122 @@ def history_panel():
 
     # 履歴クリア
     if st.button("🗑️ 履歴をクリア", key="clear_hist", use_container_width=True):
-        st.session_state.history = []
+        clear_learning_history()
         save_history_to_ls([])
         st.session_state._ls_counter += 1
         st.rerun()
 
 
+# ===================================================================
+# 非表示の管理（まとめて非表示・表示に戻す）
+# ===================================================================
+HIDDEN_PANEL_LIMIT = 50  # 一度に候補として並べる問題の数
+
+
+def hidden_cards_panel(data: list[dict]):
+    """読み込んだデッキの問題をまとめて非表示にする／非表示の問題を戻す。
+
+    全問題の選択肢は作らず、キーワードに合う問題を HIDDEN_PANEL_LIMIT 件まで候補に出す
+    （非表示の問題はキーワードが無くても先頭から出す）。
+    """
+    def label(item: dict) -> str:
+        return f"{item['front']}（{item['deck']}）" if item.get("deck") else item["front"]
+
+    query = st.text_input("問題を絞り込む（表・裏）", key="bulk_hide_query",
+                          placeholder="キーワードを入力すると候補を表示します")
+    needle = query.strip().lower()
+
+    def matches(item: dict) -> bool:
+        return needle in item["front"].lower() or needle in str(item.get("back", "")).lower()
+
+    hidden, visible = [], []
+    hidden_count = 0
+    more = False
+    for item in data:
+        if item.get("hidden"):
+            hidden_count += 1
+            if not needle or matches(item):
+                if len(hidden) < HIDDEN_PANEL_LIMIT:
+                    hidden.append(item)
+                else:
+                    more = True
+        elif needle and matches(item):
+            if len(visible) < HIDDEN_PANEL_LIMIT:
+                visible.append(item)
+            else:
+                more = True
+    if more:
+        st.caption(f"候補は先頭 {HIDDEN_PANEL_LIMIT}件までです。キーワードを足して絞り込んでください。")
+
+    if needle:
+        to_hide = st.multiselect("非表示にする問題", range(len(visible)), format_func=lambda i: label(visible[i]),
+                                 key="bulk_hide_select")
+        if st.button("🗑️ まとめて非表示", key="bulk_hide", use_container_width=True, disabled=not to_hide):
+            done = save_hidden_many([visible[i] for i in to_hide])
+            st.session_state.pop("bulk_hide_select", None)
+            st.toast(f"{done}件を非表示にしました", icon="🗑️")
+            st.rerun()
+
+    st.caption(f"非表示の問題: {hidden_count}件")
+    if hidden:
+        to_unhide = st.multiselect("表示に戻す問題", range(len(hidden)), format_func=lambda i: label(hidden[i]),
+                                   key="bulk_unhide_select")
+        if st.button("↩️ まとめて表示に戻す", key="bulk_unhide", use_container_width=True, disabled=not to_unhide):
+            done = save_unhidden_many([hidden[i] for i in to_unhide])
+            st.session_state.pop("bulk_unhide_select", None)
+            st.toast(f"{done}件を表示に戻しました", icon="↩️")
+            st.rerun()
+
+
+# ===================================================================
+# 近似重複の確認（まとまりの一覧と、2件目以降の非表示）
+# ===================================================================
+NEAR_DUPLICATE_REPORT_LIMIT = 30  # 画面に並べるまとまりの数
+
+
+def near_duplicates_panel(data: list[dict]):
+    """表示中の問題から近似重複のまとまりを探し、各まとまりの2件目以降をまとめて非表示にできる。"""
+    threshold = st.slider("類似度のしきい値", 0.5, 1.0, step=0.05, key="near_dup_threshold",
+                          value=float(st.secrets.get("near_duplicate_threshold", NEAR_DUPLICATE_THRESHOLD)))
+    if st.button("🧬 近似重複を探す", key="near_dup_scan", use_container_width=True):
+        visible = [d for d in data if not d.get("hidden")]
+        started = time.perf_counter()
+        clusters = find_near_duplicates(visible, threshold)
+        st.session_state.near_dup_report = {
+            "clusters": clusters, "cards": len(visible), "seconds": time.perf_counter() - started,
+        }
+
+    report = st.session_state.get("near_dup_report")
+    if not report:
+        return
+    clusters = report["clusters"]
+    st.caption(f"{report['cards']}枚中 {len(clusters)}組・{sum(len(c) for c in clusters)}枚 ({report['seconds']:.2f}秒)")
+    for n, cluster in enumerate(clusters[:NEAR_DUPLICATE_REPORT_LIMIT], 1):
+        st.markdown(f"**{n}.** " + " ／ ".join(item["front"] for item in cluster))
+    if len(clusters) > NEAR_DUPLICATE_REPORT_LIMIT:
+        st.caption(f"ほか {len(clusters) - NEAR_DUPLICATE_REPORT_LIMIT}組")
+
+    extras = [item for cluster in clusters for item in cluster[1:]]
+    if st.button(f"🗑️ 各組の2件目以降（{len(extras)}件）を非表示", key="near_dup_hide",
+                 use_container_width=True, disabled=not extras):
+        done = save_hidden_many(extras)
+        st.session_state.pop("near_dup_report", None)
+        st.toast(f"{done}件を非表示にしました", icon="🗑️")
+        st.rerun()
+
+
 # ===================================================================
 # メイン
 # ===================================================================
 def main():
+    setup_page()
+
     # セッションと履歴の初期化
     init_session_state()
 
+    # 全デッキの事前読み込み（プロセスにつき1回・以後はバックグラウンドで定期更新）
+    warmup_stats = start_deck_warmup()
+
     # サイドバーで機能切り替え
     with st.sidebar:
         st.title("メニュー")
@@ -1891,13 +5492,36 @@ def main():
         options_keys.append("🔗 URL直接入力")
         deck_options["🔗 URL直接入力"] = "DIRECT_INPUT"
 
+        # 学習者（未入力ならこのブラウザ固有のIDで履歴を分ける）
+        st.text_input(
+            "👤 ユーザー名", key="user_login",
+            placeholder="未入力ならこのブラウザ専用のIDを使用",
+            help="履歴はユーザーごとに保存・集計されます",
+        )
+        if current_user_id():
+            st.caption(f"履歴の保存先: {current_user_id()}")
+
         # デッキ選択メニュー
         selected_deck_name = st.selectbox("問題集 (デッキ)", options_keys, key="deck_selector")
         
         if selected_deck_name == "🔗 URL直接入力":
-            selected_deck_url = st.text_input("スプレッドシートのURLを入力してください")
+            selected_deck_url = st.text_input("スプレッドシートのURLを入力してください").strip()
+            if (selected_deck_url and not selected_deck_url.startswith(("http://", "https://"))
+                    and not is_local_deck(selected_deck_url)):
+                st.error("スプレッドシートの URL（https://...）を入力してください。")
+                selected_deck_url = ""
         else:
             selected_deck_url = deck_options[selected_deck_name]
+
+        # 複数デッキをまとめて学習（登録済みデッキが2つ以上ある場合のみ）
+        merged_decks = {}
+        configured_names = [n for n in options_keys if n != "🔗 URL直接入力"]
+        if len(configured_names) >= 2:
+            if st.checkbox("📚 複数デッキをまとめて学習", key="multi_deck_enabled"):
+                merged_names = st.multiselect(
+                    "まとめるデッキ", configured_names, default=configured_names, key="multi_deck_names"
+                )
+                merged_decks = {n: deck_options[n] for n in merged_names}
         
         # サービスアカウント情報の表示（デバッグ用・権限設定用）
         # try:
@@ -1916,7 +5540,11 @@ def main():
         #     st.write("deck_options", deck_options)
         #     st.write("secrets.decks", st.secrets.get("decks", "Not Found"))
 
-        mode = st.radio("学習モード", ["4択クイズ", "フラッシュカード", "マッチングゲーム", "学習履歴"])
+        mode = st.radio("学習モード", ["4択クイズ", "フラッシュカード", "マッチングゲーム", "学習履歴", "検索"],
+                        key="learning_mode")
+        if st.session_state.get("trace_mode") != mode:
+            st.session_state.trace_mode = mode
+            record_trace("mode", value=mode)
         
         st.divider()
         st.caption("セッション設定")
@@ -1930,6 +5558,12 @@ def main():
         mastered_rate = 20
         if filter_mastered:
             mastered_rate = st.slider("既習問題の出現率 (%)", 0, 100, 20, step=5, help="正解済みの問題がどの程度の割合で混ざるかを設定します。0%にすると完全に出なくなります。")
+
+        # 難易度（全員の学習履歴から推定した予想正答率）で選ぶ・並べる
+        difficulty_order = st.selectbox(
+            "出題の選び方", DIFFICULTY_ORDERS,
+            help="全員の学習履歴から推定したカードの難しさと、あなたの正答傾向から予想正答率を求めて使います。",
+        )
         
         # マッチングゲーム設定
         # ここではシンプルに常時表示し、モード切り替え時に適用されるようにする
@@ -1947,29 +5581,140 @@ def main():
         with st.expander("🛠️ AI高度な設定"):
             st.slider("Temperature", 0.0, 1.0, 0.3, 0.1, key="ai_temperature", help="高いほど創造的、低いほど正確")
             st.number_input("Max Output Tokens", 100, 2048, 500, 50, key="ai_max_tokens", help="AI回答の最大文字数")
+            st.checkbox("🔮 AI解説を先読み", key="ai_prefetch_enabled",
+                        help="回答中に、この問題と次の問題のAI解説を裏で生成しておきます（API利用量が増えます）")
+
+        with st.expander("📈 パフォーマンス情報"):
+            if warmup_stats["seconds"] is None:
+                st.caption(f"🔥 デッキ事前読み込み中…（{warmup_stats['decks']}件）")
+            else:
+                st.caption(f"🔥 デッキ事前読み込み: {warmup_stats['decks']}件 / {warmup_stats['seconds']:.2f}秒")
+            if warmup_stats["last_refresh_seconds"] is not None:
+                st.caption(f"🔁 定期更新: {warmup_stats['refreshes']}回 (前回 {warmup_stats['last_refresh_seconds']:.2f}秒)")
+            if warmup_stats["errors"]:
+                st.caption(f"⚠️ 読み込みエラー: {len(warmup_stats['errors'])}件")
+            flight = _gemini_single_flight()
+            st.caption(
+                f"🤝 Gemini呼び出し: 実行 {flight.executed}件 / 同時リクエスト共有 {flight.shared}件 "
+                f"(優先度の引き上げ {flight.raised}件)"
+            )
+            limiter_metrics = _gemini_rate_limiter().metrics()
+            st.caption(
+                f"🚦 Geminiレート制限: {limiter_metrics['effective_rpm']:.1f} RPM / "
+                f"待ち行列 {limiter_metrics['queue_depth']}件 / 429 {limiter_metrics['throttled']}回"
+            )
+            for priority, avg_wait in sorted(limiter_metrics["avg_wait"].items()):
+                st.caption(
+                    f"　⏳ {GEMINI_PRIORITY_LABELS.get(priority, priority)}: 平均待ち {avg_wait:.2f}秒"
+                    f" / 最大 {limiter_metrics['max_wait'][priority]:.2f}秒"
+                )
+            http_metrics = _gemini_http_client().metrics()
+            st.caption(
+                f"🔌 Gemini接続 ({http_metrics['protocol']}): リクエスト {http_metrics['requests']}件 / "
+                f"新規接続 {http_metrics['connections']}件 / 再利用 {http_metrics['reused']}件"
+            )
+            edit_buffer = _sheet_edit_buffer()
+            st.caption(
+                f"✏️ セル編集: {edit_buffer.edits}件 (まとめ {edit_buffer.coalesced}件) / "
+                f"書き込み {edit_buffer.batches}回 / 待ち {edit_buffer.pending_count()}件"
+            )
+            for edit_error in edit_buffer.errors().values():
+                st.caption(f"⚠️ セル編集の書き込みエラー: {edit_error}")
+            sheets_metrics = _sheets_quota().metrics()
+            st.caption(
+                f"📗 Sheetsクォータ: 読み取り {sheets_metrics['read']['effective_rpm']:.0f} RPM "
+                f"(待ち {sheets_metrics['read']['queue_depth']}件) / "
+                f"書き込み {sheets_metrics['write']['effective_rpm']:.0f} RPM "
+                f"(待ち {sheets_metrics['write']['queue_depth']}件) / "
+                f"429 {sheets_metrics['read']['throttled'] + sheets_metrics['write']['throttled']}回"
+            )
+            for kind, label in (("read", "読み取り"), ("write", "書き込み")):
+                for priority, avg_wait in sorted(sheets_metrics[kind]["avg_wait"].items()):
+                    st.caption(
+                        f"　⏳ {label}・{SHEETS_PRIORITY_LABELS.get(priority, priority)}: 平均待ち {avg_wait:.2f}秒"
+                        f" / 最大 {sheets_metrics[kind]['max_wait'][priority]:.2f}秒"
+                    )
+            for caller, counts in sorted(sheets_metrics["calls"].items(),
+                                         key=lambda kv: -(kv[1]["read"] + kv[1]["write"])):
+                st.caption(
+                    f"　📄 {caller}: 読み取り {counts['read']}件 / 書き込み {counts['write']}件 / "
+                    f"再試行 {counts['retries']}件 / 失敗 {counts['errors']}件 / 待ち {counts['wait']:.1f}秒"
+                )
+            card_store = _card_state()
+            spilled_count, spilled_bytes = _ai_text_cache().stats()
+            st.caption(
+                f"🗂️ カード状態（このセッション）: {len(card_store)}枚 / {card_store.nbytes() / 1024:.0f}KB "
+                f"(追い出し {card_store.evicted}枚 / 復元 {card_store.restored}件) / "
+                f"退避先 {spilled_count}件 {spilled_bytes / 1024:.0f}KB"
+            )
+            if "session_seed" in st.session_state:
+                st.caption(
+                    f"🎲 出題シード: {st.session_state.session_seed} "
+                    f"(クイズ {st.session_state.get('quiz_round', 0)}周 / カード {st.session_state.get('fc_round', 0)}周 / "
+                    f"マッチング {st.session_state.get('match_round', 0)}回)"
+                )
+            difficulty_decks, difficulty_responses, difficulty_seconds = _difficulty_models().stats()
+            if difficulty_decks:
+                st.caption(
+                    f"📊 難易度モデル: {difficulty_decks}デッキ / 回答 {difficulty_responses}件 / "
+                    f"推定 {difficulty_seconds:.2f}秒"
+                )
+            for difficulty_error in _difficulty_models().errors().values():
+                st.caption(f"⚠️ 難易度の推定エラー: {difficulty_error}")
+            mermaid_count, mermaid_bytes, mermaid_hits, mermaid_misses = _mermaid_cache().stats()
+            st.caption(
+                f"🖼️ Mermaid図キャッシュ: {mermaid_count}件 / {mermaid_bytes / 1024:.0f}KB "
+                f"(ヒット {mermaid_hits}件 / ミス {mermaid_misses}件)"
+            )
+            try:
+                total_records, unsynced = _history_store().counts()
+                st.caption(f"🗄️ 履歴DB: {total_records}件 / Sheets未書き出し {unsynced}件")
+                summary_words, summary_attempts = _history_store().summary_counts()
+                if summary_words:
+                    st.caption(f"📦 集約済み履歴: {summary_words}語 / {summary_attempts}回答")
+                if _history_replicator().last_error:
+                    st.caption(f"⚠️ 履歴書き出しエラー: {_history_replicator().last_error}")
+                if _history_replicator().compact_error:
+                    st.caption(f"⚠️ 履歴の集約エラー: {_history_replicator().compact_error}")
+            except Exception:
+                pass
 
         st.caption("設定")
         if st.button("学習履歴をリセット"):
+            clear_learning_history()
+            # キャッシュキーも削除して再生成を促す
+            if "session_cache_key" in st.session_state:
+                del st.session_state.session_cache_key
             if JS_EVAL_AVAILABLE:
-                st.session_state.history = []
-                # キャッシュキーも削除して再生成を促す
-                if "session_cache_key" in st.session_state:
-                    del st.session_state.session_cache_key
                 # LocalStorageもクリア
                 streamlit_js_eval(
-                    js_expressions=f"localStorage.removeItem('{LS_KEY}')",
+                    js_expressions=f"localStorage.removeItem('{_ls_history_key()}')",
                     key=f"ls_clear_{st.session_state.get('_ls_counter', 0)}"
                 )
                 st.session_state._ls_counter += 1
-                st.success("履歴を削除しました")
+            st.success("履歴を削除しました")
 
     # デッキ変更または設定変更検知
-    current_settings = f"{selected_deck_url}_{selected_limit}_{filter_mastered}_{mastered_rate}_{match_pairs}"
+    active_deck_urls = sorted(set(merged_decks.values())) if merged_decks else []
+    deck_settings = "|".join(active_deck_urls) if active_deck_urls else selected_deck_url
+    current_settings = f"{deck_settings}_{selected_limit}_{filter_mastered}_{mastered_rate}_{difficulty_order}_{match_pairs}"
+    # ユーザーが変わったらそのユーザーの履歴だけに入れ替える
+    user_id = current_user_id()
+    if st.session_state.get("active_user_id", user_id) != user_id:
+        st.session_state.active_user_id = user_id
+        st.session_state.history = []
+        st.session_state.store_history_loaded = False
+        st.rerun()
+    st.session_state.active_user_id = user_id
     if st.session_state.get("current_settings") != current_settings:
         st.session_state.current_settings = current_settings
-        st.session_state.current_deck_url = selected_deck_url  # デッキURLを更新
-        st.session_state.sheets_history_loaded = False         # 切り替え時に履歴を再読み込み
-        st.session_state.quiz_pool = None
+        # 統合時は先頭デッキを既定の書き込み先とし、各問題は deck_url で振り分ける
+        st.session_state.current_deck_url = active_deck_urls[0] if active_deck_urls else selected_deck_url  # デッキURLを更新
+        st.session_state.active_deck_urls = active_deck_urls
+        st.session_state.store_history_loaded = False          # 切り替え時に履歴を再読み込み（SQLiteの索引検索）
+        cancel_ai_prefetch()
+        st.session_state.pop("search_restrict", None)
+        st.session_state.quiz_perm = None
         st.session_state.quiz_question = None
         st.session_state.quiz_finished = False
         st.session_state.quiz_total = 0
@@ -1977,7 +5722,7 @@ def main():
         
         st.session_state.fc_index = 0
         st.session_state.fc_flipped = False
-        st.session_state.fc_order = []
+        st.session_state.fc_perm = None
         
         st.session_state.match_finished = False
         st.session_state.match_cards = []
@@ -1986,13 +5731,44 @@ def main():
             del st.session_state.session_cache_key
 
     # データ読み込み
-    data = load_data(selected_deck_url)
+    if active_deck_urls:
+        data = load_decks_merged(merged_decks)
+    else:
+        data = load_data(selected_deck_url)
     if not data:
         st.error("データを読み込めませんでした。")
         return
 
+    with st.sidebar:
+        with st.expander("🗑️ 非表示の管理"):
+            hidden_cards_panel(data)
+        with st.expander("🧬 近似重複の確認"):
+            near_duplicates_panel(data)
+
+    if mode == "検索":
+        default_url = st.session_state.get("current_deck_url") or ""
+        if active_deck_urls:
+            sources = {url: load_data_by_url(url) for url in active_deck_urls}
+            deck_names = {url: name for name, url in reversed(list(merged_decks.items()))}
+        else:
+            sources = {default_url: data}
+            deck_names = {}
+        search_mode(sources, deck_names)
+        return
+
+    # 検索結果に限定して出題中
+    restrict = st.session_state.get("search_restrict")
+    if restrict:
+        default_url = st.session_state.get("current_deck_url") or ""
+        data = [d for d in data if (d.get("deck_url") or default_url, d["front"]) in restrict["keys"]]
+        with st.sidebar:
+            st.info(f"🔎 「{restrict['query']}」の検索結果 {len(data)}件から出題中")
+            if st.button("検索の絞り込みを解除", key="clear_search_restrict", use_container_width=True):
+                del st.session_state.search_restrict
+                st.rerun()
+
     # データをフィルタリング & スライス
-    filtered_data = filter_and_slice_data(data, selected_limit, filter_mastered, mastered_rate)
+    filtered_data = filter_and_slice_data(data, selected_limit, filter_mastered, mastered_rate, difficulty_order)
 
     if not filtered_data:
         st.warning("条件に一致する問題がありません（全て正解済み、またはデータ自体が空です）。")
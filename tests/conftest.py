@@ -0,0 +1,5 @@
+import os
+import sys
+
+# main.py をリポジトリのルートから import する（streamlit run を通さない bare モード）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
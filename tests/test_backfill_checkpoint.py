@@ -0,0 +1,36 @@
+import main as app
+
+
+def test_checkpoint_replays_generated_and_written(tmp_path):
+    path = str(tmp_path / "backfill.jsonl")
+    checkpoint = app._BackfillCheckpoint(path)
+    checkpoint.record_generated("deck", "apple", "りんごの解説")
+    checkpoint.record_generated("deck", "pear", "なしの解説")
+    checkpoint.record_generated("other", "apple", "別デッキ")
+    checkpoint.record_written("deck", ["apple"])
+    checkpoint.close()
+
+    resumed = app._BackfillCheckpoint(path)
+    assert resumed.written == {("deck", "apple")}
+    # 書き込み済みは生成済みから外れ、デッキが違えば別のカード
+    assert resumed.generated == {("deck", "pear"): "なしの解説", ("other", "apple"): "別デッキ"}
+    resumed.close()
+
+
+def test_checkpoint_ignores_a_truncated_last_line_and_keeps_appending(tmp_path):
+    path = tmp_path / "backfill.jsonl"
+    checkpoint = app._BackfillCheckpoint(str(path))
+    checkpoint.record_generated("deck", "apple", "解説")
+    checkpoint.close()
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"url": "deck", "front": "解')  # 追記の途中で止まった
+
+    resumed = app._BackfillCheckpoint(str(path))
+    assert resumed.generated == {("deck", "apple"): "解説"}
+    resumed.record_written("deck", ["apple"])
+    resumed.close()
+    # 途中で止まった行の続きにはならず、書き込み済みの記録が残る
+    again = app._BackfillCheckpoint(str(path))
+    assert again.written == {("deck", "apple")}
+    assert again.generated == {}
+    again.close()
@@ -0,0 +1,72 @@
+import time
+
+import numpy as np
+
+import main as app
+
+
+def test_fit_recovers_known_difficulties():
+    rng = np.random.default_rng(0)
+    n_users, n_cards = 200, 60
+    ability = rng.normal(0, 1, n_users)
+    difficulty = rng.normal(0, 1, n_cards)
+    users, cards = np.meshgrid(np.arange(n_users), np.arange(n_cards), indexing="ij")
+    users, cards = users.ravel(), cards.ravel()
+    attempts = np.full(users.size, 3)
+    p = 1 / (1 + np.exp(-(0.5 + ability[users] - difficulty[cards])))
+    corrects = rng.binomial(attempts, p)
+
+    base, theta, b = app.fit_card_difficulty(users, cards, attempts, corrects)
+    assert np.corrcoef(b, difficulty)[0, 1] > 0.95
+    assert np.corrcoef(theta, ability)[0, 1] > 0.9
+    assert abs(b.mean()) < 1e-6 and abs(theta.mean()) < 1e-6
+
+
+class _Store:
+    def __init__(self, rows=None, error=None):
+        self.rows, self.error, self.calls = rows or [], error, 0
+
+    def card_counts(self, _url):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        return self.rows
+
+
+def test_failed_fit_is_not_retried_until_the_backoff_passes(monkeypatch):
+    store = _Store(error=RuntimeError("db locked"))
+    monkeypatch.setattr(app, "_history_store", lambda: store)
+    registry = app._DifficultyRegistry(max_age=3600, retry_after=0.2)
+
+    assert registry.get("deck") is None
+    assert registry.get("deck") is None
+    registry.refresh("deck")
+    assert store.calls == 1
+    assert registry.errors() == {"deck": "db locked"}
+
+    time.sleep(0.25)
+    assert registry.get("deck") is None
+    assert store.calls == 2  # 2回目の失敗の後は間隔が倍になる
+    time.sleep(0.1)
+    assert registry.get("deck") is None and store.calls == 2
+
+    store.error = None
+    store.rows = [("u", "apple", 4, 1), ("u", "pear", 4, 3)]
+    time.sleep(0.4)
+    assert registry.get("deck") is not None
+    assert registry.errors() == {}
+
+
+def test_non_blocking_get_fits_in_the_background(monkeypatch):
+    store = _Store(rows=[("u", "apple", 4, 1), ("v", "apple", 2, 2)])
+    monkeypatch.setattr(app, "_history_store", lambda: store)
+    registry = app._DifficultyRegistry(max_age=3600)
+
+    assert registry.get("deck", wait=False) is None
+    deadline = time.monotonic() + 5
+    model = None
+    while model is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+        model = registry.get("deck", wait=False)
+    assert model is not None and "apple" in model.difficulty
+    assert store.calls == 1
@@ -0,0 +1,41 @@
+import threading
+
+from bench_gemini_pool import start_stub_server
+
+import main as app
+
+
+def _url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}/v1beta/models/stub:generateContent"
+
+
+def test_sequential_requests_reuse_one_connection():
+    server = start_stub_server(0)
+    try:
+        client = app._GeminiHTTPClient(pool_size=2)
+        for _ in range(5):
+            client.post_json(_url(server), {"contents": []})
+        metrics = client.metrics()
+    finally:
+        server.shutdown()
+    assert metrics["requests"] == 5
+    assert metrics["connections"] == server.connections == 1
+    assert metrics["reused"] == 4
+
+
+def test_overflow_connections_beyond_the_pool_are_counted():
+    server = start_stub_server(50)  # 接続ごとに待たせて同時接続を起こす
+    try:
+        client = app._GeminiHTTPClient(pool_size=1)
+        threads = [threading.Thread(target=client.post_json, args=(_url(server), {})) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        metrics = client.metrics()
+    finally:
+        server.shutdown()
+    # プールに戻らない一時的な接続も、サーバーが受けた接続数と一致する
+    assert metrics["connections"] == server.connections
+    assert metrics["connections"] > 1
+    assert metrics["reused"] == 4 - metrics["connections"]
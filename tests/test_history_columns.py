@@ -0,0 +1,58 @@
+import math
+
+import main as app
+
+
+def _record(word, day, second, correct):
+    # 日本時間の正午付近に置いて、日付の境目をまたがないようにする
+    return {"word": word, "timestamp": f"2026-01-{day:02d} 12:00:{second:02d}", "correct": correct}
+
+
+def test_totals_daily_and_per_word_streaks():
+    columns = app._HistoryColumns()
+    columns.append([
+        _record("a", 1, 0, False),
+        _record("a", 1, 1, True),
+        _record("b", 1, 2, False),
+        _record("a", 2, 0, True),
+        _record("b", 2, 1, False),
+    ])
+    assert columns.totals() == (5, 2)
+
+    daily = columns.daily()
+    assert [d.isoformat() for d in daily["日付"]] == ["2026-01-01", "2026-01-02"]
+    assert daily["回答数"] == [3, 2]
+    assert daily["正答率 (%)"] == [33.3, 50.0]
+
+    stats = columns.per_word()
+    a, b = columns.words.index("a"), columns.words.index("b")
+    assert stats["attempts"][a] == 3 and stats["corrects"][a] == 2
+    assert stats["streak"][a] == 2 and stats["streak"][b] == -2
+    assert bool(stats["last_correct"][a]) and not bool(stats["last_correct"][b])
+    assert math.isclose(stats["accuracy"][b], 0.0)
+
+    assert [row["単語"] for row in columns.weakest(min_attempts=2)] == ["b", "a"]
+
+
+def test_incremental_append_matches_a_fresh_build_and_grows_capacity():
+    records = [_record(f"w{i % 7}", 1 + i // 500, i % 60, i % 3 == 0) for i in range(1500)]
+    incremental = app._HistoryColumns()
+    for start in range(0, len(records), 100):
+        incremental.append(records[start:start + 100])
+        incremental.per_word()  # 集計結果のキャッシュが追加のたびに捨てられること
+    fresh = app._HistoryColumns()
+    fresh.append(records)
+
+    assert incremental.n == fresh.n == 1500
+    assert incremental.totals() == fresh.totals()
+    assert incremental.daily() == fresh.daily()
+    for key in ("attempts", "corrects", "streak"):
+        assert incremental.per_word()[key].tolist() == fresh.per_word()[key].tolist()
+
+
+def test_out_of_order_records_are_aggregated_in_time_order():
+    columns = app._HistoryColumns()
+    columns.append([_record("a", 2, 0, True), _record("a", 1, 0, False)])
+    # 時刻順では 不正解 -> 正解 なので、直近は正解で連続1
+    stats = columns.per_word()
+    assert stats["streak"][0] == 1 and bool(stats["last_correct"][0])
@@ -0,0 +1,162 @@
+import gspread
+import pytest
+
+import main as app
+
+OLD = "2024-01-01T10:00:0{}+09:00"
+NEW = "2024-03-01T10:00:0{}+09:00"
+CUTOFF = app._timestamp_to_epoch("2024-02-01T00:00:00+09:00")
+
+
+def _records(*rows):
+    return [{"word": w, "correct": c, "timestamp": ts} for w, c, ts in rows]
+
+
+def _totals(store, deck):
+    return sorted(store.card_counts(deck))
+
+
+def test_compaction_keeps_per_word_totals(tmp_path):
+    store = app._HistoryStore(str(tmp_path / "h.db"))
+    store.add(_records(
+        ("a", True, OLD.format(0)), ("a", False, OLD.format(1)), ("b", True, OLD.format(2)),
+        ("a", True, NEW.format(0)),
+    ), "deck", "u", replicated=True)
+    store.add(_records(("b", False, OLD.format(3))), "deck", "u")  # Sheets 未書き出し
+    before = _totals(store, "deck")
+
+    assert store.compact(CUTOFF) == 3
+    assert _totals(store, "deck") == before
+    # 新しい行と未書き出しの行は生のまま残る
+    assert [(r["word"], r["correct"]) for r in store.query("deck", "u")] == [("b", False), ("a", True)]
+    summary = store.summaries("deck", "u")
+    assert summary["a"] == {"attempts": 2, "corrects": 1, "last_correct": False, "last_timestamp": OLD.format(1)}
+
+    # 2回目の集約は既存の集約行に足し込む
+    store.mark_replicated([row[0] for row in store.unreplicated()])
+    assert store.compact(CUTOFF) == 1
+    assert _totals(store, "deck") == before
+    assert store.summaries("deck", "u")["b"]["attempts"] == 2
+    assert store.summary_counts() == (2, 4)
+
+
+class _FakeWorksheet:
+    def __init__(self, rows, col_count=26):
+        self.rows = rows
+        self.col_count = col_count
+        self.fail = set()
+
+    def get_all_values(self):
+        return [list(r) for r in self.rows]
+
+    def clear(self):
+        self.rows = []
+
+    def add_cols(self, count):
+        self.col_count += count
+
+    def update(self, rows, _cell):
+        if "update" in self.fail:
+            raise gspread.exceptions.GSpreadException("update failed")
+        assert max(len(r) for r in rows) <= self.col_count
+        # 書いた範囲だけを上書きし、それより下の行はそのまま残る
+        self.rows[:len(rows)] = [[str(v) for v in r] for r in rows]
+
+    def delete_rows(self, start, end):
+        if "delete_rows" in self.fail:
+            raise gspread.exceptions.GSpreadException("delete failed")
+        del self.rows[start - 1:end]
+
+
+class _FakeSpreadsheet:
+    def __init__(self, sheets):
+        self.sheets = sheets
+
+    def worksheet(self, name):
+        if name not in self.sheets:
+            raise gspread.WorksheetNotFound(name)
+        return self.sheets[name]
+
+    def add_worksheet(self, title, rows, cols):
+        self.sheets[title] = _FakeWorksheet([])
+        return self.sheets[title]
+
+
+@pytest.fixture
+def sheet(monkeypatch):
+    history = _FakeWorksheet([
+        app.HISTORY_SHEET_HEADER,
+        [OLD.format(0), "a", "Correct"],
+        [OLD.format(1), "a", "Wrong"],
+        [OLD.format(2), "b", "Correct"],
+        [NEW.format(0), "a", "Correct"],
+    ])
+    spreadsheet = _FakeSpreadsheet({app.history_sheet_name("u"): history})
+    monkeypatch.setattr(app, "_open_spreadsheet", lambda *_args, **_kwargs: spreadsheet)
+    for name in ("sheets_read", "sheets_write"):
+        monkeypatch.setattr(app, name, lambda _caller, fn, *args, **kwargs: fn(*args, **kwargs))
+    return spreadsheet
+
+
+def _sheet_totals(spreadsheet):
+    totals = {}
+    for r in spreadsheet.sheets[app.history_sheet_name("u")].rows[1:]:
+        t = totals.setdefault(r[1], [0, 0])
+        t[0] += 1
+        t[1] += r[2] == "Correct"
+    summary = spreadsheet.sheets.get(app.history_summary_sheet_name("u"))
+    for r in (summary.rows[1:] if summary else []):
+        t = totals.setdefault(r[0], [0, 0])
+        t[0] += int(r[1])
+        t[1] += int(r[2])
+    return totals
+
+
+def test_sheet_compaction_keeps_totals_and_is_idempotent(sheet):
+    before = _sheet_totals(sheet)
+    assert app._compact_history_sheet("url", "u", CUTOFF) == 3
+    assert _sheet_totals(sheet) == before
+    assert [r[1] for r in sheet.sheets[app.history_sheet_name("u")].rows[1:]] == ["a"]
+    # 集約する行が残っていなければ何もしない
+    assert app._compact_history_sheet("url", "u", CUTOFF) == 0
+    assert _sheet_totals(sheet) == before
+
+
+def test_failed_summary_write_keeps_previous_summary(sheet):
+    summary_name = app.history_summary_sheet_name("u")
+    previous = [app.HISTORY_SUMMARY_HEADER[:6], ["z", "5", "4", "Correct", OLD.format(0), OLD.format(0)]]
+    sheet.sheets[summary_name] = _FakeWorksheet([list(r) for r in previous], col_count=6)
+    sheet.sheets[summary_name].fail.add("update")
+    with pytest.raises(gspread.exceptions.GSpreadException):
+        app._compact_history_sheet("url", "u", CUTOFF)
+    assert sheet.sheets[summary_name].rows == previous
+    assert len(sheet.sheets[app.history_sheet_name("u")].rows) == 5
+
+    # 列の足りない古い集約タブも広げてから書き込む
+    sheet.sheets[summary_name].fail.clear()
+    before = _sheet_totals(sheet)
+    assert app._compact_history_sheet("url", "u", CUTOFF) == 3
+    assert _sheet_totals(sheet) == before
+
+
+def test_interrupted_compaction_is_not_counted_twice(sheet):
+    before = _sheet_totals(sheet)
+    history = sheet.sheets[app.history_sheet_name("u")]
+    history.fail.add("delete_rows")
+    with pytest.raises(gspread.exceptions.GSpreadException):
+        app._compact_history_sheet("url", "u", CUTOFF)
+    history.fail.clear()
+    assert app._compact_history_sheet("url", "u", CUTOFF) == 3
+    assert _sheet_totals(sheet) == before
+
+
+def test_late_rows_older_than_previous_compaction_are_counted(sheet):
+    history = sheet.sheets[app.history_sheet_name("u")]
+    assert app._compact_history_sheet("url", "u", CUTOFF) == 3
+    # 別のサーバーから遅れて書き出された古い行
+    history.rows.append([OLD.format(5), "b", "Wrong"])
+    before = _sheet_totals(sheet)
+    later_cutoff = app._timestamp_to_epoch("2024-04-01T00:00:00+09:00")
+    assert app._compact_history_sheet("url", "u", later_cutoff) == 2
+    assert _sheet_totals(sheet) == before
+    assert before["b"] == [2, 1]
@@ -0,0 +1,63 @@
+import main as app
+
+
+def _records(*rows):
+    return [{"word": w, "correct": c, "timestamp": ts} for w, c, ts in rows]
+
+
+def test_query_is_partitioned_by_deck_and_user(tmp_path):
+    store = app._HistoryStore(str(tmp_path / "h.db"))
+    store.add(_records(("a", True, "2024-01-01T10:00:00+09:00")), "deck1", "alice")
+    store.add(_records(("b", False, "2024-01-01T09:00:00+09:00")), "deck1", "bob")
+    store.add(_records(("c", True, "2024-01-01T08:00:00+09:00")), "deck2", "alice")
+
+    assert [r["word"] for r in store.query("deck1", "alice")] == ["a"]
+    assert [r["word"] for r in store.query("deck1", "bob")] == ["b"]
+    assert store.query("deck2", "bob") == []
+
+
+def test_query_returns_oldest_first(tmp_path):
+    store = app._HistoryStore(str(tmp_path / "h.db"))
+    store.add(_records(
+        ("late", True, "2024-01-02T00:00:00+09:00"),
+        ("early", False, "2024-01-01T00:00:00+09:00"),
+    ), "deck", "u")
+    assert [r["word"] for r in store.query("deck", "u")] == ["early", "late"]
+
+
+def test_replication_marks(tmp_path):
+    store = app._HistoryStore(str(tmp_path / "h.db"))
+    store.add(_records(("a", True, "2024-01-01T00:00:00+09:00")), "deck", "u")
+    store.add(_records(("b", True, "2024-01-01T00:00:01+09:00")), "deck", "u", replicated=True)
+
+    pending = store.unreplicated()
+    assert [row[3] for row in pending] == ["a"]
+    store.mark_replicated([row[0] for row in pending])
+    assert store.unreplicated() == []
+
+
+def test_clear_removes_only_the_partition_and_keeps_import_mark(tmp_path):
+    store = app._HistoryStore(str(tmp_path / "h.db"))
+    store.add(_records(("a", True, "2024-01-01T00:00:00+09:00")), "deck", "alice")
+    store.add(_records(("a", False, "2024-01-01T00:00:00+09:00")), "deck", "bob")
+    store.mark_imported("deck", "alice")
+
+    assert store.clear("deck", "alice") == 1
+    assert store.query("deck", "alice") == []
+    assert len(store.query("deck", "bob")) == 1
+    # シートから取り込み直して消した履歴が戻らないこと
+    assert store.is_imported("deck", "alice")
+
+
+def test_anonymous_history_stays_in_sqlite(tmp_path):
+    store = app._HistoryStore(str(tmp_path / "h.db"))
+    url = "https://docs.google.com/spreadsheets/d/example"
+    store.add(_records(("a", True, "2024-01-01T00:00:00+09:00")), url, "anon-0123456789abcdef")
+    store.add(_records(("b", True, "2024-01-01T00:00:00+09:00")), url, "")
+    replicator = app._HistoryReplicator(store, interval=60, start=False)
+
+    # シートに書き出さずに書き出し済みになる（共有の History タブにも個別タブにも書かない）
+    replicator.replicate_pending()
+    assert store.unreplicated() == []
+    assert replicator.last_error is None
+    assert app.is_anonymous_user("") and not app.is_anonymous_user("browser-1")
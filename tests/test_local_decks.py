@@ -0,0 +1,52 @@
+import pytest
+
+import main as app
+
+
+@pytest.fixture
+def decks(tmp_path, monkeypatch):
+    allowed = tmp_path / "decks"
+    allowed.mkdir()
+    (allowed / "a.csv").write_text("表,裏\nりんご,apple\n", encoding="utf-8")
+    (allowed / "notes.txt").write_text("x,y\n", encoding="utf-8")
+    outside = tmp_path / "outside.csv"
+    outside.write_text("表,裏\nなし,pear\n", encoding="utf-8")
+    configured = tmp_path / "configured.csv"
+    configured.write_text("表,裏\nもも,peach\n", encoding="utf-8")
+    monkeypatch.setattr(app, "configured_deck_urls", lambda: [str(configured), "https://example.com/sheet"])
+    monkeypatch.setattr(app, "_local_deck_dir", lambda: str(allowed.resolve()))
+    monkeypatch.setattr(app, "_trusted_local_decks", set())
+    return allowed, outside, configured
+
+
+def test_only_configured_or_local_deck_dir_paths_are_local_decks(decks):
+    allowed, outside, configured = decks
+    assert app.is_local_deck(str(configured))
+    assert app.is_local_deck(str(allowed / "a.csv"))
+    assert app.is_local_deck("file://" + str(allowed))
+    assert not app.is_local_deck(str(outside))
+    assert not app.is_local_deck("/etc/passwd")
+    assert not app.is_local_deck("/dev/zero")
+    # local_deck_dir の外を指すパスは、相対指定でもたどらない
+    assert not app.is_local_deck(str(allowed / ".." / "outside.csv"))
+
+
+def test_files_must_have_a_deck_extension(decks):
+    allowed, _outside, _configured = decks
+    assert not app.is_local_deck(str(allowed / "notes.txt"))
+    assert app._local_deck_files(str(allowed / "notes.txt")) == []
+    assert app._local_deck_files(str(allowed)) == [str(allowed / "a.csv")]
+
+
+def test_symlinks_are_checked_after_resolving(decks, tmp_path):
+    allowed, outside, _configured = decks
+    (allowed / "link.csv").symlink_to(outside)
+    assert not app.is_local_deck(str(allowed / "link.csv"))
+    assert app._local_deck_files(str(allowed)) == [str(allowed / "a.csv")]
+
+
+def test_command_line_decks_can_be_trusted(decks):
+    _allowed, outside, _configured = decks
+    app.trust_local_deck(str(outside))
+    assert app.is_local_deck(str(outside))
+    assert [item["front"] for item in app.iter_deck_items(str(outside))] == ["なし"]
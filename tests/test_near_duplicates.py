@@ -0,0 +1,62 @@
+import random
+
+import numpy as np
+
+import main as app
+
+ALPHABET = "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをん資産負債純損益"
+
+
+def _text(rng, n):
+    return "".join(rng.choice(ALPHABET) for _ in range(n))
+
+
+def _card(front, back="裏"):
+    return {"front": front, "back": back}
+
+
+def test_recall_on_known_near_duplicate_pairs():
+    rng = random.Random(1)
+    items, pairs = [], []
+    for _ in range(200):
+        front = _text(rng, 60)
+        i = rng.randrange(60)
+        edited = front[:i] + rng.choice(ALPHABET) + front[i + 1:]  # 1文字違い（Jaccard 約 0.9）
+        pairs.append((len(items), len(items) + 1))
+        items += [_card(front), _card(edited)]
+    distractors = len(items)
+    items += [_card(_text(rng, 60)) for _ in range(1000)]
+
+    clusters = app._NearDuplicateIndex(items).clusters(0.7)
+    cluster_of = {i: k for k, cluster in enumerate(clusters) for i in cluster}
+    found = sum(1 for a, b in pairs if a in cluster_of and cluster_of.get(a) == cluster_of.get(b))
+    assert found / len(pairs) >= 0.97
+    # 無関係なカードはまとまりに入らない
+    assert not any(i >= distractors for i in cluster_of)
+
+
+def test_clusters_follow_transitive_pairs():
+    rng = random.Random(2)
+    middle = _text(rng, 120)
+    left = _text(rng, 4) + middle[4:]     # 先頭だけ違う
+    right = middle[:-4] + _text(rng, 4)   # 末尾だけ違う
+    items = [_card(left), _card(_text(rng, 120)), _card(middle), _card(right)]
+    index = app._NearDuplicateIndex(items)
+
+    similarity = index._similarity(np.array([0, 2, 0]), np.array([2, 3, 3]))
+    threshold = 0.85
+    # 左と右は直接はしきい値に届かず、真ん中を介してだけつながる
+    assert similarity[0] >= threshold and similarity[1] >= threshold and similarity[2] < threshold
+    assert index.clusters(threshold) == [[0, 2, 3]]
+
+
+def test_similar_finds_an_edited_card_and_find_near_duplicates_keeps_deck_order():
+    rng = random.Random(3)
+    items = [_card(_text(rng, 50)) for _ in range(300)]
+    items.append(_card(items[10]["front"]))
+    target = items[42]["front"]
+    hits = app._NearDuplicateIndex(items).similar(target[:-1] + "資", "裏")
+    assert hits and hits[0][1] is items[42]
+
+    clusters = app.find_near_duplicates(items)
+    assert clusters == [[items[10], items[300]]]
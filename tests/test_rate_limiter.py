@@ -0,0 +1,62 @@
+import threading
+import time
+
+import main as app
+
+
+def test_waiters_are_served_by_priority_then_arrival():
+    limiter = app._PriorityRateLimiter(rpm=300)  # 0.2秒に1件
+    limiter._req_tokens = 0.0
+    order = []
+
+    def call(priority, tag):
+        limiter.acquire(priority)
+        order.append(tag)
+
+    threads = []
+    for priority, tag in [(2, "bg1"), (2, "bg2"), (1, "gen"), (0, "click")]:
+        t = threading.Thread(target=call, args=(priority, tag))
+        t.start()
+        threads.append(t)
+        time.sleep(0.02)
+    for t in threads:
+        t.join()
+    assert order == ["click", "gen", "bg1", "bg2"]
+
+
+def test_bucket_limits_the_rate():
+    limiter = app._PriorityRateLimiter(rpm=600)
+    for _ in range(600):
+        limiter.acquire()  # 満杯のバケットは待たずに取り出せる
+    started = time.monotonic()
+    limiter.acquire()
+    assert time.monotonic() - started >= 0.05
+
+
+def test_throttling_halves_and_success_recovers_additively():
+    limiter = app._PriorityRateLimiter(rpm=60, increase=0.1, decrease_cooldown=0)
+    limiter.on_throttled()
+    assert limiter.scale == 0.5
+    limiter.on_throttled()
+    assert limiter.scale == 0.25
+    limiter.on_success()
+    assert abs(limiter.scale - 0.35) < 1e-9
+    for _ in range(20):
+        limiter.on_success()
+    assert limiter.scale == 1.0
+    assert limiter.throttled == 2
+
+
+def test_concurrent_throttles_within_the_cooldown_decrease_once():
+    limiter = app._PriorityRateLimiter(rpm=60, decrease_cooldown=60)
+    for _ in range(5):
+        limiter.on_throttled()
+    assert limiter.scale == 0.5
+
+
+def test_scale_never_drops_below_the_floor():
+    limiter = app._PriorityRateLimiter(rpm=60, min_scale=0.1, decrease_cooldown=0)
+    for _ in range(20):
+        limiter.on_throttled()
+    assert limiter.scale == 0.1
+    assert limiter.metrics()["effective_rpm"] == 6.0
@@ -0,0 +1,45 @@
+import main as app
+
+
+def _deck():
+    return [
+        {"front": "りんご", "back": "apple", "notes": ""},
+        {"front": "青りんご", "back": "green apple", "notes": ""},
+        {"front": "Ｐｅａｒ", "back": "なし", "explanation": "りんごの仲間ではない"},
+        {"front": "ぶどう", "back": "grape", "hidden": True, "notes": "りんご"},
+    ]
+
+
+def test_front_matches_rank_before_other_fields():
+    index = app._SearchIndex(_deck())
+    # 表面に含むものが先（デッキの並び順）、解説だけに含むものは後。非表示は出さない
+    assert [item["front"] for item in index.search("りんご")] == ["りんご", "青りんご", "Ｐｅａｒ"]
+
+
+def test_search_normalizes_width_and_case_and_requires_every_term():
+    index = app._SearchIndex(_deck())
+    assert [item["front"] for item in index.search("pear")] == ["Ｐｅａｒ"]
+    assert [item["front"] for item in index.search("GREEN apple")] == ["青りんご"]
+    assert index.search("apple なし") == []
+    assert index.search("   ") == []
+
+
+def test_search_respects_limit():
+    items = [{"front": f"card{i}", "back": "x"} for i in range(10)]
+    assert len(app._SearchIndex(items).search("card", limit=3)) == 3
+
+
+def test_update_reindexes_one_card_and_switches_to_the_copied_list():
+    items = _deck()
+    index = app._SearchIndex(items)
+    assert index.search("メモ") == []
+
+    copied = list(items)
+    copied[0] = {**items[0], "notes": "メモを追加"}
+    index.update("りんご", copied)
+    assert index.items is copied
+    assert index.search("メモ") == [copied[0]]
+    # 古いトークンだけで引けていた語は当たらなくなる
+    copied[1] = {**items[1], "back": "lime"}
+    index.update("青りんご", copied)
+    assert [item["front"] for item in index.search("green")] == []
@@ -0,0 +1,32 @@
+import pytest
+
+import main as app
+
+
+@pytest.mark.parametrize("n", [0, 1, 2, 3, 5, 16, 17, 100, 1000, 4097])
+@pytest.mark.parametrize("seed", [0, 1, 12345, 2**32 - 1])
+def test_seeded_permutation_is_a_bijection_with_inverse(n, seed):
+    perm = app._SeededPermutation(n, seed)
+    values = [perm[i] for i in range(n)]
+    assert sorted(values) == list(range(n))
+    assert all(perm.index(v) == i for i, v in enumerate(values))
+
+
+def test_seeded_permutation_depends_only_on_the_seed():
+    a, b, c = (app._SeededPermutation(500, s) for s in (7, 7, 8))
+    assert [a[i] for i in range(500)] == [b[i] for i in range(500)]
+    assert [a[i] for i in range(500)] != [c[i] for i in range(500)]
+
+
+def test_seeded_permutation_rejects_out_of_range():
+    perm = app._SeededPermutation(10, 1)
+    with pytest.raises(IndexError):
+        perm[10]
+    with pytest.raises(ValueError):
+        perm.index(-1)
+
+
+def test_order_position_inverts_order_index_including_appended_cards():
+    perm = app._SeededPermutation(20, 3)
+    for position in range(25):  # 20 以降はスライスの末尾に足したカード
+        assert app._order_position(perm, app._order_index(perm, position)) == position
@@ -0,0 +1,84 @@
+import main as app
+
+
+def test_combine_cell_edit_set_overrides_and_append_accumulates():
+    assert app._combine_cell_edit(None, ("append", "a")) == ("append", "a")
+    assert app._combine_cell_edit(("append", "a"), ("append", "b")) == ("append", "a\nb")
+    assert app._combine_cell_edit(("set", "a"), ("append", "b")) == ("set", "a\nb")
+    assert app._combine_cell_edit(("set", ""), ("append", "b")) == ("set", "b")
+    assert app._combine_cell_edit(("append", "a"), ("set", "c")) == ("set", "c")
+
+
+def test_edit_buffer_coalesces_and_overlays_pending_edits():
+    buffer = app._SheetEditBuffer(window=3600)
+    url = "https://example.com/deck"
+    buffer.add(url, "apple", 7, "first")
+    buffer.add(url, "apple", 7, "second")
+    buffer.add(url, "apple", 6, "more", append=True)
+    buffer.add(url, "pear", 8, "TRUE")
+    assert buffer.edits == 4 and buffer.coalesced == 1
+    assert buffer.pending_count() == 3
+
+    items = [{"front": "apple", "notes": "", "explanation": "base"}, {"front": "pear", "hidden": False}]
+    buffer.apply_pending(url, items)
+    assert items[0]["notes"] == "second"
+    assert items[0]["explanation"] == "base\nmore"
+    assert items[1]["hidden"] is True
+
+
+def test_failed_writes_are_retried_then_reported(monkeypatch):
+    buffer = app._SheetEditBuffer(window=3600, max_attempts=2)
+    url = "https://example.com/deck"
+    cleared = []
+    monkeypatch.setattr(app, "clear_deck_cache", cleared.append)
+
+    def fail(_url, _edits):
+        raise RuntimeError("boom")
+
+    buffer._write = fail
+    buffer.add(url, "apple", 7, "memo")
+    buffer.flush()
+    assert buffer.errors() == {url: "boom"}
+    assert buffer.pending_count() == 1  # 次の窓で再送する
+    assert cleared == []
+    buffer.flush()
+    assert buffer.pending_count() == 0  # 上限に達したら諦める
+    assert cleared == [url]  # 編集を重ねたキャッシュは捨ててシートから読み直す
+
+    buffer._write = lambda _url, _edits: None
+    buffer.add(url, "apple", 7, "memo")
+    buffer.flush()
+    assert buffer.errors() == {}
+
+
+def test_deck_cache_update_item_copies_instead_of_mutating():
+    cache = app._DeckCache()
+    url = "https://example.com/deck"
+    original = [{"front": "apple", "notes": ""}, {"front": "pear", "notes": ""}]
+    cache.put(url, original)
+    before = cache.get(url)
+
+    copies = cache.update_item(url, "apple", lambda item: item.update(notes="memo"))
+
+    after = cache.get(url)
+    assert before is original and after is not original
+    assert original[0]["notes"] == ""  # 読み出し済みのリストと dict は変わらない
+    assert after[0]["notes"] == "memo" and after[1] is original[1]
+    assert copies == {id(original[0]): after[0]}
+    assert cache.update_item("https://example.com/other", "apple", lambda item: None) == {}
+
+
+def test_bulk_edits_are_queued_and_copied_in_one_pass():
+    buffer = app._SheetEditBuffer(window=3600)
+    url = "https://example.com/deck"
+    buffer.add_many(url, ["apple", "pear", "apple"], 8, "TRUE")
+    assert buffer.edits == 3 and buffer.coalesced == 1
+    assert buffer.pending_count() == 2
+
+    cache = app._DeckCache()
+    original = [{"front": "apple"}, {"front": "pear"}, {"front": "plum"}]
+    cache.put(url, original)
+    copies = cache.update_items(url, {"apple", "pear"}, lambda item: item.update(hidden=True))
+    after = cache.get(url)
+    assert [item.get("hidden", False) for item in after] == [True, True, False]
+    assert len(copies) == 2 and after[2] is original[2]
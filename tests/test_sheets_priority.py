@@ -0,0 +1,28 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import main as app
+
+
+def test_map_in_context_carries_the_priority_into_workers():
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        assert set(pool.map(lambda _: app._sheets_priority.get(), range(8))) == {app.SHEETS_PRIORITY_INTERACTIVE}
+        with app.sheets_priority(app.SHEETS_PRIORITY_BACKGROUND):
+            seen = app.map_in_context(pool, lambda _: app._sheets_priority.get(), range(8))
+        assert seen == [app.SHEETS_PRIORITY_BACKGROUND] * 8
+        # ワーカー側で変えた値は呼び出し元に漏れない
+        app.map_in_context(pool, lambda _: app._sheets_priority.set(app.SHEETS_PRIORITY_EDIT), range(8))
+    assert app._sheets_priority.get() == app.SHEETS_PRIORITY_INTERACTIVE
+
+
+def test_load_decks_merged_reads_with_the_callers_priority(monkeypatch):
+    seen = {}
+
+    def load(url):
+        seen[url] = app._sheets_priority.get()
+        return [{"front": f"{url}-card", "back": "x"}]
+
+    monkeypatch.setattr(app, "_load_cached_deck", load)
+    with app.sheets_priority(app.SHEETS_PRIORITY_BACKGROUND):
+        merged = app.load_decks_merged({"A": "deck-a", "B": "deck-b"})
+    assert seen == {"deck-a": app.SHEETS_PRIORITY_BACKGROUND, "deck-b": app.SHEETS_PRIORITY_BACKGROUND}
+    assert [(item["deck"], item["front"]) for item in merged] == [("A", "deck-a-card"), ("B", "deck-b-card")]
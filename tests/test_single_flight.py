@@ -0,0 +1,144 @@
+import threading
+import time
+
+import main as app
+
+
+def _start(target, n):
+    threads = [threading.Thread(target=target) for _ in range(n)]
+    for t in threads:
+        t.start()
+    return threads
+
+
+def _wait_for_followers(flight, n):
+    deadline = time.monotonic() + 5
+    while flight.shared < n and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_concurrent_calls_run_once_and_share_the_result():
+    flight = app._SingleFlight()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def fn(_current):
+        calls.append(1)
+        release.wait(5)
+        return "result"
+
+    threads = _start(lambda: results.append(flight.do("k", fn)), 5)
+    _wait_for_followers(flight, 4)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert results == ["result"] * 5
+    assert (flight.executed, flight.shared) == (1, 4)
+
+
+def test_errors_reach_every_caller_and_the_key_is_released():
+    flight = app._SingleFlight()
+    release = threading.Event()
+    errors = []
+
+    def fn(_current):
+        release.wait(5)
+        raise ValueError("boom")
+
+    def call():
+        try:
+            flight.do("k", fn)
+        except ValueError as e:
+            errors.append(str(e))
+
+    threads = _start(call, 3)
+    _wait_for_followers(flight, 2)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert errors == ["boom"] * 3
+    # 失敗は保持しないので、次の呼び出しはもう一度実行される
+    assert flight.do("k", lambda _current: "ok") == "ok"
+
+
+def test_follower_raises_the_running_priority():
+    flight = app._SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    seen = []
+    woken = []
+
+    def fn(current):
+        started.set()
+        release.wait(5)
+        seen.append(current())
+        return "done"
+
+    leader = threading.Thread(target=lambda: flight.do("k", fn, 2))
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=lambda: flight.do("k", fn, 0, on_raise=lambda: woken.append(1)))
+    follower.start()
+    _wait_for_followers(flight, 1)
+    release.set()
+    leader.join()
+    follower.join()
+
+    assert seen == [0]
+    assert woken == [1]
+    assert flight.raised == 1
+
+
+def test_lower_priority_follower_does_not_lower_the_running_priority():
+    flight = app._SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    seen = []
+
+    def fn(current):
+        started.set()
+        release.wait(5)
+        seen.append(current())
+
+    leader = threading.Thread(target=lambda: flight.do("k", fn, 0))
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=lambda: flight.do("k", fn, 2))
+    follower.start()
+    _wait_for_followers(flight, 1)
+    release.set()
+    leader.join()
+    follower.join()
+    assert seen == [0]
+
+
+def test_limiter_reorders_a_waiting_call_whose_priority_was_raised():
+    limiter = app._PriorityRateLimiter(rpm=60)
+    limiter._req_tokens = 0.0  # 次の1件まで約1秒
+    order = []
+    priority = {"value": 2}
+
+    def background():
+        limiter.acquire(lambda: priority["value"])
+        order.append("raised")
+
+    def other():
+        limiter.acquire(1)
+        order.append("other")
+
+    first = threading.Thread(target=background)
+    first.start()
+    time.sleep(0.05)
+    second = threading.Thread(target=other)
+    second.start()
+    time.sleep(0.05)
+    # 引き上げなければ後から来た優先度1が先に通る
+    priority["value"] = 0
+    limiter.wake()
+    first.join()
+    second.join()
+    assert order == ["raised", "other"]